@@ -0,0 +1,106 @@
+# coding=utf-8
+"""
+在 CPU 上用随机初始化的极小 Qwen2-VL 检查多进程启动器: devices: ["cpu"], workers_per_device 个进程
+每张图片只被一个进程打标 (各进程计数之和等于图片数), 输出与单进程打标逐字相同
+
+python benchmarks/launcher_check.py [workers] [count] [scheduler]
+"""
+import os
+import re
+import subprocess
+import sys
+import tempfile
+
+import yaml
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from tiny_qwen import build_model, make_dataset, read_outputs  # noqa: E402
+
+WORKERS = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+COUNT = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+SCHEDULER = sys.argv[3] if len(sys.argv) > 3 else "static"
+
+PROGRESS = re.compile(r"progress (\d+)/(\d+), .* workers \{(.*)\}")
+
+
+def run(script: str, workdir: str, model: str, dataset: str, output: str) -> str:
+    """运行 script, 返回 tagger.log"""
+    config = {
+        "tagger": {
+            "model_path": model,
+            "image_folder": dataset,
+            "output_folder": output,
+            "batch_size": 2,
+            "overwrite": True,
+            "filter_format": ["png"],
+            "max_new_tokens": 32,
+            "scheduler": SCHEDULER,
+            "device": "cpu",
+            "dtype": "float32",
+            "cpu_threads": 1,
+        },
+        "launcher": {"devices": ["cpu"], "workers_per_device": WORKERS, "progress_interval": 1},
+    }
+    with open(os.path.join(workdir, "config.yml"), "w") as f:
+        yaml.safe_dump(config, f)
+    log_path = os.path.join(workdir, "tagger.log")
+    if os.path.exists(log_path):
+        os.remove(log_path)
+    proc = subprocess.run(
+        [sys.executable, os.path.join(ROOT, script)],
+        cwd=workdir,
+        capture_output=True,
+        text=True,
+        env={**os.environ, "PYTHONPATH": ROOT},
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(f"{script} failed: {proc.stderr.strip().splitlines()[-1]}")
+    with open(log_path, encoding="utf-8") as f:
+        return f.read()
+
+
+def main():
+    with tempfile.TemporaryDirectory() as workdir:
+        model = os.path.join(workdir, "model")
+        dataset = os.path.join(workdir, "dataset")
+        build_model(model)
+        make_dataset(dataset, COUNT)
+
+        expected_folder = os.path.join(workdir, "single")
+        run("tagger.py", workdir, model, dataset, expected_folder)
+        expected = read_outputs(expected_folder)
+
+        output = os.path.join(workdir, "launcher")
+        log = run("launcher.py", workdir, model, dataset, output)
+        outputs = read_outputs(output)
+
+        errors = [line for line in log.splitlines() if " - ERROR: " in line or " - WARNING: " in line]
+        finished, total, workers = PROGRESS.findall(log)[-1]
+        counts = {
+            int(rank): int(count)
+            for rank, count in (part.split(": ") for part in workers.split(", "))
+        }
+        different = sorted(
+            path for path in expected.keys() | outputs.keys()
+            if expected.get(path) != outputs.get(path)
+        )
+        print(f"images: {COUNT}, progress {finished}/{total}, per worker {counts}")
+        print(f"outputs: {len(outputs)}, different from single process: {different or 'none'}")
+        for line in errors:
+            print(line)
+
+        ok = (
+            len(counts) == WORKERS
+            and int(finished) == int(total) == sum(counts.values()) == COUNT
+            and len(expected) == COUNT
+            and not different
+            and not errors
+        )
+        print("ok" if ok else "failed")
+        sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+# coding=utf-8
+"""
+对比 metadata 清理方法的单张耗时和峰值内存
+
+python benchmarks/remove_metadata_bench.py [size] [repeat]
+"""
+import io
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from PIL import Image
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+METHODS = ("getdata", "remove_metadata", "strip_bytes")
+
+
+def legacy_remove_metadata(img: Image.Image) -> Image.Image:
+    """旧实现: 每个像素转为 python tuple"""
+    data = list(img.getdata())
+    image_without_exif = Image.new(img.mode, img.size)
+    image_without_exif.putdata(data)
+    return image_without_exif
+
+
+def measure(method: str, path: str, repeat: int):
+    """在子进程中执行, 输出 单张耗时(s) 峰值内存增量(MB)"""
+    import washer
+
+    with open(path, "rb") as f:
+        file_content = f.read()
+    img = Image.open(io.BytesIO(file_content))
+    img.load()
+    base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        if method == "getdata":
+            legacy_remove_metadata(img)
+        elif method == "remove_metadata":
+            washer.remove_metadata(img)
+        else:
+            washer.strip_metadata_bytes(file_content, "webp")
+    elapsed = (time.perf_counter() - start) / repeat
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - base
+    print(f"{elapsed} {peak / 1024}")
+
+
+def main(size: int, repeat: int):
+    workdir = tempfile.mkdtemp()
+    os.chdir(workdir)
+    with open("config.yml", "w") as f:
+        f.write(
+            """
+washer:
+  filter_format: ["webp"]
+  target_format: "webp"
+  location: "."
+"""
+        )
+
+    exif = Image.Exif()
+    exif[0x010E] = "benchmark"
+    path = os.path.join(workdir, "bench.webp")
+    Image.effect_noise((size, size), 64).convert("RGB").save(
+        path, "webp", exif=exif, quality=90
+    )
+
+    print(f"image: {size}x{size}, repeat: {repeat}")
+    for method in METHODS:
+        out = subprocess.run(
+            [
+                sys.executable,
+                os.path.abspath(__file__),
+                "--measure",
+                method,
+                path,
+                str(repeat),
+            ],
+            capture_output=True,
+            text=True,
+            check=True,
+            env={**os.environ, "PYTHONPATH": ROOT},
+        ).stdout.split()
+        print(f"{method:<16} {float(out[0]) * 1000:10.2f} ms {float(out[1]):10.1f} MB")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "--measure":
+        measure(sys.argv[2], sys.argv[3], int(sys.argv[4]))
+    else:
+        main(
+            int(sys.argv[1]) if len(sys.argv) > 1 else 2048,
+            int(sys.argv[2]) if len(sys.argv) > 2 else 3,
+        )
@@ -0,0 +1,83 @@
+# coding=utf-8
+"""
+在 CPU 上用随机初始化的极小 Qwen2-VL 检查连续批处理: 各设置的输出应与 static 模式逐字相同
+连续批处理的 batch_size 小于图片数, 序列在不同步数结束, 会复用空出的 KV cache 行
+
+python benchmarks/scheduler_check.py [max_new_tokens]
+"""
+import os
+import subprocess
+import sys
+import tempfile
+
+import yaml
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from tiny_qwen import build_model, make_dataset, read_outputs  # noqa: E402
+
+MAX_NEW_TOKENS = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+
+# (名称, tagger 设置)
+CASES = [
+    ("continuous", {"scheduler": "continuous", "batch_size": 3}),
+    ("continuous-2", {"scheduler": "continuous", "batch_size": 2}),
+    ("prefix_cache", {"scheduler": "continuous", "batch_size": 3, "prefix_cache": True}),
+    ("vision_cache", {"scheduler": "continuous", "batch_size": 4, "vision_cache": "vision"}),
+]
+
+
+def run_tagger(workdir: str, model: str, dataset: str, name: str, options: dict) -> dict:
+    output = os.path.join(workdir, name)
+    config = {
+        "tagger": {
+            "model_path": model,
+            "image_folder": dataset,
+            "output_folder": output,
+            "batch_size": 3,
+            "overwrite": True,
+            "filter_format": ["png"],
+            "max_new_tokens": MAX_NEW_TOKENS,
+            "device": "cpu",
+            "dtype": "float32",
+            **options,
+        }
+    }
+    with open(os.path.join(workdir, "config.yml"), "w") as f:
+        yaml.safe_dump(config, f)
+    proc = subprocess.run(
+        [sys.executable, os.path.join(ROOT, "tagger.py")],
+        cwd=workdir,
+        capture_output=True,
+        text=True,
+        env={**os.environ, "PYTHONPATH": ROOT},
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(f"{name} failed: {proc.stderr.strip().splitlines()[-1]}")
+    return read_outputs(output)
+
+
+def main():
+    with tempfile.TemporaryDirectory() as workdir:
+        model = os.path.join(workdir, "model")
+        dataset = os.path.join(workdir, "dataset")
+        build_model(model)
+        make_dataset(dataset)
+
+        expected = run_tagger(workdir, model, dataset, "static", {"scheduler": "static"})
+        print(f"static: {len(expected)} captions")
+        failed = False
+        for name, options in CASES:
+            outputs = run_tagger(workdir, model, dataset, name, options)
+            different = sorted(
+                path for path in expected.keys() | outputs.keys()
+                if expected.get(path) != outputs.get(path)
+            )
+            failed |= bool(different)
+            print(f"{name}: {'ok' if not different else f'different {different}'}")
+        sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+# coding=utf-8
+"""
+本地桩服务器上对比 spider 串行与并发爬取的吞吐
+
+python benchmarks/spider_bench.py [count] [latency_ms]
+"""
+import asyncio
+import io
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from PIL import Image
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+COUNT = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+LATENCY = (int(sys.argv[2]) if len(sys.argv) > 2 else 50) / 1000
+
+_buf = io.BytesIO()
+Image.new("RGB", (512, 512), "RED").save(_buf, "png")
+IMAGE = _buf.getvalue()
+
+PAGE = """<html><body>
+<a class="image-view-original-link" href="http://{host}/original/{id}.png">orig</a>
+<ul class="artist-tag-list"><li><a class="search-tag">artist_{id}</a></li></ul>
+<section class="tag-list categorized-tag-list">
+<a class="search-tag">1girl</a><a class="search-tag">solo</a>
+<a class="search-tag">transparent_background</a>
+</section>
+</body></html>"""
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        time.sleep(LATENCY)  # 模拟网络延迟
+        if self.path.startswith("/posts.json"):
+            tags = parse_qs(urlparse(self.path).query)["tags"][0]
+            start, end = tags.split()[0][len("id:") :].split("..")
+            body = json.dumps(
+                [
+                    {
+                        "id": id,
+                        "file_url": f"http://{self.headers['Host']}/original/{id}.png",
+                        "tag_string_artist": f"artist_{id}",
+                        "tag_string_general": "1girl solo transparent_background",
+                    }
+                    for id in range(int(start), int(end) + 1)
+                ]
+            ).encode()
+            content_type = "application/json"
+        elif self.path.startswith("/posts/"):
+            body = PAGE.format(
+                host=self.headers["Host"], id=self.path.rsplit("/", 1)[-1]
+            ).encode()
+            content_type = "text/html"
+        else:
+            body = IMAGE
+            content_type = "image/png"
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host = f"127.0.0.1:{server.server_address[1]}"
+
+    workdir = tempfile.mkdtemp()
+    os.chdir(workdir)
+    with open("config.yml", "w") as f:
+        f.write(
+            f"""
+spider:
+  domain: "{host}"
+  protocol: "http"
+  file_save_location: "./dataset"
+  max_res: 4194304
+  latest_id: 0
+  max_id: {COUNT}
+  target_format: "webp"
+  rate_limit: 100000
+  burst: 100000
+washer:
+  filter_format: ["png"]
+  target_format: "webp"
+  location: "./dataset"
+"""
+        )
+
+    import spider
+
+    start = time.perf_counter()
+    for id in range(COUNT):
+        spider.run(id)
+    serial = time.perf_counter() - start
+
+    start = time.perf_counter()
+    asyncio.run(spider.crawl(range(COUNT, COUNT * 2)))
+    concurrent = time.perf_counter() - start
+
+    spider._CONFIG.backend = "api"
+    start = time.perf_counter()
+    asyncio.run(
+        spider.crawl(spider.group_ids(range(COUNT * 2, COUNT * 3), spider._CONFIG.page_size))
+    )
+    api = time.perf_counter() - start
+    spider.get_ledger().close()
+
+    print(f"posts: {COUNT}, latency: {LATENCY * 1000:.0f}ms, workdir: {workdir}")
+    print(f"serial: {serial:.2f}s, {COUNT / serial:.1f} posts/s")
+    print(f"async:  {concurrent:.2f}s, {COUNT / concurrent:.1f} posts/s")
+    print(f"api:    {api:.2f}s, {COUNT / api:.1f} posts/s")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+# coding=utf-8
+"""
+各入口模块的启动耗时: 在新进程中导入模块, 以及导入后执行一个不加载模型的最小操作
+config.yml 为临时目录中只含 writer 部分的最小配置, 导入时不应读取其他部分
+
+python benchmarks/startup_bench.py [repeat]
+"""
+import os
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+REPEAT = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+
+# (模块, 导入后执行的最小操作)
+CASES = [
+    ("spider", "spider.parse_post(1, PAGE)"),
+    ("washer", "washer.strip_metadata_bytes(b'', 'png')"),
+    ("scorer", "scorer.bucket(5.0, [('best quality', 4.0)])"),
+    ("box_detect", ""),
+    ("tagger", ""),
+    ("launcher", ""),
+    ("combine", ""),
+    ("pipeline", ""),
+]
+
+HEAVY = ("torch", "transformers", "qwen_vl_utils", "bs4", "ultralytics", "waifuset")
+
+# 最小的 post 页面, 解析时导入 bs4
+PAGE = (
+    b'<a class="image-view-original-link" href="/1.png"></a>'
+    b'<section class="tag-list categorized-tag-list"><a class="search-tag">solo</a></section>'
+)
+
+SCRIPT = """
+import sys, time
+PAGE = {page!r}
+start = time.perf_counter()
+import {module}
+{action}
+elapsed = time.perf_counter() - start
+heavy = [name for name in {heavy!r} if name in sys.modules]
+print(elapsed, ",".join(heavy))
+"""
+
+
+def measure(module: str, action: str, cwd: str):
+    times = []
+    heavy = ""
+    for _ in range(REPEAT):
+        output = subprocess.run(
+            [sys.executable, "-c", SCRIPT.format(module=module, action=action, heavy=HEAVY, page=PAGE)],
+            cwd=cwd,
+            env={**os.environ, "PYTHONPATH": ROOT},
+            capture_output=True,
+            text=True,
+        )
+        if output.returncode != 0:
+            return None, output.stderr.strip().splitlines()[-1]
+        elapsed, _, heavy = output.stdout.strip().partition(" ")
+        times.append(float(elapsed))
+    return min(times), heavy
+
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        with open(os.path.join(tmp, "config.yml"), "w") as f:
+            f.write("writer:\n  workers: 1\n")
+
+        print(f"{'module':<12} {'startup':>10}  heavy modules loaded")
+        for module, action in CASES:
+            elapsed, heavy = measure(module, action, tmp)
+            if elapsed is None:
+                print(f"{module:<12} {'failed':>10}  {heavy}")
+                continue
+            print(f"{module:<12} {elapsed * 1000:>8.0f}ms  {heavy or '-'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+# coding=utf-8
+"""
+对比打标器各推理模式的模型占用、峰值内存和吞吐量
+
+python benchmarks/tagger_bench.py <model_path> <image_folder> [mode ...]
+
+mode: bf16 fp16 int8 int4 auto cpu cpu-int8, 默认全部
+"""
+import os
+import re
+import subprocess
+import sys
+import tempfile
+
+import yaml
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MODES = {
+    "bf16": {"device": "cuda:0", "dtype": "bfloat16"},
+    "fp16": {"device": "cuda:0", "dtype": "float16"},
+    "int8": {"device": "cuda:0", "dtype": "bfloat16", "quantization": "int8"},
+    "int4": {"device": "cuda:0", "dtype": "bfloat16", "quantization": "int4"},
+    "auto": {"device_map": "auto", "dtype": "bfloat16"},
+    "cpu": {"device": "cpu", "dtype": "float32"},
+    "cpu-int8": {"device": "cpu", "dtype": "float32", "quantization": "int8"},
+}
+
+PATTERNS = {
+    "footprint": re.compile(r"footprint ([\d.]+) MiB"),
+    "images/s": re.compile(r"([\d.]+) images/s"),
+    "tokens/s": re.compile(r"([\d.]+) tokens/s"),
+    "peak cuda": re.compile(r"peak memory ([\d.]+) GiB"),
+    "peak rss": re.compile(r"peak rss ([\d.]+) GiB"),
+}
+
+
+def run_mode(model_path: str, image_folder: str, mode: str) -> dict:
+    workdir = tempfile.mkdtemp()
+    config = {
+        "tagger": {
+            "model_path": model_path,
+            "image_folder": image_folder,
+            "output_folder": os.path.join(workdir, "output"),
+            "batch_size": 4,
+            "overwrite": True,
+            "filter_format": ["png", "jpg", "jpeg", "webp"],
+            **MODES[mode],
+        }
+    }
+    with open(os.path.join(workdir, "config.yml"), "w") as f:
+        yaml.safe_dump(config, f)
+
+    proc = subprocess.run(
+        [sys.executable, os.path.join(ROOT, "tagger.py")],
+        cwd=workdir,
+        capture_output=True,
+        text=True,
+        env={**os.environ, "PYTHONPATH": ROOT},
+    )
+    if proc.returncode != 0:
+        return {"error": proc.stderr.strip().splitlines()[-1]}
+
+    with open(os.path.join(workdir, "tagger.log"), encoding="utf-8") as f:
+        log = f.read()
+    result = {}
+    for name, pattern in PATTERNS.items():
+        values = [float(v) for v in pattern.findall(log)]
+        if values:
+            # 多卡时峰值显存取各卡之和
+            result[name] = sum(values) if name == "peak cuda" else values[-1]
+    return result
+
+
+def main(model_path: str, image_folder: str, modes):
+    model_path = os.path.abspath(model_path)
+    image_folder = os.path.abspath(image_folder)
+    print(
+        f"{'mode':<10} {'footprint':>12} {'images/s':>10} {'tokens/s':>10} "
+        f"{'peak cuda':>10} {'peak rss':>10}"
+    )
+    for mode in modes:
+        result = run_mode(model_path, image_folder, mode)
+        if "error" in result:
+            print(f"{mode:<10} failed: {result['error']}")
+            continue
+        print(
+            f"{mode:<10} {result.get('footprint', 0):9.1f} MiB "
+            f"{result.get('images/s', 0):10.2f} {result.get('tokens/s', 0):10.1f} "
+            f"{result.get('peak cuda', 0):6.2f} GiB {result.get('peak rss', 0):6.2f} GiB"
+        )
+
+
+if __name__ == "__main__":
+    main(sys.argv[1], sys.argv[2], sys.argv[3:] or list(MODES))
@@ -0,0 +1,133 @@
+# coding=utf-8
+"""
+随机初始化的极小 Qwen2-VL (2 层, hidden 64) 和小数据集, 用于在 CPU 上检查打标器和多进程启动器
+输出没有意义, 只比较不同调度方式的输出是否一致; 需要 torch、transformers、tokenizers
+
+python benchmarks/tiny_qwen.py <model_folder> [dataset_folder] [count]
+"""
+import os
+import random
+import sys
+from typing import Dict
+
+from PIL import Image
+
+SPECIALS = [
+    "<|endoftext|>",
+    "<|im_start|>",
+    "<|im_end|>",
+    "<|vision_start|>",
+    "<|vision_end|>",
+    "<|image_pad|>",
+    "<|video_pad|>",
+]
+
+CHAT_TEMPLATE = (
+    "{% for m in messages %}<|im_start|>{{ m['role'] }}\n"
+    "{% for c in m['content'] %}{% if c['type'] == 'image' %}<|vision_start|><|image_pad|><|vision_end|>"
+    "{% else %}{{ c['text'] }}{% endif %}{% endfor %}<|im_end|>\n{% endfor %}"
+    "{% if add_generation_prompt %}<|im_start|>assistant\n{% endif %}"
+)
+
+TAGS = ["1girl", "solo", "long hair", "smile", "white background", "looking at viewer"]
+
+
+def build_model(folder: str):
+    """在 folder 保存模型和 processor, 固定随机种子, 每次生成的权重相同"""
+    import torch
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+    from transformers import (
+        Qwen2TokenizerFast,
+        Qwen2VLConfig,
+        Qwen2VLForConditionalGeneration,
+        Qwen2VLImageProcessor,
+        Qwen2VLProcessor,
+    )
+
+    tokenizer = Tokenizer(models.BPE(unk_token=None))
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(
+        vocab_size=600,
+        special_tokens=SPECIALS,
+        initial_alphabet=pre_tokenizers.ByteLevel.alphabet(),
+    )
+    corpus = [", ".join(TAGS)] * 50 + ["user assistant system the a picture of"] * 50
+    tokenizer.train_from_iterator(corpus, trainer)
+    tokenizer = Qwen2TokenizerFast(
+        tokenizer_object=tokenizer,
+        eos_token="<|im_end|>",
+        pad_token="<|endoftext|>",
+        additional_special_tokens=SPECIALS[1:],
+    )
+    tokenizer.chat_template = CHAT_TEMPLATE
+    processor = Qwen2VLProcessor(
+        image_processor=Qwen2VLImageProcessor(), tokenizer=tokenizer, chat_template=CHAT_TEMPLATE
+    )
+    processor.save_pretrained(folder)
+
+    ids = {token: tokenizer.convert_tokens_to_ids(token) for token in SPECIALS}
+    config = Qwen2VLConfig(
+        vocab_size=len(tokenizer),
+        hidden_size=64,
+        intermediate_size=128,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        rope_scaling={"type": "mrope", "mrope_section": [2, 3, 3]},
+        max_position_embeddings=4096,
+        vision_config=dict(
+            depth=2,
+            embed_dim=32,
+            hidden_size=64,
+            num_heads=4,
+            mlp_ratio=2,
+            patch_size=14,
+            spatial_merge_size=2,
+            temporal_patch_size=2,
+            in_channels=3,
+        ),
+        image_token_id=ids["<|image_pad|>"],
+        video_token_id=ids["<|video_pad|>"],
+        vision_start_token_id=ids["<|vision_start|>"],
+        vision_end_token_id=ids["<|vision_end|>"],
+        eos_token_id=ids["<|im_end|>"],
+        pad_token_id=ids["<|endoftext|>"],
+        bos_token_id=ids["<|endoftext|>"],
+        tie_word_embeddings=False,
+    )
+    torch.manual_seed(0)
+    model = Qwen2VLForConditionalGeneration(config)
+    model.generation_config.eos_token_id = ids["<|im_end|>"]
+    model.save_pretrained(folder)
+
+
+def make_dataset(folder: str, count: int = 7):
+    """folder/<作者>/<i>.png 和已有标签 <i>.txt, 图片尺寸不同, 组批时提示词长度不同"""
+    rng = random.Random(0)
+    for i in range(count):
+        artist = os.path.join(folder, "ab"[i % 2])
+        os.makedirs(artist, exist_ok=True)
+        size = (rng.randrange(100, 400, 28), rng.randrange(100, 400, 28))
+        image = Image.new("RGB", size, tuple(rng.randrange(256) for _ in range(3)))
+        image.save(os.path.join(artist, f"{i}.png"))
+        with open(os.path.join(artist, f"{i}.txt"), "w", encoding="utf-8") as f:
+            f.write(", ".join(rng.sample(TAGS, rng.randint(1, 4))))
+
+
+def read_outputs(folder: str) -> Dict[str, str]:
+    """输出文件夹下所有 txt, 相对路径 -> 内容"""
+    outputs = {}
+    for root, _, files in os.walk(folder):
+        for name in files:
+            if name.endswith(".txt"):
+                path = os.path.join(root, name)
+                with open(path, encoding="utf-8") as f:
+                    outputs[os.path.relpath(path, folder)] = f.read()
+    return outputs
+
+
+if __name__ == "__main__":
+    build_model(sys.argv[1])
+    if len(sys.argv) > 2:
+        make_dataset(sys.argv[2], int(sys.argv[3]) if len(sys.argv) > 3 else 7)
@@ -1,11 +1,20 @@
 import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import List, Tuple
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
+import numpy as np
 import yaml
-from ultralytics import YOLO
 from PIL import Image
 import logging
 
+import dataset_index
+import metrics
+import writer
+from config import LazyConfig, setup_logging
+from dataset_index import DatasetItem
+from detection_cache import Detection, DetectionCache
+
 
 class BBoxConfig:
 
@@ -22,64 +31,211 @@ class BBoxConfig:
             self.nlp_out = conf["nlp_out"]
             self.tag_out = conf["tag_out"]
             self.filter_format = tuple(conf["filter_format"])
-
-            Path(self.nlp_out).mkdir(parents=True, exist_ok=True)
+            self.batch_size = conf.get("batch_size", 16)  # 每次检测的图片数
+            self.imgsz = conf.get("imgsz", 640)  # 检测输入尺寸
+            self.loader_workers = conf.get("loader_workers", 4)  # 解码线程数
+            self.device = conf.get("device", None)  # 如 cuda:0 / cpu, null 自动选择
+            # 所有人物框保存到 npz, 用于之后裁剪, null 不保存
+            self.boxes_out = conf.get("boxes_out", None)
+            # 检测结果缓存, 按图片内容和模型设置保存, 重新运行时只检测新增或修改的图片, null 不缓存
+            self.cache = conf.get("cache", "./data/detections.db")
+            self.keep_nlp = conf.get("keep_nlp", False)  # 自然语言打标结果另外保存到 nlp_out
+
+            if self.keep_nlp:
+                Path(self.nlp_out).mkdir(parents=True, exist_ok=True)
             Path(self.tag_out).mkdir(parents=True, exist_ok=True)
 
     def __str__(self):
         return f"{self.__class__.__name__}:{self.__dict__}"
 
 
-logging.basicConfig(
-    level=logging.INFO,
-    filename="run.log",
-    filemode="a",
-    format="%(asctime)s - %(pathname)s[line:%(lineno)d] - %(levelname)s: %(message)s",
-)
-
-_CONFIG = BBoxConfig()
+_CONFIG = LazyConfig(BBoxConfig)
 
 
 class PersonDetector:
 
     def __init__(self):
-        self.YOLO = YOLO(_CONFIG.model_path)  # 加载检测模型
+        from ultralytics import YOLO  # 导入时加载 torch, 只在创建检测器时导入
 
-    def detect_person_bbox(
-        self, image_path: str
-    ) -> Tuple[int, int, int, int]:  # x1, y1, x2, y2
+        self.YOLO = YOLO(_CONFIG.model_path)  # 加载检测模型
+        self.exported = {"paths": [], "sizes": [], "counts": [], "boxes": [], "conf": []}
+        self.cache: Optional[DetectionCache] = None
+        if _CONFIG.cache is not None:
+            self.cache = DetectionCache(
+                _CONFIG.cache, f"{_CONFIG.model_path}|{_CONFIG.imgsz}"
+            )
+
+    @metrics.timed("bbox.decode")
+    def load_image(
+        self, image_path: str, image: Optional[Callable[[], Image.Image]] = None
+    ) -> Tuple[Optional[str], Optional[Detection], Optional[Image.Image]]:
         """
-        使用 BBOX 模型检测画面中人物，返回最主要人物的边界框
+        在加载线程中执行, 返回 (内容sha1, 缓存的检测结果, 解码的图片)
+        有缓存时不解码图片, 解码完成后立即关闭文件
+        image: 返回解码后的图片, 流水线中与其他阶段共用, 有缓存时不调用
+        """
+        key = None
+        if self.cache is not None:
+            key = self.cache.hash_for(image_path)
+            cached = self.cache.get(key)
+            if cached is not None:
+                return key, cached, None
+        if image is not None:
+            return key, None, image().convert("RGB")
+        with Image.open(image_path) as img:
+            return key, None, img.convert("RGB")
+
+    def load_batches(
+        self, items: Iterable[DatasetItem]
+    ) -> Iterator[Tuple[List[DatasetItem], list]]:
+        """多线程加载, 按 batch_size 返回 (图片, load_image 的结果), 提前加载下一批"""
+        pending = deque()
+
+        def submit(batch_items: List[DatasetItem]):
+            futures = [loader.submit(self.load_image, item.image) for item in batch_items]
+            pending.append((batch_items, futures))
+
+        def take():
+            batch_items, futures = pending.popleft()
+            loaded_items, loaded = [], []
+            for item, future in zip(batch_items, futures):
+                try:
+                    loaded.append(future.result())
+                    loaded_items.append(item)
+                except Exception as e:
+                    logging.error(f"load image failed: {item.image} {repr(e)}")
+            return loaded_items, loaded
+
+        with ThreadPoolExecutor(_CONFIG.loader_workers) as loader:
+            batch_items = []
+            for item in items:
+                batch_items.append(item)
+                if len(batch_items) < _CONFIG.batch_size:
+                    continue
+                submit(batch_items)
+                batch_items = []
+                if len(pending) > 1:
+                    yield take()
+
+            if batch_items:
+                submit(batch_items)
+            while pending:
+                yield take()
+
+    @metrics.timed("bbox.detect")
+    def detect_batch(self, images: List[Image.Image]) -> list:
+        """一次检测多张图片, 返回每张图片的检测结果"""
+        kwargs = {"imgsz": _CONFIG.imgsz, "verbose": False}
+        if _CONFIG.device is not None:
+            kwargs["device"] = _CONFIG.device
+        return self.YOLO(images, **kwargs)
+
+    def person_boxes(
+        self, results: list
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        一批检测结果中的所有人物框
+        返回 (每张图片的人物数 (B,), 人物框 xyxy (M, 4), 置信度 (M,)), 人物框按图片顺序排列
+        """
+        counts = [len(result.boxes) for result in results]
+        if sum(counts) == 0:
+            return (
+                np.zeros(len(results), np.int64),
+                np.zeros((0, 4), np.float32),
+                np.zeros(0, np.float32),
+            )
+
+        import torch
+
+        xyxy = torch.cat([result.boxes.xyxy for result in results]).cpu().numpy()
+        cls = torch.cat([result.boxes.cls for result in results]).cpu().numpy()
+        conf = torch.cat([result.boxes.conf for result in results]).cpu().numpy()
+        image = np.repeat(np.arange(len(results)), counts)
+        # 'person' 类别
+        person = cls == 0
+        return (
+            np.bincount(image[person], minlength=len(results)),
+            xyxy[person].astype(np.float32),
+            conf[person].astype(np.float32),
+        )
+
+    def detections(self, results: list) -> List[Detection]:
+        """每张图片的 (宽高, 人物框, 置信度), 原图尺寸使用检测结果中的 orig_shape (h, w)"""
+        counts, boxes, conf = self.person_boxes(results)
+        split = np.cumsum(counts)[:-1]
+        return [
+            ((result.orig_shape[1], result.orig_shape[0]), image_boxes, image_conf)
+            for result, image_boxes, image_conf in zip(
+                results, np.split(boxes, split), np.split(conf, split)
+            )
+        ]
+
+    def main_person(self, counts: np.ndarray, boxes: np.ndarray) -> np.ndarray:
+        """
+        每张图片面积最大的人物框 (B, 4), 坐标取整; 没有人物的图片为 0
         # TODO: 没检测到人物
         """
-        logging.info(f"Trying detecting {image_path}")
-        results = self.YOLO(image_path)
-        # 过滤出 'person' 类别
-        persons = [r for r in results[0].boxes if int(r.cls) == 0]
-        if not persons:
-            logging.error(f"No person detected in {image_path}")
-            return
-
-        # 取最大 bbox
-        box = max(persons, key=lambda b: b.xyxy[0][2] * b.xyxy[0][3])
-        x1, y1, x2, y2 = map(int, box.xyxy[0])
-
-        logging.info(f"Person detected in {image_path}, {[x1, y1, x2, y2]}")
-        return x1, y1, x2, y2
-
-    def compute_grid_cell(
-        self, image_size: Tuple[int, int], bbox: Tuple[int, int, int, int]
-    ) -> str:
+        image = np.repeat(np.arange(len(counts)), counts)
+        area = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+        # 按图片排序, 同一图片内面积从大到小
+        order = np.lexsort((-area, image))
+        _, first = np.unique(image[order], return_index=True)
+        main = np.zeros((len(counts), 4), np.int64)
+        main[image[order][first]] = boxes[order][first].astype(np.int64)
+        return main
+
+    def compute_grid_cells(self, sizes: np.ndarray, bboxes: np.ndarray) -> List[str]:
         """
         将图像分为 3x3 网格，根据 bbox 中心点返回格子标签（A1~C3）
+        sizes: (B, 2) 宽高, bboxes: (B, 4) x1, y1, x2, y2
+        """
+        w, h = sizes[:, 0], sizes[:, 1]
+        cx = (bboxes[:, 0] + bboxes[:, 2]) // 2
+        cy = (bboxes[:, 1] + bboxes[:, 3]) // 2
+        col = np.minimum(cx * 3 // w + 1, 3)
+        row = np.minimum(cy * 3 // h, 2)
+        return [f"{'ABC'[r]}{c}" for r, c in zip(row.tolist(), col.tolist())]
+
+    def export_boxes(
+        self,
+        batch_items: List[DatasetItem],
+        sizes: np.ndarray,
+        counts: np.ndarray,
+        boxes: np.ndarray,
+        conf: np.ndarray,
+    ):
+        """记录所有人物框, 结束时保存到 boxes_out"""
+        root = os.path.abspath(_CONFIG.image_folder)
+        self.exported["paths"] += [
+            os.path.relpath(item.image, root) for item in batch_items
+        ]
+        self.exported["sizes"].append(sizes)
+        self.exported["counts"].append(counts)
+        self.exported["boxes"].append(boxes)
+        self.exported["conf"].append(conf)
+
+    def save_boxes(self):
         """
-        w, h = image_size
-        x1, y1, x2, y2 = bbox
-        cx, cy = (x1 + x2) // 2, (y1 + y2) // 2
-        col = min(cx * 3 // w + 1, 3)
-        row = min(cy * 3 // h, 2)
-        row_label = ["A", "B", "C"][row]
-        return f"{row_label}{col}"
+        保存为 npz: paths (N,) 相对 image_folder 的路径, sizes (N, 2) 宽高,
+        offsets (N+1,) 第 i 张图片的人物框为 boxes[offsets[i]:offsets[i+1]], boxes (M, 4) xyxy, conf (M,)
+        """
+        def concat(name: str, empty: np.ndarray) -> np.ndarray:
+            parts = self.exported[name]
+            return np.concatenate(parts) if parts else empty
+
+        counts = concat("counts", np.zeros(0, np.int64))
+        Path(_CONFIG.boxes_out).parent.mkdir(parents=True, exist_ok=True)
+        np.savez(
+            _CONFIG.boxes_out,
+            paths=np.array(self.exported["paths"], dtype=str),
+            sizes=concat("sizes", np.zeros((0, 2), np.int64)).astype(np.int32),
+            offsets=np.concatenate([[0], np.cumsum(counts)]).astype(np.int64),
+            boxes=concat("boxes", np.zeros((0, 4), np.float32)),
+            conf=concat("conf", np.zeros(0, np.float32)),
+        )
+        logging.info(
+            f"saved {int(counts.sum())} person boxes of {len(counts)} images to {_CONFIG.boxes_out}"
+        )
 
     # 第二步：读取已有 txt，并调用自然语言打标器 -->
     def call_nlp_tagger(self, image_path: str, txt_path: str) -> str:
@@ -113,58 +269,92 @@ class PersonDetector:
 
     # 第四步：输出最终 txt 并清理原始 -->
     def write_final_tags(self, out_path: str, tags: List[str]):
-        with open(out_path, "w", encoding="utf-8") as f:
-            f.write(",".join(tags))
+        writer.write(out_path, ",".join(tags))
 
     def recursive_search(self, path: str):
-        """递归搜索文件夹里的图片"""
-        for file_path in os.listdir(path):
-            file_path = os.path.join(path, file_path)
-
-            if os.path.isdir(file_path):
-                self.recursive_search(file_path)
-
-            if os.path.isfile(file_path) and file_path.lower().endswith(
-                _CONFIG.filter_format
-            ):
-                self.detect_img(file_path)
-
-    def detect_img(self, file_path: str):
-        base = os.path.splitext(file_path)[0]
+        """递归搜索文件夹里的图片, 按批次检测"""
+        items = dataset_index.scan(path, _CONFIG.filter_format)
+        for batch_items, loaded in self.load_batches(items):
+            if loaded:
+                metrics.step()
+                self.process_batch(batch_items, loaded)
+
+    def process_batch(self, batch_items: List[DatasetItem], loaded: list):
+        """检测没有缓存的图片, 选出主体人物并写出标签"""
+        detections = [cached for _, cached, _ in loaded]
+        fresh = [i for i, detection in enumerate(detections) if detection is None]
+        metrics.count("bbox.images", len(batch_items))
+        metrics.count("bbox.cache_hits", len(batch_items) - len(fresh))
+        if fresh:
+            logging.info(f"Trying detecting {len(fresh)} images")
+            try:
+                results = self.detect_batch([loaded[i][2] for i in fresh])
+            except Exception as e:
+                logging.error(
+                    f"batch detect failed: {[batch_items[i].image for i in fresh]} {repr(e)}"
+                )
+                return
+            for i, detection in zip(fresh, self.detections(results)):
+                detections[i] = detection
+            if self.cache is not None:
+                self.cache.put((loaded[i][0], detections[i]) for i in fresh)
+
+        sizes = np.array([size for size, _, _ in detections], np.int64)
+        counts = np.array([len(boxes) for _, boxes, _ in detections], np.int64)
+        boxes = np.concatenate([boxes for _, boxes, _ in detections])
+        conf = np.concatenate([conf for _, _, conf in detections])
+        main = self.main_person(counts, boxes)
+        cells = self.compute_grid_cells(sizes, main)
+        if _CONFIG.boxes_out is not None:
+            self.export_boxes(batch_items, sizes, counts, boxes, conf)
+
+        for i, item in enumerate(batch_items):
+            if counts[i] == 0:
+                logging.error(f"No person detected in {item.image}")
+                continue
+            logging.info(f"Person detected in {item.image}, {main[i].tolist()}")
+            self.detect_img(item.image, cells[i])
+
+    @metrics.timed("bbox.write")
+    def detect_img(self, file_path: str, pos: str):
+        # 相对 image_folder 的路径, 输出保持同样的目录结构
+        base = os.path.relpath(
+            os.path.splitext(file_path)[0], os.path.abspath(_CONFIG.image_folder)
+        )
         img_path = file_path
         txt_src = os.path.join(_CONFIG.txt_folder, f"{base}.txt")
 
-        # 人物检测 & 网格位置
-        bbox = pd.detect_person_bbox(img_path)
-        if bbox is None:
-            return
-
-        img = Image.open(img_path)
-        pos = pd.compute_grid_cell(img.size, bbox)
-
         logging.info(f"Person pos: {pos} in {img_path}")
 
-        # 自然语言打标 -->
-        nlp_tags = pd.call_nlp_tagger(img_path, txt_src)
-        with open(
-            os.path.join(_CONFIG.nlp_out, f"{base}.txt"), "w", encoding="utf-8"
-        ) as f:
-            f.write(nlp_tags)
+        # 自然语言打标, 结果保存在内存中, keep_nlp 时另外写入 nlp_out -->
+        nlp_tags = self.call_nlp_tagger(img_path, txt_src)
+        if _CONFIG.keep_nlp:
+            writer.write(os.path.join(_CONFIG.nlp_out, f"{base}.txt"), nlp_tags)
 
         # Danbooru 打标 & 去重 & 排序 -->
-        tags = pd.call_danbooru_tagger(img_path, nlp_tags)
-        tags = pd.fetch_and_sort_tags(tags)
+        tags = self.call_danbooru_tagger(img_path, nlp_tags)
+        tags = self.fetch_and_sort_tags(tags)
         # 添加位置标签到最前
         tags.insert(0, pos)
 
-        # 输出最终标签并删除中间文件 -->
-        pd.write_final_tags(os.path.join(_CONFIG.tag_out, f"{base}.txt"), tags)
-        os.remove(os.path.join(_CONFIG.nlp_out, f"{base}.txt"))
+        # 输出最终标签 -->
+        self.write_final_tags(os.path.join(_CONFIG.tag_out, f"{base}.txt"), tags)
+
+    def close(self):
+        """保存人物框, 关闭检测结果缓存"""
+        if _CONFIG.boxes_out is not None:
+            self.save_boxes()
+        if self.cache is not None:
+            self.cache.close()
 
     def run(self):
         self.recursive_search(os.path.abspath(_CONFIG.image_folder))
+        self.close()
+        writer.shutdown()  # 写完剩余的标签
 
 
 if __name__ == "__main__":
+    setup_logging("run.log")
+    metrics.start("bbox")
     pd = PersonDetector()
     pd.run()
@@ -0,0 +1,63 @@
+# coding=utf-8
+import hashlib
+import os
+import shutil
+from typing import Iterator, Set, Tuple
+
+
+class ClaimDir:
+    """
+    多进程打标时的任务认领, 每张图片一个锁文件
+    O_CREAT|O_EXCL 创建文件是原子的, 同一张图片只有一个进程能认领成功
+    """
+
+    def __init__(self, path: str, owner: str = ""):
+        self.path = os.path.abspath(path)
+        self.owner = owner
+        self.owned: Set[str] = set()
+
+    def lock_path(self, image: str) -> str:
+        key = hashlib.sha1(os.path.abspath(image).encode("utf-8")).hexdigest()
+        return os.path.join(self.path, key[:2], key + ".lock")
+
+    def claim(self, image: str) -> bool:
+        """认领成功或已经是自己认领的返回 True"""
+        if image in self.owned:
+            return True
+        path = self.lock_path(image)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(f"{self.owner}\t{os.path.abspath(image)}\n")
+        self.owned.add(image)
+        return True
+
+    def release(self, image: str):
+        self.owned.discard(image)
+        try:
+            os.remove(self.lock_path(image))
+        except FileNotFoundError:
+            pass
+
+    def entries(self) -> Iterator[Tuple[str, str]]:
+        """所有认领记录 (owner, 图片路径)"""
+        if not os.path.isdir(self.path):
+            return
+        for sub in os.scandir(self.path):
+            if not sub.is_dir():
+                continue
+            for entry in os.scandir(sub.path):
+                try:
+                    with open(entry.path, encoding="utf-8") as f:
+                        owner, image = f.read().rstrip("\n").split("\t", 1)
+                except (OSError, ValueError):
+                    continue
+                yield owner, image
+
+    def clear(self):
+        """删除所有认领, 开始新一轮打标前调用"""
+        shutil.rmtree(self.path, ignore_errors=True)
+        self.owned.clear()
@@ -1,8 +1,24 @@
-from safetensors.torch import load_file, save_file
+import hashlib
+import json
+import mmap
+import struct
+import sys
 import yaml
 from pathlib import Path
 import logging
 import os
+from typing import Dict, List, Tuple
+
+import metrics
+from config import LazyConfig, setup_logging
+from tensor_index import (
+    DTYPE_SIZES,
+    INDEX_FILE,
+    build_index,
+    check_coverage,
+    inspect_shards,
+    read_header,
+)
 
 
 class CombineConfig:
@@ -16,44 +32,211 @@ class CombineConfig:
             conf = conf.get("combine")
             self.model_folder = conf["model_folder"]
             self.output_file = conf["output_file"]
+            self.verify = conf.get("verify", False)  # 合并后校验每个张量的sha256
+            self.chunk_size = conf.get("chunk_size", 16)  # 每次复制的大小(MB)
+            self.header_workers = conf.get("header_workers", 8)  # 并行读取分片头的线程数
+            # 张量索引, 不合并也能按需 mmap 单个张量
+            self.index_file = conf.get(
+                "index_file", os.path.join(self.model_folder, "tensors.index.json")
+            )
 
-            Path(self.output_file).mkdir(parents=True, exist_ok=True)
+            Path(self.output_file).parent.mkdir(parents=True, exist_ok=True)
 
     def __str__(self):
         return f"{self.__class__.__name__}:{self.__dict__}"
 
 
-logging.basicConfig(
-    level=logging.INFO,
-    filename="combine.log",
-    filemode="a",
-    format="%(asctime)s - %(pathname)s[line:%(lineno)d] - %(levelname)s: %(message)s",
-)
+_CONFIG = LazyConfig(CombineConfig)
+
+_DTYPE_ORDER = {dtype: i for i, dtype in enumerate(DTYPE_SIZES)}
+
+
+def shard_files(base_path: str, output_file: str) -> List[str]:
+    """
+    需要合并的分片
+    有 model.safetensors.index.json 时按其中的分片顺序, 否则按文件名排序
+    """
+    index_path = os.path.join(base_path, INDEX_FILE)
+    if os.path.exists(index_path):
+        with open(index_path, "r", encoding="utf-8") as f:
+            weight_map = json.load(f)["weight_map"]
+        names = sorted(set(weight_map.values()))
+    else:
+        names = sorted(
+            file for file in os.listdir(base_path) if file.endswith(".safetensors")
+        )
 
-_CONFIG = CombineConfig()
+    output_file = os.path.abspath(output_file)
+    return [
+        os.path.join(base_path, name)
+        for name in names
+        if os.path.join(base_path, name) != output_file
+    ]
+
+
+@metrics.timed("combine.verify")
+def verify(base_path: str, shards: List[str]) -> Dict[str, Tuple[dict, int]]:
+    """
+    并行读取所有分片头, 检查数据类型/形状/偏移、截断、重复张量, 以及与 index.json 是否一致
+    有问题时全部写入日志后报错, 没有问题时返回 {分片: (header, 数据起始位置)}
+    """
+    inspected = inspect_shards(shards, _CONFIG.header_workers)
+    problems = [problem for _, _, found in inspected.values() for problem in found]
+    problems += check_coverage(
+        base_path, {shard: header for shard, (header, _, _) in inspected.items()}
+    )
+    for problem in problems:
+        logging.error(problem)
+    if problems:
+        raise ValueError(f"{len(problems)} problems found in {base_path}, see combine.log")
+
+    tensors = sum(len(header) - ("__metadata__" in header) for header, _, _ in inspected.values())
+    logging.info(f"Verified {len(shards)} shards, {tensors} tensors")
+    return {shard: (header, data_start) for shard, (header, data_start, _) in inspected.items()}
+
+
+def plan(
+    headers: Dict[str, Tuple[dict, int]]
+) -> Tuple[dict, List[Tuple[str, str, int, int]]]:
+    """
+    计算合并后的 header 和复制计划 [(张量名, 分片, 源起始位置, 长度)]
+    张量按数据类型从大到小、名称排序, 与 safetensors 保存时一致
+    """
+    metadata = {}
+    tensors: Dict[str, Tuple[str, dict, int]] = {}
+    for shard, (header, data_start) in headers.items():
+        for name, info in header.items():
+            if name == "__metadata__":
+                for key, value in (info or {}).items():
+                    metadata.setdefault(key, value)
+                continue
+            tensors[name] = (shard, info, data_start)
+
+    names = sorted(
+        tensors, key=lambda name: (-_DTYPE_ORDER[tensors[name][1]["dtype"]], name)
+    )
+    header = {"__metadata__": metadata} if metadata else {}
+    copies = []
+    offset = 0
+    for name in names:
+        shard, info, data_start = tensors[name]
+        begin, end = info["data_offsets"]
+        header[name] = {
+            "dtype": info["dtype"],
+            "shape": info["shape"],
+            "data_offsets": [offset, offset + end - begin],
+        }
+        copies.append((name, shard, data_start + begin, end - begin))
+        offset += end - begin
+    return header, copies
+
+
+def encode_header(header: dict) -> bytes:
+    """header 补空格到8字节对齐"""
+    data = json.dumps(header, separators=(",", ":")).encode("utf-8")
+    data += b" " * (-len(data) % 8)
+    return struct.pack("<Q", len(data)) + data
+
+
+def copy_range(src: mmap.mmap, begin: int, length: int, out, digest=None):
+    """按 chunk_size 从 mmap 复制字节, 不整体读入内存"""
+    view = memoryview(src)
+    chunk = _CONFIG.chunk_size << 20
+    try:
+        for start in range(begin, begin + length, chunk):
+            part = view[start : min(start + chunk, begin + length)]
+            out.write(part)
+            if digest is not None:
+                digest.update(part)
+            part.release()
+    finally:
+        view.release()
+
+
+@metrics.timed("combine.checksum")
+def verify_output(output_file: str, digests: Dict[str, str]):
+    """重新读取输出文件, 校验每个张量的sha256"""
+    header, data_start = read_header(output_file)
+    with open(output_file, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        view = memoryview(mm)
+        try:
+            for name, expected in digests.items():
+                begin, end = header[name]["data_offsets"]
+                digest = hashlib.sha256(view[data_start + begin : data_start + end])
+                if digest.hexdigest() != expected:
+                    raise ValueError(f"checksum mismatch: {name}")
+        finally:
+            view.release()
+    logging.info(f"Checksums match for {len(digests)} tensors")
 
 
 def run(model_folder: str, output_file: str):
     """
     合并模型
+    先检查所有分片, 再根据各分片的 header 计算合并后的 header, 直接从 mmap 复制张量数据
     """
     base_path = os.path.abspath(model_folder)
+    shards = shard_files(base_path, output_file)
 
-    shard_files = [
-        os.path.join(base_path, file)
-        for file in os.listdir(base_path)
-        if file.endswith(".safetensors")
-    ]
+    logging.info(f"Trying to combine {shards}")
+    header, copies = plan(verify(base_path, shards))
+
+    digests = {}
+    tmp_file = f"{output_file}.{os.getpid()}.tmp"
+    handles = {}
+    try:
+        for shard in shards:
+            f = open(shard, "rb")
+            handles[shard] = (f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+        with open(tmp_file, "wb") as out:
+            out.write(encode_header(header))
+            for name, shard, begin, length in copies:
+                metrics.step()
+                digest = hashlib.sha256() if _CONFIG.verify else None
+                with metrics.timer("combine.write"):
+                    copy_range(handles[shard][1], begin, length, out, digest)
+                metrics.count("combine.bytes", length)
+                if digest is not None:
+                    digests[name] = digest.hexdigest()
+        os.replace(tmp_file, output_file)
+    finally:
+        for f, mm in handles.values():
+            mm.close()
+            f.close()
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
 
-    logging.info(f"Trying to combine {shard_files}")
-    combined = {}
-    for f in shard_files:
-        sd = load_file(f)
-        combined.update(sd)
+    if _CONFIG.verify:
+        verify_output(output_file, digests)
     # 输出为单文件
-    save_file(combined, output_file)
-    logging.info(f"Combined model saved to {output_file}")
+    logging.info(f"Combined {len(copies)} tensors, model saved to {output_file}")
+
+
+def write_index(model_folder: str, index_file: str):
+    """检查分片后写入张量索引, 用 tensor_index.LazyTensors 读取"""
+    base_path = os.path.abspath(model_folder)
+    headers = verify(base_path, shard_files(base_path, _CONFIG.output_file))
+    Path(index_file).parent.mkdir(parents=True, exist_ok=True)
+    index = build_index(index_file, headers)
+    tmp_file = f"{index_file}.{os.getpid()}.tmp"
+    with open(tmp_file, "w", encoding="utf-8") as f:
+        json.dump(index, f, ensure_ascii=False)
+    os.replace(tmp_file, index_file)
+    logging.info(f"Indexed {len(index['tensors'])} tensors to {index_file}")
 
 
 if __name__ == "__main__":
-    run(_CONFIG.model_folder, _CONFIG.output_file)
+    setup_logging("combine.log")
+    metrics.start("combine")
+    # python combine.py [merge|verify|index], 默认合并
+    command = sys.argv[1] if len(sys.argv) > 1 else "merge"
+    if command == "merge":
+        run(_CONFIG.model_folder, _CONFIG.output_file)
+    elif command == "verify":
+        base_path = os.path.abspath(_CONFIG.model_folder)
+        verify(base_path, shard_files(base_path, _CONFIG.output_file))
+    elif command == "index":
+        write_index(_CONFIG.model_folder, _CONFIG.index_file)
+    else:
+        raise SystemExit("usage: python combine.py [merge|verify|index]")
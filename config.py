@@ -0,0 +1,43 @@
+# coding=utf-8
+import logging
+import threading
+from typing import Callable
+
+
+class LazyConfig:
+    """
+    第一次访问属性时才创建配置, 导入模块时不读取 config.yml
+    作为库导入时不需要对应的配置部分, 只在真正使用时报错
+    """
+
+    def __init__(self, factory: Callable[[], object]):
+        object.__setattr__(self, "_factory", factory)
+        object.__setattr__(self, "_config", None)
+        object.__setattr__(self, "_lock", threading.Lock())
+
+    def load(self):
+        if self._config is None:
+            with self._lock:
+                if self._config is None:
+                    object.__setattr__(self, "_config", self._factory())
+        return self._config
+
+    def __getattr__(self, name: str):
+        return getattr(self.load(), name)
+
+    def __setattr__(self, name: str, value):
+        # 启动器等在使用前覆盖配置
+        setattr(self.load(), name, value)
+
+    def __str__(self):
+        return str(self.load())
+
+
+def setup_logging(filename: str):
+    """入口脚本的日志设置, 不在导入模块时调用"""
+    logging.basicConfig(
+        level=logging.INFO,
+        filename=filename,
+        filemode="a",
+        format="%(asctime)s - %(pathname)s[line:%(lineno)d] - %(levelname)s: %(message)s",
+    )
@@ -0,0 +1,126 @@
+# coding=utf-8
+import json
+import os
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Dict, Iterator, NamedTuple, Tuple
+
+CACHE_NAME = ".dataset_index.json"
+
+
+def cache_path(root: str) -> str:
+    """
+    缓存保存在数据集文件夹旁边: <上级目录>/.<文件夹名>.dataset_index.json
+    写在数据集内会改变根文件夹的修改时间, 下次遍历时根文件夹的缓存总是失效
+    """
+    root = os.path.abspath(root)
+    return os.path.join(os.path.dirname(root), f".{os.path.basename(root)}{CACHE_NAME}")
+
+
+class DatasetItem(NamedTuple):
+    """数据集中的一张图片"""
+
+    image: str  # 图片绝对路径
+    txt: str  # 同名 txt 路径
+    has_txt: bool  # txt 是否存在
+    artist: str  # 所在文件夹名 (作者)
+    size: int  # 图片大小
+
+
+def _list_dir(root: str, rel: str, cache: Dict[str, dict]) -> Tuple[str, dict]:
+    """
+    列出文件夹内容, 修改时间与缓存一致时直接使用缓存
+    文件夹内增删文件会改变其修改时间, 原地修改文件不会
+    """
+    path = os.path.join(root, rel)
+    mtime_ns = os.stat(path).st_mtime_ns
+    cached = cache.get(rel)
+    if cached is not None and cached["mtime_ns"] == mtime_ns:
+        return rel, cached
+
+    files = {}
+    subdirs = []
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.is_dir():
+                subdirs.append(entry.name)
+            elif entry.is_file() and not entry.name.endswith(CACHE_NAME):
+                files[entry.name] = entry.stat().st_size
+    return rel, {"mtime_ns": mtime_ns, "files": files, "subdirs": sorted(subdirs)}
+
+
+def _walk(root: str, cache: Dict[str, dict], workers: int) -> Dict[str, dict]:
+    """并行遍历所有文件夹"""
+    listing = {}
+    with ThreadPoolExecutor(workers) as pool:
+        futures = {pool.submit(_list_dir, root, "", cache)}
+        while futures:
+            done, futures = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                rel, entry = future.result()
+                listing[rel] = entry
+                for name in entry["subdirs"]:
+                    futures.add(
+                        pool.submit(_list_dir, root, os.path.join(rel, name), cache)
+                    )
+    return listing
+
+
+def _load_cache(root: str) -> Dict[str, dict]:
+    try:
+        with open(cache_path(root), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_cache(root: str, listing: Dict[str, dict]):
+    """先写临时文件再重命名, 多个进程同时遍历时不会读到写了一半的文件"""
+    path = cache_path(root)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(listing, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+    except OSError:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def invalidate(root: str):
+    """删除缓存, 下次 scan 重新遍历"""
+    path = cache_path(root)
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def scan(
+    root: str,
+    formats: Tuple[str, ...],
+    workers: int = 16,
+    refresh: bool = False,
+) -> Iterator[DatasetItem]:
+    """
+    遍历数据集, 按路径顺序返回 formats 格式的图片
+    文件夹列表缓存在 cache_path(root), 只在有文件夹变化时写入
+    """
+    root = os.path.abspath(root)
+    cache = {} if refresh else _load_cache(root)
+    listing = _walk(root, cache, workers)
+    if listing != cache:
+        _save_cache(root, listing)
+
+    for rel in sorted(listing):
+        files = listing[rel]["files"]
+        folder = os.path.join(root, rel) if rel else root
+        artist = os.path.basename(folder)
+        for name in sorted(files):
+            if not name.lower().endswith(formats):
+                continue
+            txt_name = os.path.splitext(name)[0] + ".txt"
+            yield DatasetItem(
+                os.path.join(folder, name),
+                os.path.join(folder, txt_name),
+                txt_name in files,
+                artist,
+                files[name],
+            )
@@ -0,0 +1,66 @@
+# coding=utf-8
+from typing import Iterable, Optional, Tuple
+
+import numpy as np
+
+from manifest import HashedStore
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS detections (
+    hash TEXT NOT NULL,
+    model TEXT NOT NULL,
+    width INTEGER NOT NULL,
+    height INTEGER NOT NULL,
+    boxes BLOB NOT NULL,
+    conf BLOB NOT NULL,
+    PRIMARY KEY (hash, model)
+);
+"""
+
+# (宽高, 人物框 (n, 4) xyxy, 置信度 (n,))
+Detection = Tuple[Tuple[int, int], np.ndarray, np.ndarray]
+
+
+class DetectionCache(HashedStore):
+    """
+    人物检测结果缓存, 按图片内容sha1和模型设置索引, 图片未变时不再检测
+    """
+
+    def __init__(self, path: str, model: str, commit_every: int = 500):
+        super().__init__(path, _SCHEMA, commit_every)
+        self.model = model
+
+    def get(self, hash: str) -> Optional[Detection]:
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT width, height, boxes, conf FROM detections WHERE hash = ? AND model = ?",
+                (hash, self.model),
+            ).fetchone()
+        if row is None:
+            return None
+        width, height, boxes, conf = row
+        return (
+            (width, height),
+            np.frombuffer(boxes, np.float32).reshape(-1, 4),
+            np.frombuffer(conf, np.float32),
+        )
+
+    def put(self, rows: Iterable[Tuple[str, Detection]]):
+        """批量保存 (sha1, 检测结果)"""
+        with self.lock:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO detections (hash, model, width, height, boxes, conf) VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        hash,
+                        self.model,
+                        int(size[0]),
+                        int(size[1]),
+                        np.ascontiguousarray(boxes, np.float32).tobytes(),
+                        np.ascontiguousarray(conf, np.float32).tobytes(),
+                    )
+                    for hash, (size, boxes, conf) in rows
+                ],
+            )
+            self._commit()
+
@@ -0,0 +1,100 @@
+# coding=utf-8
+import os
+from typing import List, Optional
+
+import numpy as np
+
+from manifest import HashedStore
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS vectors (
+    hash TEXT PRIMARY KEY,
+    row INTEGER NOT NULL
+);
+"""
+
+
+class EmbeddingStore(HashedStore):
+    """
+    图片向量库, 按图片内容sha1索引
+    向量按行追加到 float16 文件 embeddings.f16, 读取时 memmap
+    index.db 记录 sha1 -> 行号, 以及 路径 -> (大小, 修改时间, sha1), 文件未变时不再重新计算sha1
+    """
+
+    def __init__(self, path: str, dim: int, commit_every: int = 500):
+        super().__init__(os.path.join(path, "index.db"), _SCHEMA, commit_every)
+        self.dim = dim
+        self.data_path = os.path.join(path, "embeddings.f16")
+
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'dim'").fetchone()
+        if row is None:
+            self.conn.execute("INSERT INTO meta VALUES ('dim', ?)", (str(dim),))
+            self.conn.commit()
+        elif int(row[0]) != dim:
+            raise ValueError(f"embedding dim mismatch: store {row[0]}, model {dim}")
+
+        self.rows = {
+            hash: row for hash, row in self.conn.execute("SELECT hash, row FROM vectors")
+        }
+        # 向量先写入文件再写索引, 中断时文件末尾可能有没有索引的行, 截断
+        row_bytes = dim * 2
+        count = len(self.rows)
+        if (
+            os.path.exists(self.data_path)
+            and os.path.getsize(self.data_path) > count * row_bytes
+        ):
+            os.truncate(self.data_path, count * row_bytes)
+        self.writer = open(self.data_path, "ab")
+        self.mapped: Optional[np.memmap] = None
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, hash: str) -> bool:
+        return hash in self.rows
+
+    def add(self, hashes: List[str], embeddings: np.ndarray):
+        """追加向量, 已有的跳过"""
+        with self.lock:
+            new = []
+            seen = set()
+            for i, hash in enumerate(hashes):
+                if hash not in self.rows and hash not in seen:
+                    new.append((i, hash))
+                    seen.add(hash)
+            if not new:
+                return
+            data = np.ascontiguousarray(
+                embeddings[[i for i, _ in new]], dtype=np.float16
+            )
+            self.writer.write(data.tobytes())
+            self.writer.flush()
+
+            start = len(self.rows)
+            for offset, (_, hash) in enumerate(new):
+                self.rows[hash] = start + offset
+            self.conn.executemany(
+                "INSERT INTO vectors (hash, row) VALUES (?, ?)",
+                [(hash, self.rows[hash]) for _, hash in new],
+            )
+            self._commit()
+
+    def get(self, hashes: List[str]) -> np.ndarray:
+        """按sha1读取向量 (n, dim) float16, 不存在时 KeyError"""
+        rows = [self.rows[hash] for hash in hashes]
+        with self.lock:
+            if self.mapped is None or self.mapped.shape[0] < len(self.rows):
+                self.mapped = np.memmap(
+                    self.data_path, np.float16, "r", shape=(len(self.rows), self.dim)
+                )
+            return np.array(self.mapped[rows])
+
+    def close(self):
+        with self.lock:
+            self.writer.close()
+            self.mapped = None
+        super().close()
@@ -0,0 +1,172 @@
+# coding=utf-8
+"""
+多进程打标: 每个设备启动 workers_per_device 个 NaturalTagger 进程
+图片在组批时通过锁文件认领, 没有静态切分, 先处理完的进程继续认领剩下的图片
+"""
+import logging
+import multiprocessing
+import os
+import queue
+import time
+from typing import Dict, List
+
+import yaml
+
+import dataset_index
+import metrics
+import tagger
+from claims import ClaimDir
+from config import LazyConfig, setup_logging
+
+
+class LauncherConfig:
+
+    def __init__(self):
+        with open("./config.yml", "r") as f:
+            conf = yaml.safe_load(f)
+            # 可选配置, 没有时使用默认值
+            conf = conf.get("launcher") or {}
+            # 设备列表, 如 ["cuda:0", "cuda:1"], null 时使用所有 GPU, 没有 GPU 时使用 cpu
+            self.devices = conf.get("devices", None)
+            self.workers_per_device = conf.get("workers_per_device", 1)
+            # 认领锁文件目录, 默认 <output_folder>/.claims
+            self.claim_dir = conf.get("claim_dir", None) or os.path.join(
+                tagger._CONFIG.output_folder, ".claims"
+            )
+            self.progress_interval = conf.get("progress_interval", 10)  # 进度日志间隔(秒)
+
+    def __str__(self):
+        return f"{self.__class__.__name__}:{self.__dict__}"
+
+
+_CONFIG = LazyConfig(LauncherConfig)
+
+
+def default_devices() -> List[str]:
+    import torch
+
+    if torch.cuda.is_available():
+        return [f"cuda:{i}" for i in range(torch.cuda.device_count())]
+    return ["cpu"]
+
+
+def count_candidates() -> int:
+    """需要打标的图片数, 用于计算进度"""
+    return sum(
+        1
+        for item in dataset_index.scan(
+            tagger._CONFIG.image_folder, tagger._CONFIG.filter_format
+        )
+        if tagger._CONFIG.overwrite or not os.path.exists(tagger.output_path(item))
+    )
+
+
+def _worker(rank: int, device: str, progress: multiprocessing.Queue):
+    """子进程: 在 device 上加载模型, 处理认领到的图片"""
+    setup_logging("tagger.log")
+    # 各进程分别写入指标, 端口只在主进程中启动
+    metrics.start(f"tagger-{rank}", serve=False)
+    try:
+        # 每个进程使用一个设备, 不再切分
+        tagger._CONFIG.device = device
+        tagger._CONFIG.device_map = None
+        claims = ClaimDir(_CONFIG.claim_dir, str(rank))
+        with tagger.NaturalTagger(
+            claims, lambda count: progress.put((rank, count))
+        ) as worker:
+            worker.run(tagger._CONFIG.image_folder)
+    except Exception as e:
+        logging.exception(f"worker {rank} on {device} failed: {repr(e)}")
+        raise
+    finally:
+        metrics.stop()
+        progress.put((rank, None))
+
+
+def log_progress(done: Dict[int, int], total: int, start: float):
+    elapsed = time.perf_counter() - start
+    finished = sum(done.values())
+    rate = finished / max(elapsed, 1e-6)
+    eta = (total - finished) / rate if rate > 0 else float("inf")
+    workers = ", ".join(f"{rank}: {count}" for rank, count in sorted(done.items()))
+    logging.info(
+        f"progress {finished}/{total}, {rate:.2f} images/s, eta {eta:.0f}s, workers {{{workers}}}"
+    )
+
+
+def count_unfinished(claims: ClaimDir) -> int:
+    """已认领但没有输出的图片 (进程异常退出)"""
+    index = {
+        item.image: item
+        for item in dataset_index.scan(
+            tagger._CONFIG.image_folder, tagger._CONFIG.filter_format
+        )
+    }
+    unfinished = 0
+    for owner, image in claims.entries():
+        item = index.get(image)
+        if item is None or not os.path.exists(tagger.output_path(item)):
+            unfinished += 1
+            logging.warning(f"worker {owner} did not finish {image}")
+    return unfinished
+
+
+def main():
+    devices = _CONFIG.devices or default_devices()
+    slots = [
+        device for device in devices for _ in range(_CONFIG.workers_per_device)
+    ]
+    claims = ClaimDir(_CONFIG.claim_dir)
+    claims.clear()
+
+    total = count_candidates()
+    logging.info(f"captioning {total} images with {len(slots)} workers on {devices}")
+
+    # CUDA 不能在 fork 出的子进程中初始化
+    ctx = multiprocessing.get_context("spawn")
+    progress = ctx.Queue()
+    processes = [
+        ctx.Process(target=_worker, args=(rank, device, progress), daemon=True)
+        for rank, device in enumerate(slots)
+    ]
+    for process in processes:
+        process.start()
+
+    done = {rank: 0 for rank in range(len(slots))}
+    running = set(done)
+    start = last_log = time.perf_counter()
+    while running:
+        try:
+            rank, count = progress.get(timeout=_CONFIG.progress_interval)
+            if count is None:
+                running.discard(rank)
+            else:
+                done[rank] += count
+                metrics.count("launcher.images", count)
+        except queue.Empty:
+            # 进程被杀死时不会发送结束消息
+            for rank in list(running):
+                if processes[rank].exitcode is not None:
+                    running.discard(rank)
+
+        if time.perf_counter() - last_log >= _CONFIG.progress_interval:
+            log_progress(done, total, start)
+            last_log = time.perf_counter()
+
+    for process in processes:
+        process.join()
+    log_progress(done, total, start)
+
+    failed = [rank for rank, process in enumerate(processes) if process.exitcode != 0]
+    if failed:
+        logging.error(f"workers {failed} exited abnormally")
+    unfinished = count_unfinished(claims)
+    if unfinished:
+        logging.error(f"{unfinished} images were not captioned, run again to retry")
+    claims.clear()
+
+
+if __name__ == "__main__":
+    setup_logging("tagger.log")
+    metrics.start("launcher")
+    main()
@@ -0,0 +1,117 @@
+# coding=utf-8
+import time
+from typing import Iterable, List, Optional, Set
+
+from manifest import SqliteStore
+
+# post 状态
+DONE = "done"  # 已完成
+MISSING = "missing"  # 不存在 (404/410/列表中没有), 不再重试
+FAILED = "failed"  # 解析/保存失败
+ERROR = "error"  # 网络错误/429/5xx 等临时错误
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS posts (
+    id INTEGER PRIMARY KEY,
+    status TEXT NOT NULL,
+    http_code INTEGER,
+    file_hash TEXT,
+    folder TEXT,
+    message TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS posts_status ON posts (status);
+"""
+
+
+def status_for_code(code: int) -> str:
+    """根据 http 状态码判断失败类型"""
+    if code in (404, 410):
+        return MISSING
+    if code == 429 or code >= 500:
+        return ERROR
+    return FAILED
+
+
+class CrawlLedger(SqliteStore):
+    """爬取记录, 保存每个id的状态, 用于断点续爬和失败重试"""
+
+    def __init__(self, path: str, commit_every: int = 100):
+        super().__init__(path, _SCHEMA, commit_every)
+        self.skip: Set[int] = set()
+
+    def load_skip(self, start: int, end: int):
+        """加载 [start, end) 中已完成/不存在的id, 之后用 should_skip O(1) 判断"""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT id FROM posts WHERE id >= ? AND id < ? AND status IN (?, ?)",
+                (start, end, DONE, MISSING),
+            )
+            self.skip = {row[0] for row in rows}
+
+    def should_skip(self, id: int) -> bool:
+        return id in self.skip
+
+    def pending_ids(self, start: int, end: int) -> Iterable[int]:
+        """[start, end) 中需要爬取的id"""
+        self.load_skip(start, end)
+        return (id for id in range(start, end) if id not in self.skip)
+
+    def retry_ids(self) -> List[int]:
+        """失败和临时错误的id"""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT id FROM posts WHERE status IN (?, ?) ORDER BY id",
+                (FAILED, ERROR),
+            )
+            ids = [row[0] for row in rows]
+        if ids:
+            self.load_skip(ids[0], ids[-1] + 1)
+        return ids
+
+    def checkpoint(self, start: int, end: int) -> int:
+        """
+        [start, end) 中第一个未完成的id, 按记录表计算
+        retry_failed 时 skip 只加载了重试的id范围, 不能用于计算
+        """
+        checkpoint = start
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT id FROM posts WHERE id >= ? AND id < ? AND status IN (?, ?) ORDER BY id",
+                (start, end, DONE, MISSING),
+            )
+            for (id,) in rows:
+                if id != checkpoint:
+                    break
+                checkpoint += 1
+        return checkpoint
+
+    def record(
+        self,
+        id: int,
+        status: str,
+        http_code: Optional[int] = None,
+        file_hash: Optional[str] = None,
+        folder: Optional[str] = None,
+        message: Optional[str] = None,
+    ):
+        now = time.time()
+        with self.lock:
+            self.conn.execute(
+                """
+                INSERT INTO posts (id, status, http_code, file_hash, folder, message, created_at, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (id) DO UPDATE SET
+                    status = excluded.status,
+                    http_code = excluded.http_code,
+                    file_hash = excluded.file_hash,
+                    folder = excluded.folder,
+                    message = excluded.message,
+                    updated_at = excluded.updated_at
+                """,
+                (id, status, http_code, file_hash, folder, message, now, now),
+            )
+            if status in (DONE, MISSING):
+                self.skip.add(id)
+            self._commit()
@@ -0,0 +1,148 @@
+# coding=utf-8
+import hashlib
+import os
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Optional
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    hash TEXT NOT NULL,
+    clean INTEGER NOT NULL
+);
+"""
+
+# HashedStore 的 路径 -> 内容sha1 缓存, 路径为绝对路径
+_FILES_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    hash TEXT NOT NULL
+);
+"""
+
+
+def content_hash(data: bytes) -> str:
+    return hashlib.sha1(data).hexdigest()
+
+
+def file_hash(path: str) -> str:
+    """文件内容sha1"""
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class SqliteStore:
+    """
+    sqlite 记录的公共部分: WAL, 多线程共用一个连接 (读写时持有 lock), 每 commit_every 次写入提交一次
+    """
+
+    def __init__(self, path: str, schema: str, commit_every: int = 500):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(schema)
+        self.lock = threading.Lock()
+        self.commit_every = commit_every
+        self.pending = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _commit(self):
+        """持有 lock 时调用"""
+        self.pending += 1
+        if self.pending >= self.commit_every:
+            self.conn.commit()
+            self.pending = 0
+
+    def close(self):
+        with self.lock:
+            self.conn.commit()
+            self.conn.close()
+
+
+class HashedStore(SqliteStore):
+    """按图片内容sha1索引的记录, files 表记录 路径 -> (大小, 修改时间, sha1), 文件未变时不再重新计算sha1"""
+
+    def __init__(self, path: str, schema: str, commit_every: int = 500):
+        super().__init__(path, schema + _FILES_SCHEMA, commit_every)
+
+    def hash_for(self, path: str) -> str:
+        """文件内容sha1, 大小和修改时间未变时使用记录的值"""
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT size, mtime_ns, hash FROM files WHERE path = ?", (path,)
+            ).fetchone()
+        if row is not None and row[0] == st.st_size and row[1] == st.st_mtime_ns:
+            return row[2]
+
+        hash = file_hash(path)
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO files (path, size, mtime_ns, hash) VALUES (?, ?, ?, ?)",
+                (path, st.st_size, st.st_mtime_ns, hash),
+            )
+            self._commit()
+        return hash
+
+
+class Manifest(SqliteStore):
+    """
+    数据集文件清单, 记录每个文件的大小、修改时间、内容sha1和是否已清洗
+    路径保存为相对 root 的路径
+    """
+
+    def __init__(self, path: str, root: str, commit_every: int = 500):
+        super().__init__(path, _SCHEMA, commit_every)
+        self.root = os.path.abspath(root)
+
+    def relpath(self, path: str) -> str:
+        return os.path.relpath(os.path.abspath(path), self.root)
+
+    def get(self, path: str) -> Optional[tuple]:
+        """(size, mtime_ns, hash, clean)"""
+        with self.lock:
+            return self.conn.execute(
+                "SELECT size, mtime_ns, hash, clean FROM files WHERE path = ?",
+                (self.relpath(path),),
+            ).fetchone()
+
+    def is_clean(self, path: str, st: os.stat_result) -> bool:
+        """大小和修改时间未变且已清洗"""
+        row = self.get(path)
+        return (
+            row is not None
+            and row[0] == st.st_size
+            and row[1] == st.st_mtime_ns
+            and bool(row[3])
+        )
+
+    def mark(self, path: str, hash: str, clean: bool = True):
+        """记录文件当前状态"""
+        st = os.stat(path)
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO files (path, size, mtime_ns, hash, clean) VALUES (?, ?, ?, ?, ?)",
+                (self.relpath(path), st.st_size, st.st_mtime_ns, hash, int(clean)),
+            )
+            self._commit()
+
+    def remove(self, path: str):
+        with self.lock:
+            self.conn.execute("DELETE FROM files WHERE path = ?", (self.relpath(path),))
+            self._commit()
@@ -0,0 +1,383 @@
+# coding=utf-8
+"""
+结构化指标: 各阶段耗时、计数、队列长度、显存, 定期以一行 JSON 追加到 metrics.file
+可选在本地端口提供 Prometheus 文本格式, --profile [N] 时采集 N 个批次的 cProfile / torch profiler
+计时和计数只在内存中累计, 没有调用 start 时不写文件也不读取配置
+"""
+import atexit
+import cProfile
+import functools
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional
+
+import yaml
+
+try:
+    import resource
+except ImportError:  # Windows 没有 resource 模块
+    resource = None
+
+
+class MetricsConfig:
+
+    def __init__(self):
+        with open("./config.yml", "r") as f:
+            conf = yaml.safe_load(f)
+            # 可选配置, 没有时使用默认值
+            conf = conf.get("metrics") or {}
+            self.file = conf.get("file")  # JSONL 输出, null 不写
+            self.interval = conf.get("interval", 10.0)  # 写入间隔(秒)
+            self.port = conf.get("port")  # Prometheus 文本格式端口, 只监听 127.0.0.1, null 不启动
+            self.profile_batches = conf.get("profile_batches", 10)  # --profile 不带数字时采集的批次数
+            self.profile_dir = conf.get("profile_dir", "./profile")  # profile 输出目录
+
+    def __str__(self):
+        return f"{self.__class__.__name__}:{self.__dict__}"
+
+
+class _Registry:
+    """所有线程共用的计时、计数和队列长度"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.timers: Dict[str, List[float]] = {}  # 名称 -> [次数, 总耗时, 最大耗时]
+        self.counters: Dict[str, float] = {}
+        self.gauges: Dict[str, Callable[[], float]] = {}
+        self.last_counters: Dict[str, float] = {}
+        self.last_time = time.time()
+
+    def observe(self, name: str, seconds: float):
+        with self.lock:
+            timer = self.timers.get(name)
+            if timer is None:
+                self.timers[name] = [1, seconds, seconds]
+            else:
+                timer[0] += 1
+                timer[1] += seconds
+                timer[2] = max(timer[2], seconds)
+
+    def count(self, name: str, value: float):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def snapshot(self, rates: bool = True) -> dict:
+        """
+        当前累计值, rates 时计数器另外给出距上次快照的每秒速率 (如 tokens/s)
+        Prometheus 端口读取时不计算速率, 不影响 JSONL 中的速率
+        """
+        now = time.time()
+        with self.lock:
+            timers = {
+                name: {"count": int(count), "total": round(total, 6), "max": round(peak, 6)}
+                for name, (count, total, peak) in self.timers.items()
+            }
+            counters = dict(self.counters)
+            gauges = dict(self.gauges)
+            per_second = {}
+            if rates:
+                elapsed = max(now - self.last_time, 1e-6)
+                per_second = {
+                    name: round((value - self.last_counters.get(name, 0)) / elapsed, 3)
+                    for name, value in counters.items()
+                }
+                self.last_counters, self.last_time = counters, now
+
+        values = {}
+        for name, read in gauges.items():
+            try:
+                values[name] = read()
+            except Exception:
+                pass
+        snapshot = {
+            "timers": timers,
+            "counters": counters,
+            "rates": per_second,
+            "gauges": values,
+            "gpu": gpu_memory(),
+        }
+        rss = max_rss()
+        if rss is not None:
+            snapshot["rss"] = rss
+        return snapshot
+
+
+_REGISTRY = _Registry()
+
+
+def observe(name: str, seconds: float):
+    """记录一次耗时, name 为 模块.阶段, 如 tagger.generate"""
+    _REGISTRY.observe(name, seconds)
+
+
+@contextmanager
+def timer(name: str):
+    """计时 with 块, 异常时也记录"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _REGISTRY.observe(name, time.perf_counter() - start)
+
+
+def timed(name: str):
+    """计时整个函数的装饰器"""
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timer(name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def count(name: str, value: float = 1):
+    _REGISTRY.count(name, value)
+
+
+def gauge(name: str, read: Callable[[], float]):
+    """登记队列长度等瞬时值, 快照时调用 read 读取, 同名覆盖"""
+    with _REGISTRY.lock:
+        _REGISTRY.gauges[name] = read
+
+
+def remove_gauge(name: str):
+    with _REGISTRY.lock:
+        _REGISTRY.gauges.pop(name, None)
+
+
+def gpu_memory() -> Dict[str, dict]:
+    """已初始化 cuda 时各设备的当前和峰值显存, 不为此导入 torch"""
+    # 其他线程正在导入 torch 时模块还没有 cuda
+    cuda = getattr(sys.modules.get("torch"), "cuda", None)
+    if cuda is None or not cuda.is_available() or not cuda.is_initialized():
+        return {}
+    return {
+        f"cuda:{i}": {
+            "allocated": cuda.memory_allocated(i),
+            "peak": cuda.max_memory_allocated(i),
+        }
+        for i in range(cuda.device_count())
+    }
+
+
+def max_rss() -> Optional[int]:
+    """进程峰值内存(字节), 没有 resource 模块 (Windows) 时为 None"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 的单位为 KiB, macOS 为字节
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def prometheus_text(snapshot: dict) -> str:
+    """Prometheus 文本格式"""
+
+    def label(value: str) -> str:
+        return value.replace("\\", "\\\\").replace('"', '\\"')
+
+    lines = ["# TYPE danbooru_stage_seconds summary"]
+    for name, timer in snapshot["timers"].items():
+        lines.append(f'danbooru_stage_seconds_sum{{stage="{label(name)}"}} {timer["total"]}')
+        lines.append(f'danbooru_stage_seconds_count{{stage="{label(name)}"}} {timer["count"]}')
+    lines.append("# TYPE danbooru_stage_seconds_max gauge")
+    for name, timer in snapshot["timers"].items():
+        lines.append(f'danbooru_stage_seconds_max{{stage="{label(name)}"}} {timer["max"]}')
+    lines.append("# TYPE danbooru_events_total counter")
+    for name, value in snapshot["counters"].items():
+        lines.append(f'danbooru_events_total{{name="{label(name)}"}} {value}')
+    lines.append("# TYPE danbooru_gauge gauge")
+    for name, value in snapshot["gauges"].items():
+        lines.append(f'danbooru_gauge{{name="{label(name)}"}} {value}')
+    lines.append("# TYPE danbooru_cuda_memory_bytes gauge")
+    for device, memory in snapshot["gpu"].items():
+        for kind, value in memory.items():
+            lines.append(f'danbooru_cuda_memory_bytes{{device="{device}",kind="{kind}"}} {value}')
+    if "rss" in snapshot:
+        lines.append("# TYPE danbooru_max_rss_bytes gauge")
+        lines.append(f"danbooru_max_rss_bytes {snapshot['rss']}")
+    return "\n".join(lines) + "\n"
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = prometheus_text(_REGISTRY.snapshot(rates=False)).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _Profiler:
+    """
+    在第一次调用 step 的线程中采集之后 batches 个批次
+    cProfile 只记录该线程; 已导入 torch 时同时用 torch profiler 记录算子和 cuda kernel
+    """
+
+    def __init__(self, component: str, batches: int, folder: str):
+        self.component = component
+        self.batches = batches
+        self.folder = folder
+        self.thread: Optional[int] = None
+        self.steps = 0
+        self.profile: Optional[cProfile.Profile] = None
+        self.torch_profile = None
+        self.lock = threading.Lock()
+
+    def step(self):
+        """每个批次开始前调用, 第一次调用时开始采集"""
+        if self.thread is None:
+            with self.lock:
+                if self.thread is not None:
+                    return
+                self.thread = threading.get_ident()
+            self._start()
+            return
+        if self.thread != threading.get_ident() or self.profile is None:
+            return
+        self.steps += 1
+        torch_profile = self.torch_profile
+        if torch_profile is not None:
+            torch_profile.step()
+        if self.steps >= self.batches:
+            self.stop()
+
+    def _start(self):
+        self.profile = cProfile.Profile()
+        torch = sys.modules.get("torch")
+        if torch is not None:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.torch_profile = torch.profiler.profile(
+                activities=activities, record_shapes=True, profile_memory=True
+            )
+            self.torch_profile.start()
+        self.profile.enable()
+        logging.info(f"profiling {self.batches} batches of {self.component}")
+
+    def stop(self):
+        """采集完成或进程退出时保存, 采集线程已结束时也可以在其他线程中调用"""
+        with self.lock:
+            profile, self.profile = self.profile, None
+            torch_profile, self.torch_profile = self.torch_profile, None
+        if profile is None:
+            return
+        profile.disable()
+        os.makedirs(self.folder, exist_ok=True)
+        prefix = os.path.join(self.folder, f"{self.component}-{os.getpid()}")
+        profile.dump_stats(f"{prefix}.prof")
+        outputs = [f"{prefix}.prof"]
+        if torch_profile is not None:
+            torch_profile.stop()
+            torch_profile.export_chrome_trace(f"{prefix}.trace.json")
+            outputs.append(f"{prefix}.trace.json")
+        logging.info(f"profiled {self.steps} batches of {self.component}: {outputs}")
+
+
+_STATE: Dict[str, object] = {}
+_STATE_LOCK = threading.Lock()
+
+
+def step():
+    """模型循环中每个批次调用一次, --profile 时控制采集的批次"""
+    profiler = _STATE.get("profiler")
+    if profiler is not None:
+        profiler.step()
+
+
+def event(kind: str, **fields):
+    """立即写入一条记录, 如每次运行的吞吐汇总"""
+    _write({"type": kind, **fields})
+
+
+def _write(record: dict):
+    record = {
+        "time": round(time.time(), 3),
+        "component": _STATE.get("component"),
+        "pid": os.getpid(),
+        **record,
+    }
+    line = json.dumps(record, ensure_ascii=False) + "\n"
+    with _STATE_LOCK:
+        file = _STATE.get("file")
+        if file is not None:
+            file.write(line)
+            file.flush()
+
+
+def _flush_loop(done: threading.Event, interval: float):
+    while not done.wait(interval):
+        _write({"type": "snapshot", **_REGISTRY.snapshot()})
+
+
+def _profile_arg() -> Optional[int]:
+    """从命令行取出 --profile [N], 不影响脚本原有的参数"""
+    if "--profile" not in sys.argv:
+        return None
+    index = sys.argv.index("--profile")
+    sys.argv.pop(index)
+    if index < len(sys.argv) and sys.argv[index].isdigit():
+        return int(sys.argv.pop(index))
+    return 0
+
+
+def start(component: str, serve: bool = True):
+    """
+    入口脚本调用: 按配置定期写入 JSONL、启动 Prometheus 端口, --profile 时准备采集
+    进程退出时写入最后一次快照
+    serve: 多进程时只在一个进程中启动端口
+    """
+    config = MetricsConfig()
+    batches = _profile_arg()
+    _STATE["component"] = component
+    if config.file is not None:
+        os.makedirs(os.path.dirname(os.path.abspath(config.file)), exist_ok=True)
+        _STATE["file"] = open(config.file, "a", encoding="utf-8")
+        done = threading.Event()
+        _STATE["done"] = done
+        threading.Thread(
+            target=_flush_loop, args=(done, config.interval), name="metrics", daemon=True
+        ).start()
+    if serve and config.port is not None:
+        server = ThreadingHTTPServer(("127.0.0.1", config.port), _Handler)
+        threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+        _STATE["server"] = server
+        logging.info(f"metrics on http://127.0.0.1:{config.port}/metrics")
+    if batches is not None:
+        _STATE["profiler"] = _Profiler(
+            component, batches or config.profile_batches, config.profile_dir
+        )
+    atexit.register(stop)
+
+
+def stop():
+    """写入最后一次快照, 结束未完成的 profile"""
+    profiler = _STATE.pop("profiler", None)
+    if profiler is not None:
+        profiler.stop()
+    if "done" in _STATE:
+        _STATE.pop("done").set()
+    if "file" in _STATE:
+        _write({"type": "snapshot", **_REGISTRY.snapshot()})
+        with _STATE_LOCK:
+            _STATE.pop("file").close()
+    if "server" in _STATE:
+        _STATE.pop("server").shutdown()
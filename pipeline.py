@@ -0,0 +1,386 @@
+# coding=utf-8
+"""
+流水线: 每张图片依次经过 读取/爬取 -> 清洗, 然后同时送入各模型阶段 (评分、打标、人物检测)
+阶段间为有界队列, 图片只读取一次, 第一个需要的模型阶段解码, 解码后的图片在各模型阶段间共用
+各阶段的设置来自 config.yml 中对应的部分, 只导入用到的阶段
+"""
+import asyncio
+import io
+import logging
+import os
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterator, List, NamedTuple, Optional
+
+import yaml
+from PIL import Image
+
+import dataset_index
+import metrics
+import writer
+from config import LazyConfig, setup_logging
+from dataset_index import DatasetItem
+
+MODEL_STAGES = ("scorer", "tagger", "bbox")
+
+
+class PipelineConfig:
+
+    def __init__(self):
+        with open("./config.yml", "r") as f:
+            conf = yaml.safe_load(f)
+            # 可选配置, 没有时使用默认值
+            conf = conf.get("pipeline") or {}
+            # spider: 处理新爬取的图片, dataset: 处理已有数据集
+            self.source = conf.get("source", "dataset")
+            self.image_folder = conf.get("image_folder", "./data/dataset")  # dataset 时的数据集
+            self.filter_format = tuple(
+                conf.get("filter_format", ["png", "jpg", "jpeg", "webp"])
+            )
+            # 启用的阶段, 模型阶段使用 scorer / tagger / bbox 中的设置
+            self.stages = conf.get("stages", ["washer", "scorer", "tagger", "bbox"])
+            self.queue_size = conf.get("queue_size", 64)  # 阶段间队列长度
+            self.io_workers = conf.get("io_workers", 8)  # 读取、清洗、解码的线程数
+            self.batch_timeout = conf.get("batch_timeout", 2.0)  # 模型阶段凑批等待时间(秒)
+
+            unknown = set(self.stages) - {"washer", *MODEL_STAGES}
+            if unknown:
+                raise ValueError(f"unknown pipeline stages: {sorted(unknown)}")
+            if self.source not in ("spider", "dataset"):
+                raise ValueError(f"unknown pipeline source: {self.source}")
+
+    def __str__(self):
+        return f"{self.__class__.__name__}:{self.__dict__}"
+
+
+_CONFIG = LazyConfig(PipelineConfig)
+
+_DONE = object()  # 队列结束标记
+
+
+class LazyImage:
+    """
+    图片文件内容, 第一次使用时解码, 各模型阶段共用解码后的图片
+    所有模型阶段都跳过 (已有输出、向量库或检测缓存命中) 的图片不解码, 队列中只保存文件内容
+    """
+
+    def __init__(self, data: bytes):
+        self.data = data
+        self.image: Optional[Image.Image] = None
+        self.lock = threading.Lock()
+
+    def get(self) -> Image.Image:
+        """解码一次, 释放文件内容"""
+        with self.lock:
+            if self.image is None:
+                with metrics.timer("pipeline.decode"):
+                    with Image.open(io.BytesIO(self.data)) as img:
+                        self.image = img.convert("RGB")
+                self.data = None
+            return self.image
+
+
+class Item(NamedTuple):
+    """流水线中的一张图片"""
+
+    item: DatasetItem
+    image: Optional[LazyImage] = None
+
+
+class Stage:
+    """
+    CPU 阶段: workers 个线程从 inbox 取图片, 处理结果放入所有下游队列
+    下游队列满时阻塞, handler 返回 None 时丢弃
+    """
+
+    def __init__(
+        self,
+        name: str,
+        handler: Callable[[Item], Optional[Item]],
+        workers: int,
+        outputs: List[queue.Queue],
+    ):
+        self.name = name
+        self.handler = handler
+        self.inbox = queue.Queue(_CONFIG.queue_size)
+        self.outputs = outputs
+        self.remaining = workers
+        self.lock = threading.Lock()
+        self.count = 0
+        metrics.gauge(f"pipeline.{name}_queue", self.inbox.qsize)
+        self.threads = [
+            threading.Thread(target=self._loop, name=f"{name}-{i}", daemon=True)
+            for i in range(workers)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def _loop(self):
+        while True:
+            entry = self.inbox.get()
+            if entry is _DONE:
+                self.inbox.put(_DONE)  # 通知同阶段的其他线程
+                self._finish()
+                return
+            try:
+                with metrics.timer(f"pipeline.{self.name}"):
+                    result = self.handler(entry)
+            except Exception as e:
+                logging.error(f"{self.name} failed: {entry.item.image} {repr(e)}")
+                continue
+            if result is None:
+                continue
+            with self.lock:
+                self.count += 1
+            metrics.count(f"pipeline.{self.name}")
+            for output in self.outputs:
+                output.put(result)
+
+    def _finish(self):
+        with self.lock:
+            self.remaining -= 1
+            if self.remaining > 0:
+                return
+        for output in self.outputs:
+            output.put(_DONE)
+
+    def join(self):
+        for thread in self.threads:
+            thread.join()
+
+
+class Inbox(queue.Queue):
+    """模型阶段的输入队列, 记录是否已读到结束标记"""
+
+    def __init__(self, maxsize: int):
+        super().__init__(maxsize)
+        self.closed = False
+
+    def drain(self):
+        """模型阶段异常退出后丢弃剩下的图片, 不阻塞上游"""
+        while not self.closed:
+            if self.get() is _DONE:
+                self.closed = True
+
+
+def batches(inbox: Inbox, batch_size: int) -> Iterator[List[Item]]:
+    """
+    从队列组批, 凑满 batch_size 或等待 batch_timeout 后没有新图片时返回不完整的批次
+    新图片陆续到达时不必等到凑满
+    """
+    batch = []
+    while True:
+        try:
+            entry = inbox.get(timeout=_CONFIG.batch_timeout if batch else None)
+        except queue.Empty:
+            yield batch
+            batch = []
+            continue
+        if entry is _DONE:
+            inbox.closed = True
+            break
+        batch.append(entry)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def run_scorer(inbox: Inbox):
+    """评分阶段, 只记录分数, 质量tag在所有模型阶段完成后写入"""
+    import scorer
+
+    count = 0
+    with scorer.WaifuScorer() as model, ThreadPoolExecutor(
+        scorer._CONFIG.loader_workers
+    ) as loader:
+        for batch in batches(inbox, scorer._CONFIG.batch_size):
+            futures = [
+                loader.submit(model.load_image, entry.item.image, entry.image.get)
+                for entry in batch
+            ]
+            batch_items, loaded = [], []
+            for entry, future in zip(batch, futures):
+                try:
+                    loaded.append(future.result())
+                    batch_items.append(entry.item)
+                except Exception as e:
+                    logging.error(f"scorer load failed: {entry.item.image} {repr(e)}")
+            if loaded:
+                count += model.score_batch(batch_items, loaded)
+    logging.info(f"scorer: scored {count} images")
+
+
+def run_tagger(inbox: Inbox):
+    """打标阶段, 跳过已有输出的图片, 预处理使用共用的解码图片"""
+    import tagger
+
+    images: Dict[str, LazyImage] = {}
+
+    def pending(size: int) -> Iterator[List[DatasetItem]]:
+        for batch in batches(inbox, size):
+            group = []
+            for entry in batch:
+                if not tagger._CONFIG.overwrite and os.path.exists(
+                    tagger.output_path(entry.item)
+                ):
+                    continue
+                images[entry.item.image] = entry.image
+                group.append(entry.item)
+            if group:
+                yield group
+
+    def image(item: DatasetItem) -> Optional[Callable[[], Image.Image]]:
+        # 预处理后不再需要图片, 立即释放
+        shared = images.pop(item.image, None)
+        return shared.get if shared is not None else None
+
+    with tagger.NaturalTagger(images=image) as model:
+        model.run_batches(pending(model.group_size()))
+
+
+def run_bbox(inbox: Inbox):
+    """人物检测阶段"""
+    import box_detect
+
+    model = box_detect.PersonDetector()
+    try:
+        for batch in batches(inbox, box_detect._CONFIG.batch_size):
+            batch_items, loaded = [], []
+            for entry in batch:
+                try:
+                    loaded.append(model.load_image(entry.item.image, entry.image.get))
+                    batch_items.append(entry.item)
+                except Exception as e:
+                    logging.error(f"bbox load failed: {entry.item.image} {repr(e)}")
+            if loaded:
+                model.process_batch(batch_items, loaded)
+    finally:
+        model.close()
+
+
+_MODEL_RUNNERS = {"scorer": run_scorer, "tagger": run_tagger, "bbox": run_bbox}
+
+
+def model_worker(name: str, inbox: Inbox):
+    """模型阶段线程, 异常时记录日志并丢弃之后的图片"""
+    try:
+        _MODEL_RUNNERS[name](inbox)
+    except Exception as e:
+        logging.exception(f"{name} stage failed: {repr(e)}")
+        inbox.drain()
+
+
+def read(entry: Item) -> Item:
+    with open(entry.item.image, "rb") as f:
+        return entry._replace(image=LazyImage(f.read()))
+
+
+def spider_item(image_path: str, file_content: bytes) -> Item:
+    folder = os.path.dirname(os.path.abspath(image_path))
+    return Item(
+        DatasetItem(
+            os.path.abspath(image_path),
+            os.path.splitext(os.path.abspath(image_path))[0] + ".txt",
+            True,
+            os.path.basename(folder),
+            len(file_content),
+        ),
+        LazyImage(file_content),
+    )
+
+
+def run():
+    stages = _CONFIG.stages
+    logging.info(f"pipeline: source {_CONFIG.source}, stages {stages}")
+
+    # 模型阶段: 每个阶段一个线程独占模型, 按自己的批大小组批
+    model_queues = [
+        (name, Inbox(_CONFIG.queue_size)) for name in MODEL_STAGES if name in stages
+    ]
+    model_threads = [
+        threading.Thread(target=model_worker, args=(name, inbox), name=name)
+        for name, inbox in model_queues
+    ]
+    for name, inbox in model_queues:
+        metrics.gauge(f"pipeline.{name}_queue", inbox.qsize)
+    for thread in model_threads:
+        thread.start()
+
+    # CPU 阶段, 从后往前创建, heads 为上一个阶段的输出队列
+    cpu_stages: List[Stage] = []
+    heads: List[queue.Queue] = [inbox for _, inbox in model_queues]
+
+    manifest = None
+    if "washer" in stages:
+        import washer
+        from manifest import Manifest
+
+        root = os.path.abspath(
+            _CONFIG.image_folder
+            if _CONFIG.source == "dataset"
+            else washer._CONFIG.location
+        )
+        manifest = Manifest(washer.manifest_path(root), root)
+
+        def wash(entry: Item) -> Item:
+            path = entry.item.image
+            if manifest.is_clean(path, os.stat(path)):
+                return entry
+            new_path, data = washer.wash_file(path, entry.image.data, manifest)
+            return entry._replace(
+                item=entry.item._replace(image=new_path), image=LazyImage(data)
+            )
+
+        cpu_stages.append(Stage("washer", wash, _CONFIG.io_workers, heads))
+        heads = [cpu_stages[-1].inbox]
+
+    start = time.perf_counter()
+    if _CONFIG.source == "dataset":
+        cpu_stages.append(Stage("read", read, _CONFIG.io_workers, heads))
+        heads = [cpu_stages[-1].inbox]
+    try:
+        if _CONFIG.source == "dataset":
+            for item in dataset_index.scan(_CONFIG.image_folder, _CONFIG.filter_format):
+                heads[0].put(Item(item))
+        else:
+            import spider
+
+            def on_saved(image_path: str, file_content: bytes):
+                for head in heads:
+                    head.put(spider_item(image_path, file_content))
+
+            with spider.get_ledger():
+                asyncio.run(spider.crawl(spider.crawl_ids(), on_saved))
+    finally:
+        # 遍历或爬取出错时也结束各阶段, 处理完已送入的图片后再抛出异常
+        for head in heads:
+            head.put(_DONE)
+        for stage in reversed(cpu_stages):
+            stage.join()
+        for thread in model_threads:
+            thread.join()
+
+    if "scorer" in stages:
+        # 打标读取 txt 中的标签, 全部完成后再写入质量tag
+        sys.modules["scorer"].apply_quality()
+
+    if "transcoder" in sys.modules:
+        sys.modules["transcoder"].shutdown()
+    if manifest is not None:
+        manifest.close()
+    writer.shutdown()  # 写完剩余的标签
+    logging.info(
+        f"pipeline done in {time.perf_counter() - start:.1f}s, "
+        f"images out of each stage: { {stage.name: stage.count for stage in reversed(cpu_stages)} }"
+    )
+
+
+if __name__ == "__main__":
+    setup_logging("pipeline.log")
+    metrics.start("pipeline")
+    run()
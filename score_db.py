@@ -0,0 +1,73 @@
+# coding=utf-8
+import time
+from typing import Iterable, List, Optional, Tuple
+
+from manifest import SqliteStore
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS scores (
+    path TEXT PRIMARY KEY,
+    txt TEXT NOT NULL,
+    hash TEXT,
+    model TEXT NOT NULL,
+    score REAL NOT NULL,
+    quality TEXT,
+    txt_mtime_ns INTEGER,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS scores_model ON scores (model);
+"""
+
+
+class ScoreDB(SqliteStore):
+    """
+    评分记录, 保存每张图片的原始分数和已写入 txt 的质量tag
+    写入质量tag时只处理分档变化或 txt 被修改过的图片
+    """
+
+    def __init__(self, path: str):
+        super().__init__(path, _SCHEMA)
+
+    def record(self, rows: Iterable[Tuple[str, str, Optional[str], str, float]]):
+        """批量记录 (图片路径, txt路径, 内容sha1, 模型, 分数)"""
+        now = time.time()
+        with self.lock:
+            self.conn.executemany(
+                """
+                INSERT INTO scores (path, txt, hash, model, score, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (path) DO UPDATE SET
+                    txt = excluded.txt,
+                    hash = excluded.hash,
+                    model = excluded.model,
+                    score = excluded.score,
+                    updated_at = excluded.updated_at
+                """,
+                [(*row, now) for row in rows],
+            )
+            self.conn.commit()
+
+    def scores(self, model: str) -> List[tuple]:
+        """model 的所有记录 (图片路径, txt路径, 分数, 已写入的质量tag, 写入后 txt 的修改时间)"""
+        with self.lock:
+            return self.conn.execute(
+                "SELECT path, txt, score, quality, txt_mtime_ns FROM scores WHERE model = ?",
+                (model,),
+            ).fetchall()
+
+    def mark_applied(self, rows: Iterable[Tuple[str, str, int]]):
+        """批量记录已写入 (图片路径, 质量tag, 写入后 txt 的修改时间)"""
+        with self.lock:
+            self.conn.executemany(
+                "UPDATE scores SET quality = ?, txt_mtime_ns = ? WHERE path = ?",
+                [(quality, mtime_ns, path) for path, quality, mtime_ns in rows],
+            )
+            self.conn.commit()
+
+    def delete(self, paths: Iterable[str]):
+        """删除图片已不存在的记录"""
+        with self.lock:
+            self.conn.executemany(
+                "DELETE FROM scores WHERE path = ?", [(path,) for path in paths]
+            )
+            self.conn.commit()
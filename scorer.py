@@ -1,9 +1,23 @@
 import os
-from waifuset import WaifuScorer as WScorer
+import sys
+import numpy as np
 from PIL import Image
 import yaml
 import logging
-from typing import List
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import TYPE_CHECKING, Callable, Iterable, Iterator, List, Optional, Tuple
+
+import dataset_index
+import metrics
+import writer
+from config import LazyConfig, setup_logging
+from dataset_index import DatasetItem
+from embedding_store import EmbeddingStore
+from score_db import ScoreDB
+
+if TYPE_CHECKING:
+    import torch
 
 
 class ScorerConfig:
@@ -19,93 +33,288 @@ class ScorerConfig:
             self.model_path = conf["model_path"]
             self.image_folder = conf["image_folder"]
             self.filter_format = tuple(conf["filter_format"])
+            self.loader_workers = conf.get("loader_workers", 4)  # 解码线程数
+            # 预处理后等待评分的图片张量最多占用的内存(MB), 与原图分辨率无关
+            self.max_memory = conf.get("max_memory", 1024)
+            # CLIP 向量库目录, 按图片内容保存向量, 重新评分时只运行评分头, null 不保存
+            self.emb_store = conf.get("emb_store", None)
+            self.score_db = conf.get("score_db", "./data/scores.db")  # 评分记录
+            self.apply_workers = conf.get("apply_workers", 8)  # 写入质量tag的线程数
+            # 质量分档, threshold: buckets 为分数下限; quantile: buckets 为分位数下限
+            quality = conf.get("quality") or {}
+            self.quality_mode = quality.get("mode", "threshold")
+            self.quality_buckets = quality.get(
+                "buckets",
+                {"masterpiece": 0.8, "best quality": 0.5, "normal quality": 0.3},
+            )
+            self.quality_default = quality.get("default", "worst quality")
 
     def __str__(self):
         return f"{self.__class__.__name__}:{self.__dict__}"
 
 
-logging.basicConfig(
-    level=logging.INFO,
-    filename="scorer.log",
-    filemode="a",
-    format="%(asctime)s - %(pathname)s[line:%(lineno)d] - %(levelname)s: %(message)s",
-)
+_CONFIG = LazyConfig(ScorerConfig)
+
 
-_CONFIG = ScorerConfig()
+def _input_size(preprocess) -> int:
+    """CLIP 预处理后的图片边长"""
+    for transform in getattr(preprocess, "transforms", []):
+        size = getattr(transform, "size", None)
+        if size is not None:
+            return size if isinstance(size, int) else max(size)
+    return 224
 
 
 class WaifuScorer:
     def __init__(self):
+        # 只有评分时才加载 torch 和 waifuset, apply 不需要
+        from waifuset import WaifuScorer as WScorer
+
         self.scorer = WScorer.from_pretrained(pretrained_model_name_or_path=_CONFIG.model_path, emb_cache_dir=None)
+        self.preprocess = self.scorer.clip_preprocessor
+        self.input_size = _input_size(self.preprocess)
+        self.store: Optional[EmbeddingStore] = None
+        if _CONFIG.emb_store is not None:
+            self.store = EmbeddingStore(
+                _CONFIG.emb_store, self.scorer.mlp_model.input_size
+            )
+        self.db = ScoreDB(_CONFIG.score_db)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.db.close()
+        if self.store is not None:
+            self.store.close()
+
+    @metrics.timed("scorer.decode")
+    def load_image(
+        self, image_path: str, image: Optional[Callable[[], Image.Image]] = None
+    ) -> Tuple[Optional[str], Optional["torch.Tensor"]]:
+        """
+        解码并预处理为 CLIP 输入张量, 在加载线程中执行, 完成后立即关闭文件
+        返回 (内容sha1, 张量), 向量库中已有时不解码, 张量为 None
+        image: 返回解码后的图片, 流水线中与其他阶段共用, 向量库中已有时不调用
+        """
+        key = None
+        if self.store is not None:
+            key = self.store.hash_for(image_path)
+            if key in self.store:
+                return key, None
+        if image is not None:
+            return key, self.preprocess(image())
+        with Image.open(image_path) as img:
+            # JPEG 直接按缩小的尺寸解码, 短边不小于输入尺寸
+            img.draft("RGB", (self.input_size, self.input_size))
+            return key, self.preprocess(img)
+
+    def stream(
+        self, items: Iterable[DatasetItem]
+    ) -> Iterator[Tuple[List[DatasetItem], list]]:
+        """
+        多线程解码, 按 batch_size 返回 (图片, load_image 的结果)
+        已提交的图片数受 max_memory 限制, 内存占用与原图分辨率无关
+        """
+        tensor_bytes = 3 * self.input_size**2 * 4
+        max_pending = max(_CONFIG.batch_size, _CONFIG.max_memory * 2**20 // tensor_bytes)
+        pending = deque()
+        metrics.gauge("scorer.pending", pending.__len__)
+        batch_items, loaded = [], []
+
+        def take():
+            item, future = pending.popleft()
+            try:
+                loaded.append(future.result())
+                batch_items.append(item)
+            except Exception as e:
+                logging.error(f"load image failed: {item.image} {repr(e)}")
+
+        with ThreadPoolExecutor(_CONFIG.loader_workers) as loader:
+            for item in items:
+                pending.append((item, loader.submit(self.load_image, item.image)))
+                while len(pending) >= max_pending or (
+                    pending and pending[0][1].done()
+                ):
+                    take()
+                    if len(loaded) == _CONFIG.batch_size:
+                        yield batch_items, loaded
+                        batch_items, loaded = [], []
+
+            while pending:
+                take()
+                if len(loaded) == _CONFIG.batch_size:
+                    yield batch_items, loaded
+                    batch_items, loaded = [], []
+            if loaded:
+                yield batch_items, loaded
+        metrics.remove_gauge("scorer.pending")
+
+    @metrics.timed("scorer.encode")
+    def encode(self, images: "torch.Tensor") -> "torch.Tensor":
+        """CLIP 图片向量, L2 归一化"""
+        import torch
+
+        clip_model = self.scorer.clip_model
+        with torch.no_grad():
+            features = clip_model.encode_image(
+                images.to(self.scorer.device, dtype=clip_model.dtype)
+            ).float()
+        norm = features.norm(dim=-1, keepdim=True)
+        norm[norm == 0] = 1
+        return (features / norm).cpu()
+
+    def get_score(
+        self, loaded: List[Tuple[Optional[str], Optional["torch.Tensor"]]]
+    ) -> List[float]:
+        # 批量评分, 向量库中已有的图片只运行评分头
+        import torch
+
+        embeddings = [None] * len(loaded)
+        missing = [i for i, (_, image) in enumerate(loaded) if image is not None]
+        if missing:
+            encoded = self.encode(torch.stack([loaded[i][1] for i in missing]))
+            if self.store is not None:
+                # 与从向量库读取的精度一致
+                encoded = encoded.half().float()
+                self.store.add([loaded[i][0] for i in missing], encoded.numpy())
+            for i, embedding in zip(missing, encoded):
+                embeddings[i] = embedding
 
-    def get_score(self, images: List[Image.Image]):
-        # 批量评分
-        return self.scorer(images)
-
-    def covert_quality(self, txt: str, score: float):
-        """根据分数修改质量tag"""
-        if score >= 0.8:
-            q_tag = "masterpiece"
-        elif 0.5 <= score < 0.8:
-            q_tag = "best quality"
-        elif 0.3 <= score < 0.5:
-            q_tag = "normal quality"
-        else:
-            q_tag = "worst quality"
-
-        tags = [
-            tag
-            for tag in txt.split(",")
-            if not tag
-            in ("masterpiece", "best quality", "normal quality", "worst quality")
-        ]
-        tags.append(q_tag)
-        return ",".join(tags)
-
-    def write_score(self, txt_path: str, score: float):
-        """智能写入评分到标签文件"""
-        content = ""
-
-        if os.path.exists(txt_path):
-            with open(txt_path, "r", encoding="utf-8") as f:
-                content = f.read().strip()
-
-        new_content = self.covert_quality(content, score)
-
-        with open(txt_path, "w", encoding="utf-8") as f:
-            f.write(new_content.strip())
-            logging.info(f"new score written in: {txt_path}")
+        cached = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        if cached:
+            vectors = self.store.get([loaded[i][0] for i in cached])
+            for i, vector in zip(cached, torch.from_numpy(vectors).float()):
+                embeddings[i] = vector
+        with torch.no_grad(), metrics.timer("scorer.score"):
+            return self.scorer.inference(torch.stack(embeddings))
 
     def run(self, path: str):
-        base_folder = os.path.abspath(path)
-        image_files = []
+        """评分并保存到评分记录, 不修改 txt"""
+        items = dataset_index.scan(path, _CONFIG.filter_format)
+        count = 0
 
-        for f_name in os.listdir(base_folder):
-            abs_path = os.path.join(base_folder, f_name)
+        for batch_items, loaded in self.stream(items):
+            metrics.step()
+            count += self.score_batch(batch_items, loaded)
+            logging.info(f"scored {count} images")
 
-            # 递归子文件夹
-            if os.path.isdir(abs_path):
-                self.run(abs_path)
-                continue
+    def score_batch(self, batch_items: List[DatasetItem], loaded: list) -> int:
+        """评分一批图片并保存到评分记录, 返回评分的图片数"""
+        try:
+            scores = self.get_score(loaded)
+        except Exception as e:
+            logging.error(f"batch score failed: {repr(e)}")
+            return 0
 
-            if f_name.lower().endswith(_CONFIG.filter_format):
-                image_files.append(abs_path)
+        with metrics.timer("scorer.write"):
+            self.db.record(
+                (item.image, item.txt, key, _CONFIG.model_path, score)
+                for item, (key, _), score in zip(batch_items, loaded, scores)
+            )
+        metrics.count("scorer.images", len(batch_items))
+        return len(batch_items)
 
-        for i in range(0, len(image_files), _CONFIG.batch_size):
-            batch_files = image_files[i : i + _CONFIG.batch_size]
-            images = [Image.open(p) for p in batch_files]
 
-            try:
-                scores = self.get_score(images)
-            except Exception as e:
-                logging.error(f"batch score failed: {repr(e)}")
+def thresholds(scores: List[float]) -> List[Tuple[str, float]]:
+    """各质量tag的分数下限, 从高到低; quantile 模式下按所有图片的分数分布计算"""
+    buckets = sorted(_CONFIG.quality_buckets.items(), key=lambda x: -x[1])
+    if _CONFIG.quality_mode == "quantile":
+        if not scores:
+            return []
+        values = np.quantile(np.asarray(scores), [q for _, q in buckets])
+        return [(tag, float(value)) for (tag, _), value in zip(buckets, values)]
+    if _CONFIG.quality_mode != "threshold":
+        raise ValueError(f"unknown quality mode: {_CONFIG.quality_mode}")
+    return buckets
+
+
+def bucket(score: float, bounds: List[Tuple[str, float]]) -> str:
+    for tag, bound in bounds:
+        if score >= bound:
+            return tag
+    return _CONFIG.quality_default
+
+
+def covert_quality(txt: str, q_tag: str) -> str:
+    """替换质量tag"""
+    quality_tags = set(_CONFIG.quality_buckets) | {_CONFIG.quality_default}
+    tags = [tag for tag in txt.split(",") if not tag in quality_tags]
+    tags.append(q_tag)
+    return ",".join(tags)
+
+
+def write_score(txt_path: str, q_tag: str) -> Future:
+    """智能写入质量tag到标签文件, 由后台线程写入"""
+    content = ""
+
+    if os.path.exists(txt_path):
+        with open(txt_path, "r", encoding="utf-8") as f:
+            content = f.read().strip()
+
+    new_content = covert_quality(content, q_tag)
+    return writer.write(txt_path, new_content.strip())
+
+
+def _txt_mtime_ns(txt_path: str) -> Optional[int]:
+    try:
+        return os.stat(txt_path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def apply_quality():
+    """
+    按评分记录写入质量tag, 只改写分档变化或写入后被修改过的 txt
+    修改分档设置后重新运行即可, 不需要重新评分
+    图片已删除 (或清洗时改名) 的记录从评分记录中删除, 不参与分位数; 没有 txt 的图片跳过, 不创建 txt
+    """
+    with ScoreDB(_CONFIG.score_db) as db:
+        rows = db.scores(_CONFIG.model_path)
+        removed = [row[0] for row in rows if not os.path.exists(row[0])]
+        if removed:
+            db.delete(removed)
+            logging.info(f"removed {len(removed)} score records of deleted images")
+            removed = set(removed)
+            rows = [row for row in rows if row[0] not in removed]
+        bounds = thresholds([row[2] for row in rows])
+        logging.info(f"quality thresholds: {bounds}, default: {_CONFIG.quality_default}")
+
+        changed = []
+        missing = 0
+        for path, txt, score, quality, txt_mtime_ns in rows:
+            if not os.path.exists(txt):
+                missing += 1
                 continue
+            q_tag = bucket(score, bounds)
+            if q_tag != quality or _txt_mtime_ns(txt) != txt_mtime_ns:
+                changed.append((path, txt, q_tag))
 
-            for score, img_path in zip(scores, batch_files):
-                txt_path = img_path.rsplit(".", 1)[0] + ".txt"
-                logging.info(f"score: {score} for {img_path}")
-                self.write_score(txt_path, score)
+        applied = []
+        with ThreadPoolExecutor(_CONFIG.apply_workers) as pool:
+            futures = [pool.submit(write_score, txt, q_tag) for _, txt, q_tag in changed]
+            for (path, txt, q_tag), future in zip(changed, futures):
+                try:
+                    future.result().result()
+                    applied.append((path, q_tag, os.stat(txt).st_mtime_ns))
+                except Exception as e:
+                    logging.error(f"write quality failed: {txt} {repr(e)}")
+        db.mark_applied(applied)
+        logging.info(
+            f"quality tags: {len(rows)} scored, {len(applied)} rewritten, "
+            f"{len(rows) - len(changed) - missing} unchanged, {missing} without txt"
+        )
 
 
 if __name__ == "__main__":
-    WaifuScorer().run(_CONFIG.image_folder)
+    setup_logging("scorer.log")
+    metrics.start("scorer")
+    # python scorer.py [score|apply], 默认评分后写入质量tag
+    command = sys.argv[1] if len(sys.argv) > 1 else "all"
+    if command not in ("score", "apply", "all"):
+        raise SystemExit("usage: python scorer.py [score|apply]")
+    if command in ("score", "all"):
+        with WaifuScorer() as scorer:
+            scorer.run(_CONFIG.image_folder)
+    if command in ("apply", "all"):
+        apply_quality()
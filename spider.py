@@ -1,17 +1,23 @@
 # coding=utf-8
 import requests
-import bs4
 import logging
 import os
-import io
-import math
-from PIL import Image
-from typing import List
+import hashlib
+import time
+import asyncio
+from concurrent.futures import Future, ThreadPoolExecutor
+from urllib.parse import urlencode, urlparse
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple
 from collections import OrderedDict
 import yaml
 from pathlib import Path
 
-from washer import remove_metadata
+import ledger
+import metrics
+import transcoder
+import writer
+from config import LazyConfig, setup_logging
+from ledger import CrawlLedger
 
 
 class SpiderConfig:
@@ -30,6 +36,19 @@ class SpiderConfig:
             self.latest_id = conf["latest_id"]
             self.max_id = conf["max_id"]
             self.target_format = conf["target_format"]
+            self.mode = conf.get("mode", "serial")  # serial / async
+            self.backend = conf.get("backend", "html")  # html / api
+            self.page_size = conf.get("page_size", 200)  # api 每页post数
+            self.concurrency = conf.get("concurrency", 16)  # 同时处理的post数
+            self.rate_limit = conf.get("rate_limit", 10)  # 每个host每秒请求数
+            self.burst = conf.get("burst", self.rate_limit)
+            self.max_retries = conf.get("max_retries", 5)  # 429/5xx 重试次数
+            self.backoff = conf.get("backoff", 1.0)  # 重试等待基数(秒)
+            self.timeout = conf.get("timeout", 30)
+            self.queue_size = conf.get("queue_size", 64)
+            self.encode_workers = conf.get("encode_workers", os.cpu_count() or 1)  # 同时编码的图片数
+            self.ledger = conf.get("ledger", "./crawl.db")  # 爬取记录数据库
+            self.retry_failed = conf.get("retry_failed", False)  # 只重试失败的id
 
             if self.max_id < self.latest_id:
                 raise ValueError("max_id must be larger than latest_id")
@@ -40,106 +59,239 @@ class SpiderConfig:
         return f"{self.__class__.__name__}:{self.__dict__}"
 
 
-logging.basicConfig(
-    level=logging.INFO,
-    filename="run.log",
-    filemode="a",
-    format="%(asctime)s - %(pathname)s[line:%(lineno)d] - %(levelname)s: %(message)s",
-)
+_CONFIG = LazyConfig(SpiderConfig)
 
-_CONFIG = SpiderConfig()
 
+class Post(NamedTuple):
+    """从post页面解析出的信息"""
 
-def has_transparency(img: Image.Image):
-    """检查图片是否有透明"""
-    if img.info.get("transparency", None) is not None:
-        return True
-    if img.mode == "P":
-        transparent = img.info.get("transparency", -1)
-        for _, index in img.getcolors():
-            if index == transparent:
-                return True
-    elif img.mode == "RGBA":
-        extrema = img.getextrema()
-        if extrema[3][0] < 255:
-            return True
+    id: int
+    link: str
+    artists: List[str]
+    tags: List[str]
 
-    return False
 
+_SESSION: Optional[requests.Session] = None
 
-def compress_img(img: Image.Image) -> Image.Image:
-    """压缩图片"""
-    res = img.width * img.height
-    if res <= _CONFIG.max_res:
-        return img
-    ratio = math.sqrt(_CONFIG.max_res / res)
-    return img.resize((int(img.width * ratio), int(img.height * ratio)))
+
+def get_session() -> requests.Session:
+    """共享的keep-alive连接池"""
+    global _SESSION
+    if _SESSION is None:
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=4, pool_maxsize=_CONFIG.concurrency * 2
+        )
+        _SESSION = requests.Session()
+        _SESSION.mount("http://", adapter)
+        _SESSION.mount("https://", adapter)
+    return _SESSION
+
+
+_LEDGER: Optional[CrawlLedger] = None
+
+
+def get_ledger() -> CrawlLedger:
+    """爬取记录"""
+    global _LEDGER
+    if _LEDGER is None:
+        _LEDGER = CrawlLedger(_CONFIG.ledger)
+    return _LEDGER
+
+
+def transcode_kwargs() -> dict:
+    return dict(
+        target_format=_CONFIG.target_format,
+        lossless=True,
+        max_res=_CONFIG.max_res,
+        flatten=True,
+    )
 
 
-def save_img(link: str, path: str):
+@metrics.timed("spider.write")
+def write_img(file_content: bytes, path: str) -> str:
+    """保存编码后的图片, 返回sha1"""
+    with open(f"{path}.{_CONFIG.target_format}", "wb") as f:
+        f.write(file_content)
+    return hashlib.sha1(file_content).hexdigest()
+
+
+def encode_img(file_content: bytes, path: str) -> str:
+    """解码、清理并保存图片, 返回保存文件的sha1"""
+    with metrics.timer("spider.encode"):
+        file_content = transcoder.transcode(file_content, **transcode_kwargs())
+    return write_img(file_content, path)
+
+
+def save_img(link: str, path: str) -> str:
     """保存图片"""
-    file_content = requests.get(link).content
-    img = Image.open(io.BytesIO(file_content))
+    with metrics.timer("spider.fetch"):
+        response = get_session().get(link, timeout=_CONFIG.timeout)
+    response.raise_for_status()
+    metrics.count("spider.bytes", len(response.content))
+    return encode_img(response.content, path)
+
+
+def save_tags(tags: List[str], path: str) -> Future:
+    """保存标签, 由后台线程写入"""
+    file_content = ",".join(tags)
+    return writer.write(path, file_content)
 
-    if has_transparency(img):
-        img = Image.alpha_composite(
-            Image.new("RGBA", img.size, "WHITE"), img.convert("RGBA")
+
+@metrics.timed("spider.parse")
+def parse_post(id: int, html: bytes) -> Post:
+    """解析post页面"""
+    import bs4
+
+    content = bs4.BeautifulSoup(html, "html.parser")
+
+    # 图片链接
+    orig_link_node = content.find("a", class_="image-view-original-link")
+    if orig_link_node:
+        img_link = orig_link_node["href"]
+    else:
+        img_link = (
+            content.find("img", id="image")["src"]
+            .replace("sample-", "")
+            .replace("/sample/", "/original/")
+        )
+
+    # 作者
+    _artist_nodes = content.find("ul", class_="artist-tag-list")
+    if _artist_nodes:
+        artists = [node.text for node in _artist_nodes.find_all(class_="search-tag")]
+    else:
+        artists = []
+    # 标签
+    tags = [
+        node.text.replace("_", " ")
+        for node in content.find(class_="tag-list categorized-tag-list").find_all(
+            class_="search-tag"
         )
+    ]
+    tags = list(OrderedDict.fromkeys(tags))  # 去重
 
-    img = remove_metadata(img)
-    img = compress_img(img)
-    img.save(f"{path}.{_CONFIG.target_format}", _CONFIG.target_format, lossless=True)
+    # 去除透明背景标签
+    if "transparent background" in tags:
+        tags[tags.index("transparent background")] = "white background"
 
+    return Post(id, img_link, artists, tags)
 
-def save_tags(tags: List[str], path: str):
-    """保存标签"""
-    file_content = ",".join(tags)
-    with open(path, "w") as f:
-        f.write(file_content)
+
+def post_folder(post: Post) -> str:
+    """post保存的文件夹"""
+    # 作者名为文件夹
+    folder_name = post.artists[0] if len(post.artists) > 0 else "unkown"
+
+    # 单人多人分文件夹
+    # if "solo" in tags:
+    #     folder_name = "single_person"
+    # else:
+    #     folder_name = "multi_person"
+
+    folder = os.path.join(_CONFIG.save_location, folder_name)
+    Path(folder).mkdir(parents=True, exist_ok=True)
+    return folder
 
 
 def run(id: int):
     try:
-        response = requests.get(f"{_CONFIG.protocal}://{_CONFIG.domain}/posts/{id}")
+        with metrics.timer("spider.fetch"):
+            response = get_session().get(
+                f"{_CONFIG.protocal}://{_CONFIG.domain}/posts/{id}", timeout=_CONFIG.timeout
+            )
     except Exception as e:
         logging.error(f"id: {id} request error: {repr(e)}.")
+        get_ledger().record(id, ledger.ERROR, message=repr(e))
         return
 
     if response.status_code != 200:
         logging.error(f"id: {id} return {response.status_code}.")
+        get_ledger().record(
+            id, ledger.status_for_code(response.status_code), response.status_code
+        )
+        return
+
+    try:
+        post = parse_post(id, response.content)
+    except Exception as e:
+        logging.error(f"id: {id} html parse error: {repr(e)}.")
+        get_ledger().record(id, ledger.FAILED, 200, message=repr(e))
         return
 
-    content = bs4.BeautifulSoup(response.content, "html.parser")
+    download_post(post)
+
+
+def download_post(post: Post):
+    """下载post的图片和标签"""
+    logging.info(
+        f"id: {post.id}, artist: {post.artists}, tags count: {len(post.tags)}, link: {post.link}."
+    )
+
+    folder = post_folder(post)
+    metrics.step()  # 每张图片为一个批次
 
     try:
-        # 图片链接
-        orig_link_node = content.find("a", class_="image-view-original-link")
-        if orig_link_node:
-            img_link = orig_link_node["href"]
-        else:
-            img_link = (
-                content.find("img", id="image")["src"]
-                .replace("sample-", "")
-                .replace("/sample/", "/original/")
-            )
+        file_hash = save_img(post.link, os.path.join(folder, f"{post.id}"))
+        # 标签写入完成后才记录完成, 写入失败与图片保存失败相同
+        save_tags(post.tags, os.path.join(folder, f"{post.id}.txt")).result()
+    except Exception as e:
+        logging.error(f"id: {post.id} save file error: {repr(e)}.")
+        record_save_error(post, e)
+        return
 
-        # 作者
-        _artist_nodes = content.find("ul", class_="artist-tag-list")
-        if _artist_nodes:
-            artists = [
-                node.text
-                for node in content.find("ul", class_="artist-tag-list").find_all(
-                    class_="search-tag"
-                )
-            ]
-        else:
-            artists = []
-        # 标签
+    logging.info(f"id: {post.id} done.")
+    metrics.count("spider.images")
+    get_ledger().record(post.id, ledger.DONE, 200, file_hash, folder)
+
+
+def record_save_error(post: Post, e: Exception):
+    """图片下载失败为临时错误, 解码/保存失败为失败"""
+    if isinstance(e, requests.HTTPError) and e.response is not None:
+        status = ledger.status_for_code(e.response.status_code)
+    elif isinstance(e, requests.RequestException):
+        status = ledger.ERROR
+    else:
+        status = ledger.FAILED
+    get_ledger().record(post.id, status, message=repr(e))
+
+
+def group_ids(ids: Iterable[int], size: int) -> Iterable[Tuple[int, int]]:
+    """把升序的id分组为长度不超过 size 的范围 [start, end)"""
+    start = last = None
+    for id in ids:
+        if start is not None and id - start >= size:
+            yield start, last + 1
+            start = None
+        if start is None:
+            start = id
+        last = id
+    if start is not None:
+        yield start, last + 1
+
+
+def listing_url(start: int, end: int) -> str:
+    """id范围 [start, end) 的 json 列表地址"""
+    query = urlencode(
+        {"tags": f"id:{start}..{end - 1} status:any", "limit": _CONFIG.page_size}
+    )
+    return f"{_CONFIG.protocal}://{_CONFIG.domain}/posts.json?{query}"
+
+
+@metrics.timed("spider.parse")
+def parse_listing(posts: List[dict]) -> List[Post]:
+    """
+    解析 json 列表, 标签顺序与 html 页面一致: 作者, 作品, 角色, 一般, meta
+    没有原图链接的post link 为 None
+    """
+    result = []
+    for item in posts:
+        artists = [
+            tag.replace("_", " ") for tag in item.get("tag_string_artist", "").split()
+        ]
         tags = [
-            node.text.replace("_", " ")
-            for node in content.find(class_="tag-list categorized-tag-list").find_all(
-                class_="search-tag"
-            )
+            tag.replace("_", " ")
+            for category in ("artist", "copyright", "character", "general", "meta")
+            for tag in item.get(f"tag_string_{category}", "").split()
         ]
         tags = list(OrderedDict.fromkeys(tags))  # 去重
 
@@ -147,36 +299,334 @@ def run(id: int):
         if "transparent background" in tags:
             tags[tags.index("transparent background")] = "white background"
 
+        result.append(Post(item["id"], item.get("file_url"), artists, tags))
+    return result
+
+
+def log_missing(start: int, end: int, posts: List[Post]):
+    """记录列表中不存在的id"""
+    found = {post.id for post in posts}
+    for id in range(start, end):
+        if id not in found and not get_ledger().should_skip(id):
+            logging.error(f"id: {id} not found in listing.")
+            get_ledger().record(id, ledger.MISSING)
+
+
+def record_range_error(start: int, end: int, status: str, code: Optional[int] = None):
+    """列表请求失败, 记录范围内所有未完成的id"""
+    for id in range(start, end):
+        if not get_ledger().should_skip(id):
+            get_ledger().record(id, status, code)
+
+
+def run_api(start: int, end: int):
+    """通过 json 列表批量爬取 [start, end), 缺少原图链接的post回退到 html"""
+    try:
+        with metrics.timer("spider.fetch"):
+            response = get_session().get(listing_url(start, end), timeout=_CONFIG.timeout)
+    except Exception as e:
+        logging.error(f"ids: {start}..{end - 1} request error: {repr(e)}.")
+        record_range_error(start, end, ledger.ERROR)
+        return
+
+    if response.status_code != 200:
+        logging.error(f"ids: {start}..{end - 1} return {response.status_code}.")
+        record_range_error(
+            start, end, ledger.status_for_code(response.status_code), response.status_code
+        )
+        return
+
+    try:
+        posts = parse_listing(response.json())
+    except Exception as e:
+        logging.error(f"ids: {start}..{end - 1} json parse error: {repr(e)}.")
+        record_range_error(start, end, ledger.FAILED, 200)
+        return
+
+    log_missing(start, end, posts)
+    posts = [post for post in posts if not get_ledger().should_skip(post.id)]
+
+    for post in sorted(posts, key=lambda p: p.id):
+        if post.link is None:
+            run(post.id)
+        else:
+            download_post(post)
+
+
+class TokenBucket:
+    """令牌桶限速"""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.capacity = max(burst, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+_BUCKETS: Dict[str, TokenBucket] = {}
+
+
+def get_bucket(url: str) -> TokenBucket:
+    """每个host一个令牌桶"""
+    host = urlparse(url).netloc
+    if host not in _BUCKETS:
+        _BUCKETS[host] = TokenBucket(_CONFIG.rate_limit, _CONFIG.burst)
+    return _BUCKETS[host]
+
+
+async def fetch(url: str) -> requests.Response:
+    """限速请求, 429/5xx 时指数退避重试"""
+    for attempt in range(_CONFIG.max_retries + 1):
+        await get_bucket(url).acquire()
+        try:
+            with metrics.timer("spider.fetch"):
+                response = await asyncio.to_thread(
+                    get_session().get, url, timeout=_CONFIG.timeout
+                )
+        except requests.RequestException:
+            if attempt == _CONFIG.max_retries:
+                raise
+            await asyncio.sleep(_CONFIG.backoff * 2**attempt)
+            continue
+
+        if response.status_code != 429 and response.status_code < 500:
+            return response
+        if attempt == _CONFIG.max_retries:
+            return response
+
+        retry_after = response.headers.get("Retry-After", "")
+        delay = (
+            float(retry_after)
+            if retry_after.isdigit()
+            else _CONFIG.backoff * 2**attempt
+        )
+        logging.warning(f"{url} return {response.status_code}, retry in {delay}s.")
+        await asyncio.sleep(delay)
+
+
+async def _worker(in_queue: asyncio.Queue, out_queue: Optional[asyncio.Queue], handler):
+    """流水线阶段: 从 in_queue 取任务, 结果放入 out_queue"""
+    while True:
+        item = await in_queue.get()
+        try:
+            result = await handler(item)
+            if result is not None and out_queue is not None:
+                for r in result if isinstance(result, list) else [result]:
+                    await out_queue.put(r)
+        except Exception as e:
+            logging.error(f"{handler.__name__} error: {repr(e)}.")
+        finally:
+            in_queue.task_done()
+
+
+async def _fetch_page(id: int) -> Optional[Post]:
+    try:
+        response = await fetch(f"{_CONFIG.protocal}://{_CONFIG.domain}/posts/{id}")
+    except Exception as e:
+        logging.error(f"id: {id} request error: {repr(e)}.")
+        get_ledger().record(id, ledger.ERROR, message=repr(e))
+        return
+
+    if response.status_code != 200:
+        logging.error(f"id: {id} return {response.status_code}.")
+        get_ledger().record(
+            id, ledger.status_for_code(response.status_code), response.status_code
+        )
+        return
+
+    try:
+        post = await asyncio.to_thread(parse_post, id, response.content)
     except Exception as e:
         logging.error(f"id: {id} html parse error: {repr(e)}.")
+        get_ledger().record(id, ledger.FAILED, 200, message=repr(e))
         return
 
     logging.info(
-        f"id: {id}, artist: {artists}, tags count: {len(tags)}, link: {img_link}."
+        f"id: {id}, artist: {post.artists}, tags count: {len(post.tags)}, link: {post.link}."
     )
+    return post
 
-    # 作者名为文件夹
-    folder_name = artists[0] if len(artists) > 0 else "unkown"
 
-    # 单人多人分文件夹
-    # if "solo" in tags:
-    #     folder_name = "single_person"
-    # else:
-    #     folder_name = "multi_person"
+async def _fetch_listing(id_range: Tuple[int, int]) -> Optional[List[Post]]:
+    start, end = id_range
+    try:
+        response = await fetch(listing_url(start, end))
+    except Exception as e:
+        logging.error(f"ids: {start}..{end - 1} request error: {repr(e)}.")
+        record_range_error(start, end, ledger.ERROR)
+        return
 
-    folder = os.path.join(_CONFIG.save_location, folder_name)
-    Path(folder).mkdir(parents=True, exist_ok=True)
+    if response.status_code != 200:
+        logging.error(f"ids: {start}..{end - 1} return {response.status_code}.")
+        record_range_error(
+            start, end, ledger.status_for_code(response.status_code), response.status_code
+        )
+        return
 
     try:
-        save_img(img_link, os.path.join(folder, f"{id}"))
-        save_tags(tags, os.path.join(folder, f"{id}.txt"))
+        posts = parse_listing(response.json())
     except Exception as e:
-        logging.error(f"id: {id} save file error: {repr(e)}.")
+        logging.error(f"ids: {start}..{end - 1} json parse error: {repr(e)}.")
+        record_range_error(start, end, ledger.FAILED, 200)
         return
 
-    logging.info(f"id: {id} done.")
+    log_missing(start, end, posts)
+    posts = [post for post in posts if not get_ledger().should_skip(post.id)]
+
+    result = []
+    for post in posts:
+        if post.link is None:
+            post = await _fetch_page(post.id)  # 回退到 html
+        else:
+            logging.info(
+                f"id: {post.id}, artist: {post.artists}, tags count: {len(post.tags)}, link: {post.link}."
+            )
+        if post is not None:
+            result.append(post)
+    return result
+
+
+async def _fetch_image(post: Post) -> Optional[Tuple[Post, bytes]]:
+    try:
+        response = await fetch(post.link)
+    except Exception as e:
+        logging.error(f"id: {post.id} image request error: {repr(e)}.")
+        get_ledger().record(post.id, ledger.ERROR, message=repr(e))
+        return
+
+    if response.status_code != 200:
+        logging.error(f"id: {post.id} image return {response.status_code}.")
+        get_ledger().record(
+            post.id, ledger.status_for_code(response.status_code), response.status_code
+        )
+        return
+    metrics.count("spider.bytes", len(response.content))
+    return post, response.content
+
+
+def _save_post(post: Post, file_content: bytes) -> Tuple[str, str, Future]:
+    folder = post_folder(post)
+    file_hash = write_img(file_content, os.path.join(folder, f"{post.id}"))
+    tags = save_tags(post.tags, os.path.join(folder, f"{post.id}.txt"))
+    return file_hash, folder, tags
+
+
+async def crawl(ids: Iterable, on_saved: Optional[Callable[[str, bytes], None]] = None):
+    """
+    并发爬取: 页面请求 -> 图片下载 -> 图片编码 三个阶段, 阶段间为有界队列
+    ids 为单个id (html) 或 id范围 (api)
+    on_saved: 图片和标签保存后以 (图片路径, 编码后的图片) 调用, 在线程中执行, 可以阻塞
+    """
+    loop = asyncio.get_running_loop()
+    _BUCKETS.clear()  # asyncio.Lock 不能跨事件循环
+    loop.set_default_executor(ThreadPoolExecutor(_CONFIG.concurrency * 2 + 4))
+
+    async def encode(item: Tuple[Post, bytes]):
+        post, file_content = item
+        metrics.step()  # 每张图片为一个批次, 只采集事件循环线程
+        try:
+            # 在转码进程池中编码, 写文件在线程中; 耗时包含在进程池中排队的时间
+            with metrics.timer("spider.encode"):
+                file_content = await asyncio.wrap_future(
+                    transcoder.submit(file_content, **transcode_kwargs())
+                )
+            file_hash, folder, tags = await asyncio.to_thread(
+                _save_post, post, file_content
+            )
+            # 标签写入完成后才记录完成, 下游也会读取标签
+            await asyncio.wrap_future(tags)
+        except Exception as e:
+            logging.error(f"id: {post.id} save file error: {repr(e)}.")
+            get_ledger().record(post.id, ledger.FAILED, 200, message=repr(e))
+            return
+        logging.info(f"id: {post.id} done.")
+        metrics.count("spider.images")
+        get_ledger().record(post.id, ledger.DONE, 200, file_hash, folder)
+
+        if on_saved is not None:
+            image_path = os.path.join(folder, f"{post.id}.{_CONFIG.target_format}")
+            await asyncio.to_thread(on_saved, image_path, file_content)
+
+    page_queue = asyncio.Queue(_CONFIG.queue_size)
+    image_queue = asyncio.Queue(_CONFIG.queue_size)
+    encode_queue = asyncio.Queue(_CONFIG.queue_size)
+    queues = {"page": page_queue, "image": image_queue, "encode": encode_queue}
+    for name, q in queues.items():
+        metrics.gauge(f"spider.{name}_queue", q.qsize)
+
+    fetch_page = _fetch_listing if _CONFIG.backend == "api" else _fetch_page
+    tasks = [
+        asyncio.create_task(_worker(page_queue, image_queue, fetch_page))
+        for _ in range(_CONFIG.concurrency)
+    ]
+    tasks += [
+        asyncio.create_task(_worker(image_queue, encode_queue, _fetch_image))
+        for _ in range(_CONFIG.concurrency)
+    ]
+    tasks += [
+        asyncio.create_task(_worker(encode_queue, None, encode))
+        for _ in range(_CONFIG.encode_workers)
+    ]
+
+    for id in ids:
+        await page_queue.put(id)
+
+    # 按阶段顺序等待排空
+    await page_queue.join()
+    await image_queue.join()
+    await encode_queue.join()
+
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    for name in queues:
+        metrics.remove_gauge(f"spider.{name}_queue")
+
+
+def crawl_ids() -> Iterable:
+    """
+    本次要爬取的id (html) 或 id范围 (api)
+    跳过爬取记录中已完成的id, retry_failed 时只重试记录中失败的id
+    """
+    if _CONFIG.retry_failed:
+        ids = get_ledger().retry_ids()
+        logging.info(f"retry {len(ids)} failed ids.")
+    else:
+        ids = get_ledger().pending_ids(_CONFIG.latest_id, _CONFIG.max_id)
+
+    if _CONFIG.backend == "api":
+        return group_ids(ids, _CONFIG.page_size)
+    return ids
 
 
 if __name__ == "__main__":
-    for id in range(_CONFIG.latest_id, _CONFIG.max_id):
-        run(id)
+    setup_logging("run.log")
+    metrics.start("spider")
+    with get_ledger():
+        if _CONFIG.mode == "async":
+            asyncio.run(crawl(crawl_ids()))
+            transcoder.shutdown()
+        elif _CONFIG.backend == "api":
+            for start, end in crawl_ids():
+                run_api(start, end)
+        else:
+            for id in crawl_ids():
+                run(id)
+
+        writer.shutdown()  # 写完剩余的标签
+        checkpoint = get_ledger().checkpoint(_CONFIG.latest_id, _CONFIG.max_id)
+        logging.info(f"checkpoint: first unfinished id {checkpoint}.")
@@ -1,10 +1,24 @@
 # coding=utf-8
 import os
 import torch
-from transformers import Qwen2VLForConditionalGeneration, Qwen2VLProcessor
-from qwen_vl_utils import process_vision_info
+from PIL import Image
 import logging
+import time
 import yaml
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import TYPE_CHECKING, Callable, Iterator, List, Optional, Tuple
+
+import dataset_index
+import manifest
+import metrics
+import writer
+from claims import ClaimDir
+from config import LazyConfig, setup_logging
+from dataset_index import DatasetItem
+
+if TYPE_CHECKING:
+    from transformers import BatchFeature, DynamicCache, Qwen2VLForConditionalGeneration
 
 
 class TaggerConfig:
@@ -22,46 +36,337 @@ class TaggerConfig:
             self.batch_size = conf["batch_size"]
             self.overwrite = conf["overwrite"]
             self.filter_format = tuple(conf["filter_format"])
+            self.sort_window = conf.get("sort_window", 1024)  # 每次排序的图片数
+            self.prefetch_batches = conf.get("prefetch_batches", 2)  # 预处理的批次数
+            self.loader_workers = conf.get("loader_workers", 2)  # 预处理线程数
+            self.max_new_tokens = conf.get("max_new_tokens", 1024)
+            # static: 整批生成完再换下一批, continuous: 生成完的序列立即换入新图片
+            self.scheduler = conf.get("scheduler", "static")
+            self.admit_size = conf.get("admit_size", 1)  # continuous 每次换入的图片数
+            # 以下两项只用于 continuous
+            # 视觉编码缓存目录, 按图片内容和缩放设置保存视觉编码输出, null 不缓存
+            self.vision_cache = conf.get("vision_cache", None)
+            self.prefix_cache = conf.get("prefix_cache", False)  # 复用模板前缀的 KV cache
+            # 推理后端
+            self.device = conf.get("device", "cuda:0")  # cuda:N / cpu
+            self.dtype = conf.get("dtype", "bfloat16")  # bfloat16 / float16 / float32
+            # null / int8 / int4, GPU 上使用 bitsandbytes, CPU 上使用 torch 动态量化 (仅 int8)
+            self.quantization = conf.get("quantization", None)
+            self.cpu_threads = conf.get("cpu_threads", None)  # CPU 推理线程数
+            # 多卡切分, 如 auto / balanced, 设置后忽略 device
+            self.device_map = conf.get("device_map", None)
+            # 每个设备的最大占用, 如 {0: "20GiB", 1: "20GiB", "cpu": "64GiB"}, 超出部分卸载到 CPU
+            self.max_memory = conf.get("max_memory", None)
 
     def __str__(self):
         return f"{self.__class__.__name__}:{self.__dict__}"
 
 
-logging.basicConfig(
-    level=logging.INFO,
-    filename="tagger.log",
-    filemode="a",
-    format="%(asctime)s - %(pathname)s[line:%(lineno)d] - %(levelname)s: %(message)s",
-)
+_CONFIG = LazyConfig(TaggerConfig)
+
+# 处理器缩放范围
+_MIN_PIXELS = 256 * 28 * 28
+_MAX_PIXELS = 768 * 28 * 28
+
+
+def output_path(item: DatasetItem) -> str:
+    """输出txt路径: output_folder/<作者>/<图片名>.txt"""
+    file_name = os.path.splitext(os.path.basename(item.image))[0]
+    return os.path.join(_CONFIG.output_folder, item.artist, file_name + ".txt")
+
+
+def _model_bytes(model: torch.nn.Module) -> int:
+    """模型权重占用的字节数, 包括动态量化后打包的权重"""
+
+    def size(value) -> int:
+        if isinstance(value, torch.Tensor):
+            return value.numel() * value.element_size()
+        if isinstance(value, (tuple, list)):
+            return sum(size(v) for v in value)
+        return 0
+
+    return sum(size(v) for v in model.state_dict().values())
+
+
+class _Running:
+    """
+    连续批处理中正在生成的序列
+    KV cache 按 batch_size 行预分配, 每个序列占一行, 序列结束后空出的行直接写入新序列, 不复制其他行
+    所有行共用列窗口 [start, length), 新序列右端对齐写入, attention mask 标记每行的有效位置
+    解码时作为 past_key_values 传给模型, 提供 Cache 的 update / get_seq_length
+    """
+
+    def __init__(self, slots: int):
+        self.slots = slots
+        self.items: List[Optional[DatasetItem]] = [None] * slots  # 空行为 None
+        self.generated: List[List[int]] = [[] for _ in range(slots)]  # 已生成的token
+        self.started: List[float] = [0.0] * slots
+        self.keys: List[torch.Tensor] = []  # 每层 (行, heads, 容量, head_dim)
+        self.values: List[torch.Tensor] = []
+        self.mask: Optional[torch.Tensor] = None  # (行, 容量)
+        self.tokens: Optional[torch.Tensor] = None  # 下一步输入的token (行,)
+        self.positions: Optional[torch.Tensor] = None  # 下一步输入的位置 (行,)
+        self.start = self.length = 0
+
+    def __len__(self):
+        return sum(item is not None for item in self.items)
+
+    def rows(self) -> List[int]:
+        """正在生成的行"""
+        return [i for i, item in enumerate(self.items) if item is not None]
+
+    def width(self) -> int:
+        """解码时计算的行数, 最后一个正在生成的行之后的空行不参与计算"""
+        rows = self.rows()
+        return rows[-1] + 1 if rows else 0
+
+    def _allocate(self, layers: list, mask: torch.Tensor, positions: torch.Tensor, capacity: int):
+        self.keys = [
+            k.new_zeros((self.slots, k.shape[1], capacity, k.shape[3])) for k, _ in layers
+        ]
+        self.values = [
+            v.new_zeros((self.slots, v.shape[1], capacity, v.shape[3])) for _, v in layers
+        ]
+        self.mask = mask.new_zeros((self.slots, capacity))
+        self.tokens = torch.zeros(self.slots, dtype=torch.long, device=mask.device)
+        self.positions = positions.new_zeros(self.slots)
+
+    def _move(self, start: int, capacity: int):
+        """把窗口复制到新缓冲区的 start 处, 只在窗口左侧列不足或右侧容量用完时发生"""
+        span = self.length - self.start
+
+        def move(x: torch.Tensor, dim: int) -> torch.Tensor:
+            out = x.new_zeros(x.shape[:dim] + (capacity,) + x.shape[dim + 1 :])
+            out.narrow(dim, start, span).copy_(x.narrow(dim, self.start, span))
+            return out
+
+        self.keys = [move(k, 2) for k in self.keys]
+        self.values = [move(v, 2) for v in self.values]
+        self.mask = move(self.mask, 1)
+        self.start, self.length = start, start + span
+
+    def reserve(self, width: int):
+        """保证窗口左侧能放下 width 列的新序列, 右侧留出下一步解码的一列"""
+        capacity = self.mask.shape[1]
+        if width <= self.length < capacity:
+            return
+        start = max(0, width - (self.length - self.start))
+        needed = start + self.length - self.start + 1
+        while capacity < needed:
+            capacity *= 2
+        self._move(start, capacity)
+
+    def add(
+        self,
+        items: List[DatasetItem],
+        cache: "DynamicCache",
+        mask: torch.Tensor,
+        tokens: torch.Tensor,
+        positions: torch.Tensor,
+    ) -> List[int]:
+        """把预填充后的序列写入空行, 返回使用的行"""
+        layers = [cache[i] for i in range(len(cache))]
+        width = mask.shape[1]
+        if self.mask is None:
+            self._allocate(layers, mask, positions, 2 * width)
+        if len(self) == 0:
+            self.start = self.length = 0  # 没有正在生成的序列, 窗口从头开始
+        self.reserve(width)
+
+        rows = [i for i, item in enumerate(self.items) if item is None][: len(items)]
+        index = torch.tensor(rows, device=self.mask.device)
+        begin = self.length - width
+        if begin < self.start:
+            self.mask[:, begin : self.start] = 0
+            self.start = begin
+        for (k, v), keys, values in zip(layers, self.keys, self.values):
+            keys[index, :, begin : self.length] = k
+            values[index, :, begin : self.length] = v
+        self.mask[index, self.start : self.length] = 0
+        self.mask[index, begin : self.length] = mask
+        self.tokens[index] = tokens
+        self.positions[index] = positions.to(self.positions.dtype)
+
+        now = time.perf_counter()
+        for row, item in zip(rows, items):
+            self.items[row] = item
+            self.generated[row] = []
+            self.started[row] = now
+        return rows
+
+    def release(self, rows: List[int]):
+        """释放结束的行, 去掉所有正在生成的行都是 padding 的列"""
+        for row in rows:
+            self.items[row] = None
+            self.generated[row] = []
+        self.mask[torch.tensor(rows, device=self.mask.device), self.start : self.length] = 0
+        active = self.rows()
+        if not active:
+            self.start = self.length = 0
+            return
+        used = self.mask[torch.tensor(active, device=self.mask.device), self.start : self.length]
+        self.start += int(used.any(0).nonzero()[0])
+
+    def update(
+        self,
+        key: torch.Tensor,
+        value: torch.Tensor,
+        layer_idx: int,
+        cache_kwargs: Optional[dict] = None,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Cache 接口: 写入本步前 width 行的 key/value, 返回窗口内的全部 key/value"""
+        width = key.shape[0]
+        keys, values = self.keys[layer_idx], self.values[layer_idx]
+        keys[:width, :, self.length] = key[:, :, -1]
+        values[:width, :, self.length] = value[:, :, -1]
+        return (
+            keys[:width, :, self.start : self.length + 1],
+            values[:width, :, self.start : self.length + 1],
+        )
 
-_CONFIG = TaggerConfig()
+    def get_seq_length(self, layer_idx: int = 0) -> int:
+        return self.length - self.start
 
 
 class NaturalTagger:
     """自然语言打标器"""
 
-    def __init__(self):
+    def __init__(
+        self,
+        claims: Optional[ClaimDir] = None,
+        progress: Optional[Callable[[int], None]] = None,
+        images: Optional[
+            Callable[[DatasetItem], Optional[Callable[[], Image.Image]]]
+        ] = None,
+    ):
+        """
+        claims: 多进程时认领图片, 只处理自己认领到的
+        progress: 每写出一张图片的结果后以图片数调用
+        images: 返回解码图片的函数, 流水线中与其他阶段共用, 需要图片时才调用; 返回 None 时从文件读取
+        """
+        self.claims = claims
+        self.progress = progress
+        self.images = images
+        # transformers 导入较慢, 创建打标器时才导入
+        from transformers import Qwen2VLProcessor
+
         # 模型加载信息
         logging.info(f"Loading ToriiGate-v0.4-7B model file from {_CONFIG.model_path}")
         self.processor = Qwen2VLProcessor.from_pretrained(
             _CONFIG.model_path,
-            min_pixels=256 * 28 * 28,
-            max_pixels=768 * 28 * 28,
+            min_pixels=_MIN_PIXELS,
+            max_pixels=_MAX_PIXELS,
             padding_side="left",
             use_fast=True,
         )
-        self.model = Qwen2VLForConditionalGeneration.from_pretrained(
+        self.model = self.load_model()
+        # 多卡切分时输入放在 embedding 所在的设备
+        self.device = self.model.get_input_embeddings().weight.device
+        logging.info(
+            f"Loaded ToriiGate-v0.4-7B on {self.device}, quantization: {_CONFIG.quantization}, "
+            f"footprint {_model_bytes(self.model) / 2**20:.1f} MiB"
+        )
+        self.cache_writer = ThreadPoolExecutor(1)  # 保存视觉编码缓存
+
+        eos = self.model.generation_config.eos_token_id
+        self.eos_ids = set(eos if isinstance(eos, list) else [eos])
+        self.eos_ids.add(self.processor.tokenizer.eos_token_id)
+        self.eos_ids.discard(None)
+        # 新版本 transformers 中 get_rope_index 在内部模型上
+        self.rope_index = (
+            getattr(self.model, "get_rope_index", None)
+            or self.model.model.get_rope_index
+        )
+        self.visual = getattr(self.model, "visual", None) or self.model.model.visual
+        # 量化后线性层的权重是整数, 以 patch embedding 的卷积为准
+        self.visual_dtype = self.visual.patch_embed.proj.weight.dtype
+        self.vision_cache = _CONFIG.vision_cache
+        self.prefix_ids: Optional[torch.Tensor] = None
+        self.prefix_kv = None
+
+    def load_model(self) -> "Qwen2VLForConditionalGeneration":
+        """按配置加载模型: 设备、精度、量化、多卡切分"""
+        from transformers import Qwen2VLForConditionalGeneration
+
+        if _CONFIG.cpu_threads:
+            torch.set_num_threads(_CONFIG.cpu_threads)
+        dtype = getattr(torch, _CONFIG.dtype)
+        on_cpu = _CONFIG.device_map is None and _CONFIG.device == "cpu"
+        kwargs = {}
+
+        if _CONFIG.quantization not in (None, "int8", "int4"):
+            raise ValueError(f"unknown quantization: {_CONFIG.quantization}")
+        if _CONFIG.quantization is not None and on_cpu:
+            # CPU 上用 torch 动态量化, 只支持 int8, 需要 float32 权重
+            if _CONFIG.quantization != "int8":
+                raise ValueError("only int8 quantization is supported on cpu")
+            dtype = torch.float32
+        elif _CONFIG.quantization is not None:
+            from transformers import BitsAndBytesConfig
+
+            if _CONFIG.quantization == "int8":
+                kwargs["quantization_config"] = BitsAndBytesConfig(load_in_8bit=True)
+            else:
+                kwargs["quantization_config"] = BitsAndBytesConfig(
+                    load_in_4bit=True,
+                    bnb_4bit_quant_type="nf4",
+                    bnb_4bit_compute_dtype=dtype,
+                )
+        if _CONFIG.max_memory is not None:
+            kwargs["max_memory"] = _CONFIG.max_memory
+
+        model = Qwen2VLForConditionalGeneration.from_pretrained(
             _CONFIG.model_path,
-            torch_dtype=torch.bfloat16,
-            device_map="cuda:0",
+            torch_dtype=dtype,
+            device_map=_CONFIG.device_map or _CONFIG.device,
+            **kwargs,
         ).eval()
-        logging.info(f"Loaded ToriiGate-v0.4-7B")
+
+        if _CONFIG.quantization is not None and on_cpu:
+            # 视觉部分保持浮点, generate 中按视觉权重的类型转换输入
+            qconfig = torch.ao.quantization.default_dynamic_qconfig
+            spec = {
+                name: qconfig
+                for name, module in model.named_modules()
+                if isinstance(module, torch.nn.Linear) and ".visual." not in f".{name}"
+            }
+            model = torch.ao.quantization.quantize_dynamic(
+                model, spec, dtype=torch.qint8
+            )
+        return model
+
+    def report(self, images: int, tokens: int, elapsed: float):
+        """记录吞吐量和内存占用"""
+        logging.info(
+            f"captioned {images} images, generated {tokens} tokens in {elapsed:.1f}s, "
+            f"{images / max(elapsed, 1e-6):.2f} images/s, "
+            f"{tokens / max(elapsed, 1e-6):.1f} tokens/s"
+        )
+        metrics.event(
+            "tagger.report",
+            images=images,
+            tokens=tokens,
+            elapsed=round(elapsed, 3),
+            tokens_per_second=round(tokens / max(elapsed, 1e-6), 3),
+        )
+        if torch.cuda.is_available() and torch.cuda.is_initialized():
+            for i in range(torch.cuda.device_count()):
+                peak = torch.cuda.max_memory_allocated(i)
+                if peak:
+                    logging.info(f"cuda:{i} peak memory {peak / 2**30:.2f} GiB")
+        # 没有 resource 模块 (Windows) 时不记录
+        peak_rss = metrics.max_rss()
+        if peak_rss is not None:
+            logging.info(f"peak rss {peak_rss / 2**30:.2f} GiB")
 
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        torch.cuda.empty_cache()
+        self.cache_writer.shutdown()
+        writer.flush()  # 等待输出写完
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
         logging.info("all done / 识别完成")
         logging.info("Unloaded ToriiGate-v0.4-7B")
 
@@ -111,107 +416,521 @@ class NaturalTagger:
     #     else:
     #         return base_prompt
 
-    def run(self, base_folder: str):
-        # ====== 修改文件列表生成逻辑（核心修复点） ======
-        image_files = []
-        base_folder = os.path.abspath(base_folder)
-
-        for f_name in os.listdir(base_folder):
-            abs_path = os.path.join(base_folder, f_name)
+    def candidates(self, base_folder: str) -> Iterator[DatasetItem]:
+        """需要打标的图片"""
+        for item in dataset_index.scan(base_folder, _CONFIG.filter_format):
+            txt_path = output_path(item)
+            if not os.path.exists(txt_path) or _CONFIG.overwrite:
+                yield item
+            else:
+                logging.info(f"skip existed: {txt_path}")
+
+    def sort_key(self, image_path: str) -> Tuple[int, float]:
+        """按缩放后的像素数和宽高比排序, 同批次的图片 token 数接近, 减少 padding"""
+        from qwen_vl_utils import smart_resize
+
+        try:
+            with Image.open(image_path) as img:
+                width, height = img.size
+            h, w = smart_resize(
+                height, width, min_pixels=_MIN_PIXELS, max_pixels=_MAX_PIXELS
+            )
+        except Exception:
+            return 0, 0.0
+        return h * w, h / w
+
+    def batches(
+        self, base_folder: str, batch_size: int
+    ) -> Iterator[List[DatasetItem]]:
+        """
+        跨文件夹组成完整批次
+        每 sort_window 张图片排序一次, 不足一个批次的留到下一个窗口
+        """
+        window = []
+        for item in self.candidates(base_folder):
+            window.append((self.sort_key(item.image), item))
+            if len(window) < _CONFIG.sort_window:
+                continue
 
-            # 递归子文件夹
-            if os.path.isdir(abs_path):
-                self.run(abs_path)
+            window.sort(key=lambda x: x[0])
+            window = yield from self.take(window, batch_size)
+
+        window.sort(key=lambda x: x[0])
+        window = yield from self.take(window, batch_size)
+        if window:
+            yield [item for _, item in window]
+
+    def take(self, window: list, batch_size: int):
+        """
+        按顺序认领图片并组成完整批次, 返回剩下不足一个批次的图片
+        多进程时在组批时才认领, 其他进程可以认领同一窗口中剩下的图片
+        """
+        batch = []
+        for entry in window:
+            if self.claims is not None and not self.claims.claim(entry[1].image):
                 continue
+            batch.append(entry)
+            if len(batch) == batch_size:
+                yield [item for _, item in batch]
+                batch = []
+        return batch
+
+    def prefetch(
+        self, batches: Iterator[List[DatasetItem]], prepare=None
+    ) -> Iterator[Tuple[List[DatasetItem], Future]]:
+        """
+        后台线程预处理之后 prefetch_batches 个批次, 与当前批次的生成并行
+        """
+        prepare = prepare or self.prepare_batch
+        pending = deque()
+        with ThreadPoolExecutor(_CONFIG.loader_workers) as loader:
+            for batch_items in batches:
+                pending.append((batch_items, loader.submit(prepare, batch_items)))
+                if len(pending) > _CONFIG.prefetch_batches:
+                    yield pending.popleft()
+
+            while pending:
+                yield pending.popleft()
+
+    def group_size(self) -> int:
+        """每次提交的图片数, continuous 时为 admit_size"""
+        if _CONFIG.scheduler == "continuous":
+            return min(_CONFIG.admit_size, _CONFIG.batch_size)
+        return _CONFIG.batch_size
 
-            parent_name = os.path.split(os.path.dirname(abs_path))[-1]
+    def run(self, base_folder: str):
+        self.run_batches(self.batches(base_folder, self.group_size()))
+
+    def run_batches(self, batches: Iterator[List[DatasetItem]]):
+        """处理 group_size 张一组的图片"""
+        if _CONFIG.scheduler == "continuous":
+            self.run_continuous(batches)
+            return
+        if self.vision_cache is not None or _CONFIG.prefix_cache:
+            logging.warning("vision_cache/prefix_cache only work with continuous scheduler")
+
+        images = tokens = 0
+        start = time.perf_counter()
+        for batch_items, future in self.prefetch(batches):
+            metrics.step()
+            tokens += self.run_batch(batch_items, future)
+            images += len(batch_items)
+        self.report(images, tokens, time.perf_counter() - start)
+
+    def shared_image(self, item: DatasetItem) -> Optional[Callable[[], Image.Image]]:
+        return self.images(item) if self.images is not None else None
+
+    def build_messages(
+        self, item: DatasetItem, image: Optional[Image.Image] = None
+    ) -> list:
+        """image 为 None 时使用图片路径"""
+        return [
+            {
+                "role": "user",
+                "content": [
+                    {"type": "image", "image": item.image if image is None else image},
+                    {"type": "text", "text": self.load_tags(item.image)},
+                ],
+            }
+        ]
+
+    @metrics.timed("tagger.preprocess")
+    def prepare_batch(self, batch_items: List[DatasetItem]) -> "BatchFeature":
+        """读取、解码、缩放图片并生成模型输入, 在加载线程中执行"""
+        from qwen_vl_utils import process_vision_info
+
+        texts = []
+        images = []
+
+        for item in batch_items:
+            shared = self.shared_image(item)
+            messages = self.build_messages(item, shared() if shared is not None else None)
+
+            text_input = self.processor.apply_chat_template(
+                messages, tokenize=False, add_generation_prompt=True
+            )
+            image_input, _ = process_vision_info(messages)
 
-            if f_name.lower().endswith(_CONFIG.filter_format):
-                txt_path = os.path.join(
-                    _CONFIG.output_folder, parent_name, f_name.split(".")[0] + ".txt"
-                )  # 图片同名txt文件
-                if not os.path.exists(txt_path) or _CONFIG.overwrite:
-                    image_files.append(abs_path)
-                else:
-                    logging.info(f"skip existed: {txt_path}")
+            texts.append(text_input)
+            images.append(image_input)
 
-        for i in range(0, len(image_files), _CONFIG.batch_size):
-            batch_files = image_files[i : i + _CONFIG.batch_size]
-            texts = []
-            images = []
+        inputs = self.processor(
+            text=texts, images=images, padding=True, return_tensors="pt"
+        )
 
-            for image_path in batch_files:
-                messages = [
+        # 锁页内存, 之后可以异步拷贝到显存
+        if self.device.type == "cuda":
+            for k, v in inputs.items():
+                if isinstance(v, torch.Tensor):
+                    inputs[k] = v.pin_memory()
+        return inputs
+
+    @metrics.timed("tagger.preprocess")
+    def prepare_images(self, batch_items: List[DatasetItem]) -> List[dict]:
+        """
+        逐张生成模型输入, 在加载线程中执行
+        视觉缓存命中时不解码图片, 直接按缓存的 grid_thw 展开图片占位符
+        """
+        from qwen_vl_utils import process_vision_info
+
+        merge = self.processor.image_processor.merge_size
+        image_token = self.processor.image_token
+        rows = []
+        for item in batch_items:
+            shared = self.shared_image(item)
+            # 生成文本不需要解码图片
+            messages = self.build_messages(item)
+            text_input = self.processor.apply_chat_template(
+                messages, tokenize=False, add_generation_prompt=True
+            )
+            key = self.vision_key(item.image) if self.vision_cache else None
+            cached = self.load_vision(key) if key else None
+
+            if cached is not None:
+                embeds, grid_thw = cached
+                count = int(grid_thw.prod()) // merge**2
+                input_ids = self.processor.tokenizer(
+                    text_input.replace(image_token, image_token * count),
+                    return_tensors="pt",
+                )["input_ids"]
+                rows.append(
                     {
-                        "role": "user",
-                        "content": [
-                            {"type": "image", "image": image_path},
-                            {"type": "text", "text": self.load_tags(image_path)},
-                        ],
+                        "key": key,
+                        "input_ids": input_ids,
+                        "image_grid_thw": grid_thw,
+                        "image_embeds": embeds,
+                        "pixel_values": None,
                     }
-                ]
-
-                text_input = self.processor.apply_chat_template(
-                    messages, tokenize=False, add_generation_prompt=True
                 )
+            else:
+                if shared is not None:
+                    messages = self.build_messages(item, shared())
                 image_input, _ = process_vision_info(messages)
-
-                texts.append(text_input)
-                images.append(image_input)
-
-            inputs = self.processor(
-                text=texts, images=images, padding=True, return_tensors="pt"
-            ).to("cuda")
-
-            with torch.no_grad():
-                generated_ids = self.model.generate(
-                    **inputs,
-                    max_new_tokens=1024,
-                    pad_token_id=self.processor.tokenizer.pad_token_id,
-                    do_sample=True,
-                    temperature=0.001,
-                    top_p=0.01,
-                    top_k=1,
-                    repetition_penalty=1.0,
+                inputs = self.processor(
+                    text=[text_input], images=image_input, return_tensors="pt"
                 )
-
-            output_texts = self.processor.batch_decode(
-                generated_ids[:, inputs["input_ids"].shape[1] :],
-                skip_special_tokens=True,
+                rows.append(
+                    {
+                        "key": key,
+                        "input_ids": inputs["input_ids"],
+                        "image_grid_thw": inputs["image_grid_thw"],
+                        "image_embeds": None,
+                        "pixel_values": inputs["pixel_values"],
+                    }
+                )
+        return rows
+
+    def vision_key(self, image_path: str) -> str:
+        """图片内容sha1 + 模型和缩放设置"""
+        settings = f"{manifest.file_hash(image_path)}|{_CONFIG.model_path}|{_MIN_PIXELS}|{_MAX_PIXELS}"
+        return manifest.content_hash(settings.encode("utf-8"))
+
+    def vision_path(self, key: str) -> str:
+        return os.path.join(self.vision_cache, key[:2], key + ".pt")
+
+    def load_vision(self, key: str) -> Optional[Tuple[torch.Tensor, torch.Tensor]]:
+        """读取缓存的 (视觉编码输出, image_grid_thw)"""
+        path = self.vision_path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            data = torch.load(path, map_location="cpu", weights_only=True)
+            return data["embeds"], data["grid_thw"]
+        except Exception as e:
+            logging.warning(f"broken vision cache {path}: {repr(e)}")
+            return None
+
+    def save_vision(self, key: str, embeds: torch.Tensor, grid_thw: torch.Tensor):
+        path = self.vision_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        torch.save({"embeds": embeds, "grid_thw": grid_thw}, tmp_path)
+        os.replace(tmp_path, path)
+
+    def run_batch(self, batch_items: List[DatasetItem], future: Future) -> int:
+        """生成一个批次, 返回生成的token数"""
+        try:
+            inputs = future.result().to(self.device, non_blocking=True)
+        except Exception as e:
+            logging.error(
+                f"prepare batch failed: {[item.image for item in batch_items]} {repr(e)}"
+            )
+            return 0
+
+        with torch.no_grad(), metrics.timer("tagger.generate"):
+            generated_ids = self.model.generate(
+                **inputs,
+                max_new_tokens=_CONFIG.max_new_tokens,
+                pad_token_id=self.processor.tokenizer.pad_token_id,
+                do_sample=True,
+                temperature=0.001,
+                top_p=0.01,
+                top_k=1,
+                repetition_penalty=1.0,
             )
 
-            # ====== 新增显存清理逻辑 ======
-            del inputs, generated_ids  # 删除大张量
-            torch.cuda.empty_cache()  # 强制清理缓存 [[8]][[10]]
-
-            # 核心修复部分：仅去除特殊符号
-            for idx, output_text in enumerate(output_texts):
-                # 仅处理回车符和首尾空格
-                output_text = output_text.replace("\r", " ").strip()
+        new_ids = generated_ids[:, inputs["input_ids"].shape[1] :]
+        output_texts = self.processor.batch_decode(new_ids, skip_special_tokens=True)
+        tokens = int((new_ids != self.processor.tokenizer.pad_token_id).sum())
+        metrics.count("tagger.tokens", tokens)
 
-                # 验证处理结果
-                # logging.info(f"Processed output sample: {output_text[:100]}...")
+        # ====== 新增显存清理逻辑 ======
+        del inputs, generated_ids, new_ids  # 删除大张量
+        if self.device.type == "cuda":
+            torch.cuda.empty_cache()  # 强制清理缓存 [[8]][[10]]
 
-                # 保存处理后的文本
-                parent_name = os.path.split(os.path.dirname(batch_files[idx]))[-1]
-                file_name = os.path.split(batch_files[idx])[-1]
+        # 在写入线程中保存, 不阻塞下一批次
+        self.write_outputs(batch_items, output_texts)
+        return tokens
+
+    @metrics.timed("tagger.write")
+    def write_outputs(self, batch_items: List[DatasetItem], output_texts: List[str]):
+        metrics.count("tagger.images", len(output_texts))
+        # 核心修复部分：仅去除特殊符号
+        for idx, output_text in enumerate(output_texts):
+            # 仅处理回车符和首尾空格
+            output_text = output_text.replace("\r", " ").strip()
+
+            # 验证处理结果
+            # logging.info(f"Processed output sample: {output_text[:100]}...")
+
+            # 保存处理后的文本, 由后台线程写入
+            future = writer.write(output_path(batch_items[idx]), output_text)
+            if self.progress is not None:
+                future.add_done_callback(lambda _: self.progress(1))
+
+    def run_continuous(self, batches: Iterator[List[DatasetItem]]):
+        """
+        连续批处理: 最多 batch_size 个序列同时生成, 序列生成结束后立即释放位置,
+        预填充新图片并拼接到正在生成的 KV cache 中
+        """
+        cached = self.vision_cache is not None or _CONFIG.prefix_cache
+        incoming = self.prefetch(
+            batches,
+            self.prepare_images if cached else self.prepare_batch,
+        )
+        admit = self.admit_cached if cached else self.admit
+        # 在后台线程中取下一组图片, 流水线中新图片还没到达时不阻塞正在生成的序列
+        fetcher = ThreadPoolExecutor(1)
+        upcoming: Optional[Future] = fetcher.submit(next, incoming, None)
+        next_batch = None  # 已取到但还放不下的一组
+        running = _Running(_CONFIG.batch_size)
+        metrics.gauge("tagger.running", running.__len__)
+        images = total_tokens = 0
+        start = time.perf_counter()
+
+        while True:
+            while True:
+                if next_batch is None:
+                    # 有正在生成的序列时只取已经准备好的
+                    if upcoming is None or (len(running) > 0 and not upcoming.done()):
+                        break
+                    next_batch = upcoming.result()
+                    if next_batch is None:
+                        upcoming = None
+                        break
+                    upcoming = fetcher.submit(next, incoming, None)
+                if len(running) + len(next_batch[0]) > _CONFIG.batch_size:
+                    break
+                admit(running, *next_batch)
+                images += len(next_batch[0])
+                next_batch = None
+
+            if len(running) > 0:
+                # 每个解码步为一个批次
+                metrics.step()
+                total_tokens += self.decode_step(running)
+            elif next_batch is None and upcoming is None:
+                break
+
+        fetcher.shutdown()
+        metrics.remove_gauge("tagger.running")
+        self.report(images, total_tokens, time.perf_counter() - start)
+
+    @torch.no_grad()
+    @metrics.timed("tagger.prefill")
+    def admit(self, running: _Running, batch_items: List[DatasetItem], future: Future):
+        """预填充新图片并加入正在生成的序列"""
+        from transformers import DynamicCache
+
+        try:
+            inputs = future.result().to(self.device, non_blocking=True)
+        except Exception as e:
+            logging.error(
+                f"prepare batch failed: {[item.image for item in batch_items]} {repr(e)}"
+            )
+            return
 
-                txt_path = os.path.join(
-                    _CONFIG.output_folder,
-                    parent_name,
-                    os.path.splitext(file_name)[0] + ".txt",
-                )
-                os.makedirs(
-                    os.path.join(_CONFIG.output_folder, parent_name), exist_ok=True
+        mask = inputs["attention_mask"]
+        position_ids, deltas = self.rope_index(
+            inputs["input_ids"], inputs.get("image_grid_thw"), None, mask
+        )
+        outputs = self.model(
+            **inputs,
+            position_ids=position_ids,
+            past_key_values=DynamicCache(),
+            use_cache=True,
+            cache_position=torch.arange(mask.shape[1], device=mask.device),
+        )
+        tokens = outputs.logits[:, -1].argmax(-1)
+        # 下一个位置 = 有效token数 + mrope偏移
+        positions = mask.sum(1) + deltas.view(-1).to(mask.device)
+
+        rows = running.add(batch_items, outputs.past_key_values, mask, tokens, positions)
+        self.accept(running, rows, tokens.tolist())
+
+    @torch.no_grad()
+    @metrics.timed("tagger.prefill")
+    def admit_cached(
+        self, running: _Running, batch_items: List[DatasetItem], future: Future
+    ):
+        """逐张预填充, 复用视觉编码缓存和模板前缀的 KV cache"""
+        try:
+            rows = future.result()
+        except Exception as e:
+            logging.error(
+                f"prepare batch failed: {[item.image for item in batch_items]} {repr(e)}"
+            )
+            return
+
+        for item, row in zip(batch_items, rows):
+            try:
+                self.prefill(running, item, row)
+            except Exception as e:
+                logging.error(f"prefill failed: {item.image} {repr(e)}")
+
+    def prefill(self, running: _Running, item: DatasetItem, row: dict):
+        from transformers import DynamicCache
+
+        device = self.device
+        input_ids = row["input_ids"].to(device)
+        grid_thw = row["image_grid_thw"].to(device)
+
+        embeds = row["image_embeds"]
+        if embeds is None:
+            pixel_values = row["pixel_values"].to(device, self.visual_dtype)
+            embeds = self.visual(pixel_values, grid_thw=grid_thw)
+            if row["key"] is not None:
+                self.cache_writer.submit(
+                    self.save_vision, row["key"], embeds.cpu(), row["image_grid_thw"]
                 )
+        inputs_embeds = self.model.get_input_embeddings()(input_ids)
+        image_mask = (input_ids == self.model.config.image_token_id).unsqueeze(-1)
+        inputs_embeds = inputs_embeds.masked_scatter(
+            image_mask.expand_as(inputs_embeds),
+            embeds.to(device, inputs_embeds.dtype),
+        )
 
-                with open(txt_path, "w", encoding="utf-8", newline="") as f:
-                    f.write(output_text)  # 直接写入未处理的原始文本
-
-            # 额外清理
-            del output_texts, texts, images  # 清理批次数据
+        mask = torch.ones_like(input_ids)
+        position_ids, deltas = self.rope_index(input_ids, grid_thw, None, mask)
+        if _CONFIG.prefix_cache:
+            start, cache = self.prefix(input_ids)
+        else:
+            start, cache = 0, DynamicCache()
+        outputs = self.model(
+            inputs_embeds=inputs_embeds[:, start:],
+            attention_mask=mask,
+            position_ids=position_ids[:, :, start:],
+            past_key_values=cache,
+            use_cache=True,
+            cache_position=torch.arange(start, mask.shape[1], device=device),
+        )
+        tokens = outputs.logits[:, -1].argmax(-1)
+        positions = mask.sum(1) + deltas.view(-1).to(device)
+
+        rows = running.add([item], outputs.past_key_values, mask, tokens, positions)
+        self.accept(running, rows, tokens.tolist())
+
+    def prefix(self, input_ids: torch.Tensor) -> Tuple[int, "DynamicCache"]:
+        """
+        图片之前的模板前缀 (system prompt 等) 对所有图片相同, 位置为 0..start-1
+        只计算一次 KV cache, 之后每张图片复制使用
+        """
+        from transformers import DynamicCache
+
+        vision_start = self.model.config.vision_start_token_id
+        start = int((input_ids[0] == vision_start).nonzero()[0]) + 1
+        prefix_ids = input_ids[:, :start]
+        if self.prefix_ids is None or not torch.equal(self.prefix_ids, prefix_ids):
+            outputs = self.model(
+                input_ids=prefix_ids,
+                position_ids=torch.arange(start, device=input_ids.device).expand(
+                    3, 1, -1
+                ),
+                past_key_values=DynamicCache(),
+                use_cache=True,
+                cache_position=torch.arange(start, device=input_ids.device),
+            )
+            self.prefix_ids = prefix_ids
+            cache = outputs.past_key_values
+            self.prefix_kv = [cache[i] for i in range(len(cache))]  # 每层 (key, value)
+            logging.info(f"cached prompt prefix: {start} tokens")
+        # update 时拼接出新的张量, 不会修改 prefix_kv
+        cache = DynamicCache()
+        for layer, (key, value) in enumerate(self.prefix_kv):
+            cache.update(key, value, layer)
+        return start, cache
+
+    @torch.no_grad()
+    @metrics.timed("tagger.generate")
+    def decode_step(self, running: _Running) -> int:
+        """所有序列各生成一个token, 只计算到最后一个正在生成的行"""
+        running.reserve(0)
+        width = running.width()
+        running.mask[:width, running.length] = 1
+        outputs = self.model(
+            input_ids=running.tokens[:width, None],
+            attention_mask=running.mask[:width, running.start : running.length + 1],
+            position_ids=running.positions[:width].view(1, -1, 1).expand(3, -1, -1),
+            past_key_values=running,
+            use_cache=True,
+            cache_position=torch.tensor(
+                [running.get_seq_length()], device=running.mask.device
+            ),
+        )
+        running.length += 1
+        running.positions[:width] += 1
+
+        tokens = outputs.logits[:, -1].argmax(-1)
+        running.tokens[:width] = tokens
+        rows = running.rows()
+        metrics.count("tagger.tokens", len(rows))
+        self.accept(running, rows, tokens[rows].tolist())
+        return len(rows)
+
+    def accept(self, running: _Running, rows: List[int], tokens: List[int]):
+        """记录各行新生成的token, 结束的序列写出并释放所在的行"""
+        finished = []
+        for i, token in zip(rows, tokens):
+            # 与 generate 一致, 结束符也保留在输出中, 解码时去掉
+            running.generated[i].append(token)
+            if (
+                token in self.eos_ids
+                or len(running.generated[i]) >= _CONFIG.max_new_tokens
+            ):
+                finished.append(i)
+
+        if not finished:
+            return
+
+        now = time.perf_counter()
+        items = [running.items[i] for i in finished]
+        output_texts = self.processor.batch_decode(
+            [running.generated[i] for i in finished], skip_special_tokens=True
+        )
+        for i in finished:
+            latency = now - running.started[i]
+            count = len(running.generated[i])
+            logging.info(
+                f"captioned {running.items[i].image}: {count} tokens, "
+                f"latency {latency:.2f}s, {count / max(latency, 1e-6):.1f} tokens/s"
+            )
+        self.write_outputs(items, output_texts)
+        running.release(finished)
 
 
 if __name__ == "__main__":
+    setup_logging("tagger.log")
+    metrics.start("tagger")
     with NaturalTagger() as tagger:
         tagger.run(_CONFIG.image_folder)
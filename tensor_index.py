@@ -0,0 +1,286 @@
+# coding=utf-8
+import json
+import mmap
+import os
+import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+INDEX_FILE = "model.safetensors.index.json"
+
+# safetensors 的数据类型, 按 safetensors 保存时的排序从小到大
+DTYPE_SIZES = {
+    "BOOL": 1,
+    "U8": 1,
+    "I8": 1,
+    "F8_E5M2": 1,
+    "F8_E4M3": 1,
+    "I16": 2,
+    "U16": 2,
+    "F16": 2,
+    "BF16": 2,
+    "I32": 4,
+    "U32": 4,
+    "F32": 4,
+    "F64": 8,
+    "I64": 8,
+    "U64": 8,
+}
+
+# numpy 没有 bf16 和 fp8
+_NUMPY_DTYPES = {
+    "BOOL": np.bool_,
+    "U8": np.uint8,
+    "I8": np.int8,
+    "I16": np.int16,
+    "U16": np.uint16,
+    "F16": np.float16,
+    "I32": np.int32,
+    "U32": np.uint32,
+    "F32": np.float32,
+    "F64": np.float64,
+    "I64": np.int64,
+    "U64": np.uint64,
+}
+
+
+_TORCH_DTYPES = {
+    "BOOL": "bool",
+    "U8": "uint8",
+    "I8": "int8",
+    "F8_E5M2": "float8_e5m2",
+    "F8_E4M3": "float8_e4m3fn",
+    "I16": "int16",
+    "U16": "uint16",
+    "F16": "float16",
+    "BF16": "bfloat16",
+    "I32": "int32",
+    "U32": "uint32",
+    "F32": "float32",
+    "F64": "float64",
+    "I64": "int64",
+    "U64": "uint64",
+}
+
+
+def parse_header(path: str) -> Tuple[dict, int]:
+    """
+    读取 safetensors 文件头, 返回 (header, 数据起始位置), 不检查张量数据
+    文件格式: 8字节小端 header 长度 + json header + 数据, data_offsets 相对数据起始位置
+    """
+    file_size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        prefix = f.read(8)
+        if len(prefix) < 8:
+            raise ValueError("file too small")
+        (header_size,) = struct.unpack("<Q", prefix)
+        if header_size > file_size - 8:
+            raise ValueError(f"header size {header_size} exceeds file size")
+        header = json.loads(f.read(header_size))
+    return header, 8 + header_size
+
+
+def read_header(path: str) -> Tuple[dict, int]:
+    """读取 safetensors 文件头, 张量数据超出文件时报错"""
+    try:
+        header, data_start = parse_header(path)
+    except ValueError as e:
+        raise ValueError(f"{path}: {e}") from e
+    data_size = os.path.getsize(path) - data_start
+    for name, info in header.items():
+        if name == "__metadata__":
+            continue
+        begin, end = info["data_offsets"]
+        if not 0 <= begin <= end <= data_size:
+            raise ValueError(
+                f"{path}: tensor {name} {info['data_offsets']} out of data range {data_size}, file truncated?"
+            )
+    return header, data_start
+
+
+def check_header(path: str, header: dict, data_start: int) -> List[str]:
+    """检查数据类型、形状与数据长度是否一致, 数据是否连续、有无重叠或多余字节"""
+    problems = []
+    spans = []
+    data_size = os.path.getsize(path) - data_start
+    for name, info in header.items():
+        if name == "__metadata__":
+            continue
+        dtype = info.get("dtype")
+        if dtype not in DTYPE_SIZES:
+            problems.append(f"{path}: tensor {name} unknown dtype {dtype}")
+            continue
+        begin, end = info["data_offsets"]
+        if not 0 <= begin <= end <= data_size:
+            problems.append(
+                f"{path}: tensor {name} {info['data_offsets']} out of data range {data_size}, file truncated?"
+            )
+            continue
+        expected = int(np.prod(info["shape"], dtype=np.int64)) * DTYPE_SIZES[dtype]
+        if end - begin != expected:
+            problems.append(
+                f"{path}: tensor {name} {dtype}{info['shape']} needs {expected} bytes, got {end - begin}"
+            )
+        spans.append((begin, end, name))
+
+    position = 0
+    for begin, end, name in sorted(spans):
+        if begin != position:
+            kind = "overlaps" if begin < position else "gap before"
+            problems.append(f"{path}: tensor {name} {kind} offset {position}")
+        position = max(position, end)
+    if position != data_size:
+        problems.append(f"{path}: data ends at {position}, file has {data_size} bytes")
+    return problems
+
+
+def inspect_shard(path: str) -> Tuple[dict, int, List[str]]:
+    """读取并检查分片, 返回 (header, 数据起始位置, 问题列表), 无法读取时 header 为空"""
+    try:
+        header, data_start = parse_header(path)
+    except (OSError, ValueError) as e:
+        return {}, 0, [f"{path}: {e}"]
+    return header, data_start, check_header(path, header, data_start)
+
+
+def inspect_shards(
+    shards: List[str], workers: int = 8
+) -> Dict[str, Tuple[dict, int, List[str]]]:
+    """并行读取检查所有分片, 按分片顺序返回"""
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        return dict(zip(shards, executor.map(inspect_shard, shards)))
+
+
+def check_coverage(base_path: str, headers: Dict[str, dict]) -> List[str]:
+    """检查张量名是否重复, 以及与 model.safetensors.index.json 是否一致"""
+    problems = []
+    owner: Dict[str, str] = {}
+    for shard, header in headers.items():
+        for name in header:
+            if name == "__metadata__":
+                continue
+            if name in owner:
+                problems.append(f"duplicate tensor {name}: {owner[name]}, {shard}")
+            else:
+                owner[name] = shard
+
+    index_path = os.path.join(base_path, INDEX_FILE)
+    if not os.path.exists(index_path):
+        return problems
+    with open(index_path, "r", encoding="utf-8") as f:
+        weight_map = json.load(f)["weight_map"]
+    for name, file in weight_map.items():
+        shard = os.path.join(base_path, file)
+        if name not in owner:
+            problems.append(f"{INDEX_FILE}: tensor {name} missing from {file}")
+        elif owner[name] != shard:
+            problems.append(f"{INDEX_FILE}: tensor {name} mapped to {file}, found in {owner[name]}")
+    for name, shard in owner.items():
+        if name not in weight_map:
+            problems.append(f"{INDEX_FILE}: tensor {name} in {shard} not listed")
+    return problems
+
+
+def build_index(index_file: str, headers: Dict[str, Tuple[dict, int]]) -> dict:
+    """
+    张量索引: 张量名 -> 文件(相对索引文件)、文件内起始位置、数据类型、形状
+    不合并分片也能按需 mmap 单个张量
+    """
+    folder = os.path.dirname(os.path.abspath(index_file))
+    tensors = {}
+    metadata = {}
+    for shard, (header, data_start) in headers.items():
+        file = os.path.relpath(shard, folder)
+        for name, info in header.items():
+            if name == "__metadata__":
+                for key, value in (info or {}).items():
+                    metadata.setdefault(key, value)
+                continue
+            begin, end = info["data_offsets"]
+            tensors[name] = {
+                "file": file,
+                "offset": data_start + begin,
+                "length": end - begin,
+                "dtype": info["dtype"],
+                "shape": info["shape"],
+            }
+    return {"metadata": metadata, "tensors": tensors}
+
+
+class LazyTensors:
+    """
+    按张量索引读取单个张量, 每个分片只在第一次用到时 mmap 一次
+    get_array 返回共享内存的 numpy 数组, get_tensor 返回 torch 张量
+    """
+
+    def __init__(self, index_file: str):
+        with open(index_file, "r", encoding="utf-8") as f:
+            index = json.load(f)
+        self.folder = os.path.dirname(os.path.abspath(index_file))
+        self.metadata: dict = index.get("metadata", {})
+        self.tensors: Dict[str, dict] = index["tensors"]
+        self.maps: Dict[str, mmap.mmap] = {}
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __len__(self):
+        return len(self.tensors)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.tensors
+
+    def keys(self) -> List[str]:
+        return list(self.tensors)
+
+    def _map(self, file: str) -> mmap.mmap:
+        with self.lock:
+            if file not in self.maps:
+                with open(os.path.join(self.folder, file), "rb") as f:
+                    # 写时复制, torch.frombuffer 需要可写的 buffer, 不会改动文件
+                    self.maps[file] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+            return self.maps[file]
+
+    def get_array(self, name: str) -> np.ndarray:
+        info = self.tensors[name]
+        if info["dtype"] not in _NUMPY_DTYPES:
+            raise ValueError(f"{name}: numpy does not support {info['dtype']}, use get_tensor")
+        dtype = _NUMPY_DTYPES[info["dtype"]]
+        return np.frombuffer(
+            self._map(info["file"]),
+            dtype=dtype,
+            count=info["length"] // DTYPE_SIZES[info["dtype"]],
+            offset=info["offset"],
+        ).reshape(info["shape"])
+
+    def get_tensor(self, name: str):
+        import torch
+
+        info = self.tensors[name]
+        dtype = getattr(torch, _TORCH_DTYPES[info["dtype"]])
+        if info["length"] == 0:
+            return torch.empty(info["shape"], dtype=dtype)
+        return torch.frombuffer(
+            self._map(info["file"]),
+            dtype=dtype,
+            count=info["length"] // DTYPE_SIZES[info["dtype"]],
+            offset=info["offset"],
+        ).reshape(info["shape"])
+
+    def close(self):
+        with self.lock:
+            for mm in self.maps.values():
+                try:
+                    mm.close()
+                except BufferError:
+                    # 还有张量在使用, 由垃圾回收释放
+                    pass
+            self.maps.clear()
+
@@ -0,0 +1,113 @@
+# coding=utf-8
+import io
+import math
+import os
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Optional
+
+import yaml
+from PIL import Image
+
+from config import LazyConfig
+from washer import remove_metadata
+
+
+class TranscoderConfig:
+
+    def __init__(self):
+        with open("./config.yml", "r") as f:
+            conf = yaml.safe_load(f)
+            # 可选配置, 没有时使用默认值
+            conf = conf.get("transcoder") or {}
+            self.workers = conf.get("workers", os.cpu_count() or 1)
+            self.webp_method = conf.get("webp_method", 4)  # 0(快)~6(慢, 压缩率高)
+            self.webp_quality = conf.get("webp_quality", 80)
+
+    def __str__(self):
+        return f"{self.__class__.__name__}:{self.__dict__}"
+
+
+_CONFIG = LazyConfig(TranscoderConfig)
+
+
+def has_transparency(img: Image.Image):
+    """检查图片是否有透明"""
+    if img.info.get("transparency", None) is not None:
+        return True
+    if img.mode == "P":
+        transparent = img.info.get("transparency", -1)
+        for _, index in img.getcolors():
+            if index == transparent:
+                return True
+    elif img.mode == "RGBA":
+        extrema = img.getextrema()
+        if extrema[3][0] < 255:
+            return True
+
+    return False
+
+
+def compress_img(img: Image.Image, max_res: int) -> Image.Image:
+    """压缩图片"""
+    res = img.width * img.height
+    if res <= max_res:
+        return img
+    ratio = math.sqrt(max_res / res)
+    return img.resize((int(img.width * ratio), int(img.height * ratio)))
+
+
+def transcode(
+    file_content: bytes,
+    target_format: str,
+    lossless: bool = False,
+    max_res: Optional[int] = None,
+    flatten: bool = False,
+) -> bytes:
+    """
+    解码图片, 移除metadata并重新编码, 输入输出都是bytes, 可以在子进程中执行
+    flatten: 透明背景合成为白色
+    max_res: 最大像素数
+    """
+    img = Image.open(io.BytesIO(file_content))
+
+    if flatten and has_transparency(img):
+        img = Image.alpha_composite(
+            Image.new("RGBA", img.size, "WHITE"), img.convert("RGBA")
+        )
+
+    img = remove_metadata(img)
+    if max_res is not None:
+        img = compress_img(img, max_res)
+
+    buf = io.BytesIO()
+    img.save(
+        buf,
+        target_format,
+        lossless=lossless,
+        method=_CONFIG.webp_method,
+        quality=_CONFIG.webp_quality,
+    )
+    return buf.getvalue()
+
+
+_POOL: Optional[ProcessPoolExecutor] = None
+
+
+def get_pool() -> ProcessPoolExecutor:
+    """共享的转码进程池"""
+    global _POOL
+    if _POOL is None:
+        _POOL = ProcessPoolExecutor(_CONFIG.workers)
+    return _POOL
+
+
+def submit(file_content: bytes, target_format: str, **kwargs) -> Future:
+    """提交转码任务到进程池"""
+    return get_pool().submit(transcode, file_content, target_format, **kwargs)
+
+
+def shutdown():
+    global _POOL
+    if _POOL is not None:
+        _POOL.shutdown()
+        _POOL = None
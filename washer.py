@@ -1,7 +1,15 @@
 # coding=utf-8
 from PIL import Image
+import logging
 import os
+import struct
 import yaml
+from collections import deque
+from typing import Optional, Tuple
+
+import dataset_index
+from config import LazyConfig
+from manifest import Manifest, content_hash
 
 
 class WasherConfig:
@@ -16,36 +24,211 @@ class WasherConfig:
             self.location = conf["location"]
             self.target_format = conf["target_format"]
             self.filter_format = tuple(conf["filter_format"])
+            self.max_pending = conf.get("max_pending", 64)  # 同时转码的图片数
+            # 清洗记录, 默认为 location 下的 .washer_manifest.db
+            self.manifest = conf.get("manifest")
 
     def __str__(self):
         return f"{self.__class__.__name__}:{self.__dict__}"
 
 
-_CONFIG = WasherConfig()
+_CONFIG = LazyConfig(WasherConfig)
 
 
 def remove_metadata(img: Image.Image) -> Image.Image:
-    """移除图片metadata"""
-    data = list(img.getdata())
-    image_without_exif = Image.new(img.mode, img.size)
-    image_without_exif.putdata(data)
+    """移除图片metadata, 直接复制像素缓冲区 (保留调色板和透明色)"""
+    image_without_exif = img.copy()
+    image_without_exif.info = {
+        k: v for k, v in img.info.items() if k == "transparency"
+    }
     return image_without_exif
 
 
+_FORMAT_ALIASES = {"jpg": "jpeg"}
+
+# 不解码直接删除的 metadata 块
+_PNG_METADATA = {b"tEXt", b"zTXt", b"iTXt", b"eXIf", b"iCCP", b"tIME"}
+_WEBP_METADATA = {b"EXIF", b"XMP ", b"ICCP"}
+_WEBP_METADATA_FLAGS = 0x20 | 0x08 | 0x04  # VP8X 中 ICC/EXIF/XMP 标志位
+# 保留 APP0 (JFIF) 和 APP14 (Adobe, 影响颜色转换)
+_JPEG_METADATA = {m for m in range(0xE1, 0xF0) if m != 0xEE} | {0xFE}
+
+
+def image_format(data: bytes) -> Optional[str]:
+    """根据文件头判断格式"""
+    if data.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "png"
+    if data.startswith(b"\xff\xd8"):
+        return "jpeg"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "webp"
+    return None
+
+
+def _strip_png(data: bytes) -> bytes:
+    out = [data[:8]]
+    pos = 8
+    while pos < len(data):
+        (length,) = struct.unpack(">I", data[pos : pos + 4])
+        end = pos + 12 + length
+        if data[pos + 4 : pos + 8] not in _PNG_METADATA:
+            out.append(data[pos:end])
+        pos = end
+    return b"".join(out)
+
+
+def _strip_jpeg(data: bytes) -> bytes:
+    out = [data[:2]]
+    pos = 2
+    while pos < len(data):
+        if data[pos] != 0xFF:
+            raise ValueError("invalid jpeg marker")
+        marker = data[pos + 1]
+        if marker == 0xFF:  # 填充字节
+            pos += 1
+            continue
+        if marker == 0xD9 or 0xD0 <= marker <= 0xD7 or marker == 0x01:
+            out.append(data[pos : pos + 2])
+            pos += 2
+            continue
+        if marker == 0xDA:  # SOS 之后为压缩数据, 原样复制
+            out.append(data[pos:])
+            break
+        (length,) = struct.unpack(">H", data[pos + 2 : pos + 4])
+        end = pos + 2 + length
+        if marker not in _JPEG_METADATA:
+            out.append(data[pos:end])
+        pos = end
+    return b"".join(out)
+
+
+def _strip_webp(data: bytes) -> bytes:
+    chunks = []
+    pos = 12
+    while pos < len(data):
+        fourcc = data[pos : pos + 4]
+        (size,) = struct.unpack("<I", data[pos + 4 : pos + 8])
+        end = pos + 8 + size + (size & 1)
+        chunk = data[pos:end]
+        if fourcc == b"VP8X":
+            chunk = (
+                chunk[:8]
+                + bytes([chunk[8] & ~_WEBP_METADATA_FLAGS & 0xFF])
+                + chunk[9:]
+            )
+        if fourcc not in _WEBP_METADATA:
+            chunks.append(chunk)
+        pos = end
+    body = b"WEBP" + b"".join(chunks)
+    return b"RIFF" + struct.pack("<I", len(body)) + body
+
+
+def strip_metadata_bytes(data: bytes, target_format: str) -> Optional[bytes]:
+    """
+    不解码, 直接删除文件中的 EXIF/XMP/ICC/文本块
+    源格式与 target_format 不同或无法解析时返回 None
+    """
+    target_format = target_format.lower()
+    fmt = image_format(data)
+    if fmt is None or fmt != _FORMAT_ALIASES.get(target_format, target_format):
+        return None
+
+    strip = {"png": _strip_png, "jpeg": _strip_jpeg, "webp": _strip_webp}[fmt]
+    try:
+        return strip(data)
+    except (struct.error, IndexError, ValueError):
+        return None
+
+
+def target_path(file_path: str) -> str:
+    """清洗后保存的路径, 扩展名为 target_format"""
+    return f"{os.path.splitext(file_path)[0]}.{_CONFIG.target_format}"
+
+
+def save_clean(file_path: str, file_content: bytes, manifest: Manifest):
+    """保存清洗后的图片, 格式改变时删除原文件, 并记录到清单"""
+    save_path = target_path(file_path)
+    with open(save_path, "wb") as f:
+        f.write(file_content)
+    if save_path != file_path:
+        os.remove(file_path)
+        manifest.remove(file_path)
+    manifest.mark(save_path, content_hash(file_content))
+
+
+def finish(future, file_path: str, manifest: Manifest):
+    """保存转码结果, 单张图片失败时记录日志, 不影响其他已完成的转码"""
+    try:
+        save_clean(file_path, future.result(), manifest)
+    except Exception as e:
+        logging.error(f"wash failed: {file_path} {repr(e)}")
+
+
+def strip_file(file_path: str, file_content: bytes, manifest: Manifest) -> Optional[bytes]:
+    """格式相同时不解码, 直接删除 metadata 块并记录到清单; 需要重新编码时返回 None"""
+    stripped = strip_metadata_bytes(file_content, _CONFIG.target_format)
+    if stripped is None:
+        return None
+    if len(stripped) != len(file_content):
+        with open(file_path, "wb") as f:
+            f.write(stripped)
+    manifest.mark(file_path, content_hash(stripped))
+    return stripped
+
+
+def wash_file(
+    file_path: str, file_content: bytes, manifest: Manifest
+) -> Tuple[str, bytes]:
+    """
+    清洗一张已读入内存的图片, 返回 (保存路径, 清洗后的内容)
+    需要重新编码时阻塞等待转码进程池, 用于流水线中逐张处理
+    """
+    import transcoder
+
+    stripped = strip_file(file_path, file_content, manifest)
+    if stripped is not None:
+        return file_path, stripped
+    file_content = transcoder.submit(file_content, _CONFIG.target_format).result()
+    save_clean(file_path, file_content, manifest)
+    return target_path(file_path), file_content
+
+
+def manifest_path(path: str) -> str:
+    """清洗记录路径, 默认为数据集下的 .washer_manifest.db"""
+    return _CONFIG.manifest or os.path.join(path, ".washer_manifest.db")
+
+
 def recursive_search(path: str):
-    """递归搜索文件夹里的图片"""
-    for file_path in os.listdir(path):
-        file_path = os.path.join(path, file_path)
-
-        if os.path.isdir(file_path):
-            recursive_search(file_path)
-
-        if os.path.isfile(file_path) and file_path.lower().endswith(
-            _CONFIG.filter_format
-        ):
-            img = Image.open(file_path)
-            img = remove_metadata(img)
-            img.save(file_path, _CONFIG.target_format)
+    """
+    递归清洗文件夹里的图片, 在转码进程池中并行处理
+    清单中已清洗且大小、修改时间未变的文件直接跳过
+    """
+    import transcoder  # transcoder 依赖本模块的 remove_metadata
+
+    with Manifest(manifest_path(path), path) as manifest:
+        pending = deque()
+        for item in dataset_index.scan(path, _CONFIG.filter_format):
+            file_path = item.image
+            if manifest.is_clean(file_path, os.stat(file_path)):
+                continue
+
+            with open(file_path, "rb") as f:
+                file_content = f.read()
+
+            # 格式相同时不解码, 直接删除 metadata 块
+            if strip_file(file_path, file_content, manifest) is not None:
+                continue
+
+            pending.append(
+                (transcoder.submit(file_content, _CONFIG.target_format), file_path)
+            )
+
+            # 限制同时在内存中的图片数
+            if len(pending) >= _CONFIG.max_pending:
+                finish(*pending.popleft(), manifest)
+
+        while pending:
+            finish(*pending.popleft(), manifest)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,165 @@
+# coding=utf-8
+import atexit
+import logging
+import os
+import queue
+import threading
+import zlib
+from concurrent.futures import Future
+from typing import List, Optional, Set, Union
+
+import yaml
+
+import metrics
+from config import LazyConfig
+
+
+class WriterConfig:
+
+    def __init__(self):
+        with open("./config.yml", "r") as f:
+            conf = yaml.safe_load(f)
+            # 可选配置, 没有时使用默认值
+            conf = conf.get("writer") or {}
+            self.workers = conf.get("workers", 4)  # 写入线程数
+            self.queue_size = conf.get("queue_size", 1024)  # 等待写入的文件数上限
+
+    def __str__(self):
+        return f"{self.__class__.__name__}:{self.__dict__}"
+
+
+_CONFIG = LazyConfig(WriterConfig)
+
+
+class AsyncWriter:
+    """
+    后台写入 txt 等小文件, 写满队列时阻塞提交的线程
+    先写临时文件再重命名, 不会留下写了一半的文件
+    同一路径的操作总是由同一个线程按提交顺序执行
+    """
+
+    def __init__(self, workers: int, queue_size: int):
+        size = max(1, queue_size // workers)
+        self.queues: List[queue.Queue] = [queue.Queue(size) for _ in range(workers)]
+        self.dirs: Set[str] = set()  # 已创建的文件夹
+        self.dirs_lock = threading.Lock()
+        self.threads = [
+            threading.Thread(target=self._loop, args=(q,), daemon=True)
+            for q in self.queues
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def _queue(self, path: str) -> queue.Queue:
+        return self.queues[zlib.crc32(path.encode("utf-8")) % len(self.queues)]
+
+    def write(
+        self, path: str, content: Union[str, bytes], encoding: str = "utf-8"
+    ) -> Future:
+        """提交写入, 文本按 encoding 编码, 不转换换行符"""
+        path = os.path.abspath(path)
+        if isinstance(content, str):
+            content = content.encode(encoding)
+        future = Future()
+        self._queue(path).put((self._write, path, content, future))
+        return future
+
+    def remove(self, path: str) -> Future:
+        """提交删除, 在之前提交的同一路径的写入之后执行"""
+        path = os.path.abspath(path)
+        future = Future()
+        self._queue(path).put((self._remove, path, None, future))
+        return future
+
+    def pending(self) -> int:
+        """等待写入的文件数"""
+        return sum(q.qsize() for q in self.queues)
+
+    def flush(self):
+        """等待已提交的操作全部完成"""
+        for q in self.queues:
+            q.join()
+
+    def close(self):
+        self.flush()
+        for q in self.queues:
+            q.put(None)
+        for thread in self.threads:
+            thread.join()
+
+    def _makedirs(self, folder: str):
+        if folder in self.dirs:
+            return
+        os.makedirs(folder, exist_ok=True)
+        with self.dirs_lock:
+            self.dirs.add(folder)
+
+    @metrics.timed("writer.write")
+    def _write(self, path: str, content: bytes):
+        self._makedirs(os.path.dirname(path))
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(content)
+            os.replace(tmp_path, path)
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def _remove(self, path: str, _):
+        if os.path.exists(path):
+            os.remove(path)
+
+    def _loop(self, q: queue.Queue):
+        while True:
+            task = q.get()
+            if task is None:
+                q.task_done()
+                return
+            func, path, content, future = task
+            try:
+                func(path, content)
+                future.set_result(path)
+            except Exception as e:
+                logging.error(f"write failed: {path} {repr(e)}")
+                future.set_exception(e)
+            finally:
+                q.task_done()
+
+
+_WRITER: Optional[AsyncWriter] = None
+_LOCK = threading.Lock()
+
+
+def get_writer() -> AsyncWriter:
+    """共享的写入线程, 进程退出时写完剩余文件"""
+    global _WRITER
+    with _LOCK:
+        if _WRITER is None:
+            _WRITER = AsyncWriter(_CONFIG.workers, _CONFIG.queue_size)
+            metrics.gauge("writer.queue", _WRITER.pending)
+            atexit.register(shutdown)
+        return _WRITER
+
+
+def write(path: str, content: Union[str, bytes], encoding: str = "utf-8") -> Future:
+    return get_writer().write(path, content, encoding)
+
+
+def remove(path: str) -> Future:
+    return get_writer().remove(path)
+
+
+def flush():
+    if _WRITER is not None:
+        _WRITER.flush()
+
+
+def shutdown():
+    global _WRITER
+    with _LOCK:
+        if _WRITER is not None:
+            _WRITER.close()
+            _WRITER = None
+            metrics.remove_gauge("writer.queue")